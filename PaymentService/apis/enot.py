@@ -7,6 +7,11 @@ import hashlib
 from enum import Enum
 from pydantic import BaseModel, validator
 
+from apis.sessions import ensure_session
+
+
+API_URL = "https://api.enot.io"
+
 
 @dataclass
 class EnotInvoiceInfo:
@@ -42,7 +47,9 @@ async def create_invoice_async(
         success_url: str | None = None,
         expire_minutes: int | None = None,
         include_services: list[str] | None = None,
-        exclude_services: str | None = None
+        exclude_services: str | None = None,
+        session: aiohttp.ClientSession | None = None,    # если не передана, для запроса создается временная сессия
+        api_url: str = API_URL,
 ):
     """
     Создает счет на оплату в сервисе enot.io
@@ -73,8 +80,8 @@ async def create_invoice_async(
     if exclude_services is not None:
         data["exclude_service"] = exclude_services
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api.enot.io/invoice/create",
+    async with ensure_session(session) as session:
+        async with session.post(f"{api_url}/invoice/create",
                                 headers=__build_headers(secret_key),
                                 json=data,
                                 ) as response:
@@ -97,6 +104,59 @@ async def create_invoice_async(
             return invoice_info
 
 
+@dataclass
+class EnotInvoiceStatusInfo:
+    invoice_id: str
+    """ID операции в системе enot.io"""
+    order_id: str
+    status: str    # created, success, fail, expired, refund
+    amount: float
+    credited: float | None
+    pay_time: datetime.datetime | None
+
+
+# https://docs.enot.io/e/new/invoice-info
+async def get_invoice_info_async(
+        shop_id: str,
+        secret_key: str,
+        invoice_id: str | None = None,
+        order_id: str | None = None,    # используется, если invoice_id не передан
+        session: aiohttp.ClientSession | None = None,
+        api_url: str = API_URL,
+):
+    """
+    Возвращает текущий статус счета в сервисе enot.io
+    """
+    params = {"shop_id": shop_id}
+    if invoice_id is not None:
+        params["invoice_id"] = invoice_id
+    else:
+        params["order_id"] = order_id
+
+    async with ensure_session(session) as session:
+        async with session.get(f"{api_url}/invoice/info",
+                               headers=__build_headers(secret_key),
+                               params=params,
+                               ) as response:
+            if response.status != 200:
+                try:
+                    response_json = await response.json(encoding="utf-8")
+                except Exception as e:
+                    response_json = {"code": response.status, "error": f"Failed to read JSON response: {str(e)}"}
+
+                raise APIError(response_json)
+
+            response_data: dict = (await response.json(encoding="utf-8")).get("data", {})
+            return EnotInvoiceStatusInfo(
+                response_data["invoice_id"],
+                response_data["order_id"],
+                response_data["status"],
+                float(response_data.get("invoice_amount") or 0),
+                float(response_data["credited"]) if response_data.get("credited") else None,
+                datetime.datetime.strptime(response_data["pay_time"], "%Y-%m-%d %H:%M:%S") if response_data.get("pay_time") else None,
+            )
+
+
 def __build_headers(secret_key: str) -> dict[str, str]:
     """Возвращает словарь с заголовками для запросов к API"""
     return {
@@ -107,14 +167,32 @@ def __build_headers(secret_key: str) -> dict[str, str]:
 
 
 # https://docs.enot.io/e/new/webhook
-def check_signature(hook_body: dict, header_signature, secret_key) -> bool:
-  sorted_hook_json = json.dumps(hook_body, sort_keys=True, separators=(', ', ': '))
-  calc_sign = hmac.new(
-    secret_key,
-    msg=sorted_hook_json.encode('utf-8'),
-    digestmod=hashlib.sha256
-  ).hexdigest()
-  return hmac.compare_digest(header_signature, calc_sign)
+def check_signature(body: bytes, header_signature: str, key: hmac.HMAC) -> bool:
+    """
+    Проверяет подпись вебхука по исходному телу запроса.
+    :param key: hmac.new(дополнительный ключ, digestmod=hashlib.sha256), подготовленный один раз
+    """
+    if not header_signature:
+        return False
+
+    # enot подписывает JSON с ключами, отсортированными по алфавиту. Обычно тело приходит уже в таком виде
+    # и проверяется без разбора, иначе оно приводится к этому виду
+    if __matches(key, body, header_signature):
+        return True
+    try:
+        hook_body = json.loads(body)
+    except ValueError:
+        return False
+    if not isinstance(hook_body, dict):
+        return False
+    sorted_hook_json = json.dumps(hook_body, sort_keys=True, separators=(', ', ': '))
+    return __matches(key, sorted_hook_json.encode('utf-8'), header_signature)
+
+
+def __matches(key: hmac.HMAC, payload: bytes, header_signature: str) -> bool:
+    mac = key.copy()
+    mac.update(payload)
+    return hmac.compare_digest(header_signature.encode("utf-8"), mac.hexdigest().encode("utf-8"))
 
 
 class EnotWebhookStatus(Enum):
@@ -157,4 +235,6 @@ class EnotWebhook(BaseModel):
 
     @validator('pay_time', 'reject_time', 'refund_time', pre=True)
     def parse_datetime(cls, value):
+        if value is None:
+            return None
         return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
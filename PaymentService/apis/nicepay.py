@@ -8,7 +8,9 @@ from typing import Annotated
 import hmac
 import hashlib
 
-CREATE_INVOICE_URL = "https://nicepay.io/public/api/payment"
+from apis.sessions import ensure_session
+
+API_URL = "https://nicepay.io"
 
 class APIError(Exception):
     """Базовый класс для всех ошибок, возвращаемых API"""
@@ -41,7 +43,9 @@ async def create_invoice_async(merchant_id: str,
                                description: str | None = None,
                                method: str | None = None,
                                success_url: str | None = None,
-                               fail_url: str | None = None):
+                               fail_url: str | None = None,
+                               session: aiohttp.ClientSession | None = None,
+                               api_url: str = API_URL):
     """
     https://nicepay.io/ru/docs/merchant/payment
     """
@@ -57,8 +61,8 @@ async def create_invoice_async(merchant_id: str,
     if fail_url:
         data["fail_url"] = fail_url
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(CREATE_INVOICE_URL, json=data) as response:
+    async with ensure_session(session) as session:
+        async with session.post(f"{api_url}/public/api/payment", json=data) as response:
             if response.status != 200:
                 try:
                     response_json = await response.json(encoding="utf-8")
@@ -103,7 +107,9 @@ class NicepayWebhook(BaseModel):
 
 
 def is_hash_valid(secret_key: str, data: dict):
-    hash_received = data.pop('hash')
+    hash_received = data.pop('hash', None)
+    if not hash_received:
+        return False
 
     sorted_params = dict(sorted(data.items()))
 
@@ -113,4 +119,4 @@ def is_hash_valid(secret_key: str, data: dict):
 
     hash_calculated = hashlib.sha256(hash_string.encode()).hexdigest()
 
-    return hash_received == hash_calculated
\ No newline at end of file
+    return hmac.compare_digest(hash_received.encode("utf-8"), hash_calculated.encode("utf-8"))
\ No newline at end of file
@@ -3,9 +3,14 @@ import aiohttp
 from dataclasses import dataclass
 from pydantic import BaseModel
 import hashlib
+import hmac
 import decimal
 
 import config
+from apis.sessions import ensure_session
+
+
+API_URL = "https://pal24.pro"
 
 
 @dataclass
@@ -30,6 +35,8 @@ async def create_bill_async(shop_id: str,
                             order_id: str,
                             name: str,
                             description: str,
+                            session: aiohttp.ClientSession | None = None,
+                            api_url: str = API_URL,
                             ):
     data = {
         "shop_id": shop_id,
@@ -41,8 +48,8 @@ async def create_bill_async(shop_id: str,
 
     headers = __build_headers(secret_key)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://pal24.pro/api/v1/bill/create",
+    async with ensure_session(session) as session:
+        async with session.post(f"{api_url}/api/v1/bill/create",
                                 headers=headers,
                                 data=data) as response:
             if response.status != 200:
@@ -62,6 +69,36 @@ async def create_bill_async(shop_id: str,
             )
 
 
+@dataclass
+class PallyBillStatusInfo:
+    id: str
+    status: Literal["NEW", "PROCESS", "UNDERPAID", "SUCCESS", "OVERPAID", "FAIL"]
+
+
+async def get_bill_status_async(secret_key: str,
+                                bill_id: str,
+                                session: aiohttp.ClientSession | None = None,
+                                api_url: str = API_URL,
+                                ):
+    async with ensure_session(session) as session:
+        async with session.get(f"{api_url}/api/v1/bill/status",
+                               headers=__build_headers(secret_key),
+                               params={"id": bill_id}) as response:
+            if response.status != 200:
+                try:
+                    response_json = await response.json(encoding="utf-8")
+                except Exception as e:
+                    response_json = {
+                        "code": response.status,
+                        "error": f"Failed to read JSON response: {str(e)}",
+                    }
+
+                raise APIError(response_json)
+
+            response_data: dict = (await response.json(encoding="utf-8"))
+            return PallyBillStatusInfo(response_data["id"], response_data["status"])
+
+
 def __build_headers(secret_key: str) -> dict[str, str]:
     """Возвращает словарь с заголовками для запросов к API"""
     return {
@@ -76,13 +113,13 @@ class PostbackForm(BaseModel):
     OutSum: decimal.Decimal
     Commission: decimal.Decimal
     TrsId: str
-    Status: Literal["SUCCESS", "UNDERPAID", "OVERPAID", "SUCCESS"]
+    Status: Literal["SUCCESS", "UNDERPAID", "OVERPAID", "FAIL"]
     ErrorCode: int | None = None
     ErrorMessage: str | None = None
     SignatureValue: str
 
 
-def is_signature_valid(signature: str, out_sum: decimal.Decimal, invoice_id: str) -> bool:
+def is_signature_valid(signature: str, out_sum: decimal.Decimal | str, invoice_id: str) -> bool:
     string = f"{out_sum}:{invoice_id}:{config.PALLY_SECRET_KEY}"
     sig = hashlib.md5(string.encode("utf-8")).hexdigest().lower()
-    return sig == signature.lower()
+    return hmac.compare_digest(sig.encode("utf-8"), signature.lower().encode("utf-8"))
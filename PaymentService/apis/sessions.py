@@ -0,0 +1,73 @@
+"""
+Долгоживущие HTTP сессии для запросов к API платежных систем.
+
+У каждой платежной системы своя сессия и свой пул keep-alive соединений,
+поэтому DNS запрос, TCP подключение и TLS рукопожатие не повторяются на каждый счет,
+а медленный провайдер не занимает соединения остальных.
+"""
+import ssl
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+
+class ProviderSessions:
+
+    _default_limit: int
+    _limits: dict[str, int]
+    _timeout: aiohttp.ClientTimeout
+    _dns_cache_ttl: int
+    _keepalive_timeout: float
+    _ssl_context: ssl.SSLContext
+    _sessions: dict[str, aiohttp.ClientSession]
+
+    def __init__(self, default_limit: int = 20, limits: dict[str, int] | None = None, timeout: float = 30,
+                 connect_timeout: float = 5, dns_cache_ttl: int = 300, keepalive_timeout: float = 60):
+        """
+        :param default_limit: максимальное количество одновременных соединений с одной платежной системой
+        :param limits: переопределение default_limit для отдельных платежных систем
+        :param timeout: таймаут запроса целиком
+        :param connect_timeout: таймаут получения соединения (включая ожидание свободного соединения в пуле)
+        :param dns_cache_ttl: время кэширования DNS записей в секундах
+        :param keepalive_timeout: сколько секунд простаивающее соединение остается открытым
+        """
+        self._default_limit = default_limit
+        self._limits = limits or {}
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        # общий контекст: сертификаты загружаются один раз, а не для каждого соединения
+        self._ssl_context = ssl.create_default_context()
+        self._sessions = {}
+
+    def get(self, provider: str) -> aiohttp.ClientSession:
+        """
+        Возвращает сессию платежной системы, создавая ее при первом обращении.
+        """
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limits.get(provider, self._default_limit),
+                                             ttl_dns_cache=self._dns_cache_ttl,
+                                             keepalive_timeout=self._keepalive_timeout,
+                                             ssl=self._ssl_context)
+            session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+            self._sessions[provider] = session
+        return session
+
+    async def close_async(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+@asynccontextmanager
+async def ensure_session(session: aiohttp.ClientSession | None):
+    """
+    Возвращает переданную сессию, а если ее нет - временную, которая закрывается после использования.
+    """
+    if session is not None:
+        yield session
+        return
+
+    async with aiohttp.ClientSession() as temporary_session:
+        yield temporary_session
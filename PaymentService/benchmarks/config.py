@@ -0,0 +1,61 @@
+"""
+Конфигурация сервиса для бенчмарка. serve.py подставляет ее вместо config.py сервиса.
+Все платежные системы указывают на заглушки из stubs.py, БД и Redis - на контейнеры из docker-compose.yaml.
+"""
+
+DEBUG = True
+
+AUTH_TOKEN = "bench-token"
+
+MYSQL_HOST = "127.0.0.1"
+MYSQL_PORT = 3307
+MYSQL_USER = "root"
+MYSQL_PASSWORD = "bench"
+MYSQL_DATABASE = "payment_bench"
+MYSQL_POOL_MAX_SIZE = 20
+
+REDIS_URL = "redis://127.0.0.1:6380/0"
+
+# счета с потерянными вебхуками (--lost-webhooks) сверяются сразу, без ожидания
+RECONCILE_STALE_MINUTES = 0
+RECONCILE_INTERVAL = 1
+RECONCILE_CONCURRENCY = 20
+RECONCILE_RATE_LIMIT = 500
+
+# нагрузка идет с одного IP и одного токена, поэтому ограничение частоты запросов отключено
+RATE_LIMITS = {}
+
+APP_HOST = "127.0.0.1"
+APP_PORT = 8101
+STUBS_HOST = "127.0.0.1"
+STUBS_PORT = 8102
+STUBS_URL = f"http://{STUBS_HOST}:{STUBS_PORT}"
+
+CHOOSE_METHOD_URL = "http://127.0.0.1/choose/{}"
+SUCCESS_URL = "http://127.0.0.1/success"
+FAILED_URL = "http://127.0.0.1/failed"
+
+AAIO_API_KEY = "bench"
+AAIO_SHOP_ID = "bench-shop"
+AAIO_KEY1 = "bench-key1"
+AAIO_KEY2 = "bench-key2"
+
+# клиент lava использует фиксированный адрес API, поэтому для lava проверяется только прием вебхуков
+LAVA_SECRET_KEY = "bench"
+LAVA_SHOP_ID = "bench-shop"
+LAVA_WEBHOOK_URL = "http://127.0.0.1/lava_webhook"
+LAVA_WEBHOOK_KEY = "bench-lava-key"
+
+ENOT_API_URL = f"{STUBS_URL}/enot"
+ENOT_SHOP_ID = "bench-shop"
+ENOT_SECRET_KEY = "bench"
+ENOT_WEBHOOK_URL = "http://127.0.0.1/enot_webhook"
+ENOT_WEBHOOK_KEY = "bench-enot-key"
+
+NICEPAY_API_URL = f"{STUBS_URL}/nicepay"
+NICEPAY_MERCHANT_ID = "bench-merchant"
+NICEPAY_SECRET_KEY = "bench-nicepay-key"
+
+PALLY_API_URL = f"{STUBS_URL}/pally"
+PALLY_SHOP_ID = "bench-shop"
+PALLY_SECRET_KEY = "bench-pally-key"
@@ -0,0 +1,257 @@
+"""
+Нагрузочный тест сервиса: create_invoice -> process_invoice -> вебхук платежной системы -> вебхук клиенту.
+С --lost-webhooks часть счетов enot и pally оплачивается без вебхука, и вебхук клиенту отправляется после сверки статуса (этап reconcile).
+
+Перед запуском нужно поднять MySQL и Redis: docker compose -f benchmarks/docker-compose.yaml up -d
+Команда для запуска: python benchmarks/run.py --invoices 2000 --concurrency 50
+Результаты сохраняются в JSON (--output), чтобы их можно было сравнивать между версиями.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+import aiomysql
+
+import config
+from stubs import ProviderStubs
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_URL = f"http://{config.APP_HOST}:{config.APP_PORT}"
+
+STAGES = ("create", "process", "webhook", "outbound_webhook", "reconcile")
+METHODS = ("enot", "nicepay", "pally", "aaio", "lava")
+# клиент lava подключается к фиксированному адресу API, поэтому для lava этап process пропускается:
+# вебхук об оплате отправляется для счета в статусе CREATED
+UNPROCESSED_METHODS = ("lava", )
+# способы оплаты, у которых заглушка отвечает на запрос статуса счета
+RECONCILED_METHODS = ("enot", "pally")
+
+
+@dataclass
+class StageResult:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def to_dict(self, duration: float) -> dict:
+        result = {"count": len(self.latencies), "errors": self.errors, "rps": round(len(self.latencies) / duration, 2)}
+        if self.latencies:
+            result.update(p50_ms=round(_percentile(self.latencies, 50) * 1000, 2),
+                          p99_ms=round(_percentile(self.latencies, 99) * 1000, 2),
+                          mean_ms=round(statistics.fmean(self.latencies) * 1000, 2),
+                          max_ms=round(max(self.latencies) * 1000, 2))
+        return result
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+class Benchmark:
+
+    _args: argparse.Namespace
+    _stubs: ProviderStubs
+    _session: aiohttp.ClientSession | None
+    _results: dict[str, StageResult]
+    _counter: itertools.count
+
+    def __init__(self, args: argparse.Namespace, stubs: ProviderStubs):
+        self._args = args
+        self._stubs = stubs
+        self._session = None
+        self._results = {stage: StageResult() for stage in STAGES}
+        self._counter = itertools.count()
+
+    async def run_async(self) -> dict:
+        connector = aiohttp.TCPConnector(limit=self._args.concurrency * 2)
+        async with aiohttp.ClientSession(APP_URL, connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as self._session:
+            await self._prepare_methods_async()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(self._worker_async() for _ in range(self._args.concurrency)))
+            duration = time.perf_counter() - started
+
+        return {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _get_commit(),
+            "params": {"invoices": self._args.invoices, "concurrency": self._args.concurrency, "methods": self._args.methods,
+                       "provider_latency_ms": self._args.latency_ms, "provider_failure_rate": self._args.failure_rate,
+                       "lost_webhooks": self._args.lost_webhooks},
+            "duration_seconds": round(duration, 3),
+            "stages": {stage: result.to_dict(duration) for stage, result in self._results.items()},
+        }
+
+    async def _prepare_methods_async(self):
+        """
+        Включает способы оплаты бенчмарка в payment_methods. Таблицы к этому моменту уже созданы сервисом.
+        """
+        conn = await aiomysql.connect(host=config.MYSQL_HOST, port=config.MYSQL_PORT, user=config.MYSQL_USER,
+                                      password=config.MYSQL_PASSWORD, db=config.MYSQL_DATABASE, autocommit=True)
+        try:
+            async with conn.cursor() as cur:
+                for method_id in self._args.methods:
+                    await cur.execute("INSERT INTO payment_methods (method_id, name, description, icon_url, instructions) "
+                                      "VALUES (%s, %s, '', '', NULL) ON DUPLICATE KEY UPDATE name = VALUES(name);",
+                                      (method_id, method_id))
+        finally:
+            conn.close()
+
+        async with self._session.post("/payment_service/methods/invalidate", json={"user_token": config.AUTH_TOKEN}) as resp:
+            resp.raise_for_status()
+
+    async def _worker_async(self):
+        while (i := next(self._counter)) < self._args.invoices:
+            await self._flow_async(self._args.methods[i % len(self._args.methods)], 100 + i % 900)
+
+    async def _flow_async(self, method_id: str, amount: int):
+        response = await self._request_async("create", "POST", "/payment_service/create_invoice",
+                                             json={"user_token": config.AUTH_TOKEN, "amount": amount, "comment": "benchmark",
+                                                   "webhook_url": self._stubs.client_webhook_url})
+        if response is None:
+            return
+        invoice_id = response["id"]
+
+        if method_id not in UNPROCESSED_METHODS and await self._request_async("process", "POST", "/payment_service/process_invoice",
+                                                                             json={"invoice_id": invoice_id, "method_id": method_id}) is None:
+            return
+
+        if method_id in RECONCILED_METHODS and random.random() < self._args.lost_webhooks:
+            await self._reconcile_flow_async(invoice_id)
+            return
+
+        webhook = self._stubs.build_webhook(method_id, invoice_id, amount)
+        delivered = self._stubs.expect_client_webhook(invoice_id)
+        if await self._request_async("webhook", webhook.method, f"/payment_service/{webhook.path}?{webhook.query}",
+                                     data=webhook.body or None, headers=webhook.headers) is None:
+            delivered.cancel()
+            return
+
+        started = asyncio.get_running_loop().time()
+        try:
+            delivered_at = await asyncio.wait_for(delivered, self._args.outbound_timeout)
+        except TimeoutError:
+            self._results["outbound_webhook"].errors += 1
+            return
+        # вебхук клиенту может прийти раньше, чем сервис ответит платежной системе
+        self._results["outbound_webhook"].latencies.append(max(0.0, delivered_at - started))
+
+    async def _reconcile_flow_async(self, invoice_id: str):
+        """
+        Вебхук платежной системы потерян: счет оплачивается в заглушке, и сервис должен найти оплату сам.
+        """
+        delivered = self._stubs.expect_client_webhook(invoice_id)
+        if not self._stubs.pay_bill(invoice_id):
+            delivered.cancel()
+            self._results["reconcile"].errors += 1
+            return
+
+        started = asyncio.get_running_loop().time()
+        try:
+            delivered_at = await asyncio.wait_for(delivered, self._args.reconcile_timeout)
+        except TimeoutError:
+            self._results["reconcile"].errors += 1
+            return
+        self._results["reconcile"].latencies.append(delivered_at - started)
+
+    async def _request_async(self, stage: str, method: str, path: str, **kwargs) -> dict | None:
+        started = time.perf_counter()
+        try:
+            async with self._session.request(method, path, **kwargs) as resp:
+                body = await resp.read()
+                if resp.status != 200:
+                    self._results[stage].errors += 1
+                    return None
+        except (aiohttp.ClientError, TimeoutError):
+            self._results[stage].errors += 1
+            return None
+        self._results[stage].latencies.append(time.perf_counter() - started)
+        return json.loads(body) if body else {}
+
+
+def _get_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _wait_for_app_async(timeout: float):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{APP_URL}/metrics") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Service did not start in {timeout} seconds")
+            await asyncio.sleep(0.5)
+
+
+def _print_report(report: dict):
+    print(f"{'stage':<18}{'count':>8}{'errors':>8}{'rps':>10}{'p50, ms':>10}{'p99, ms':>10}")
+    for stage, result in report["stages"].items():
+        print(f"{stage:<18}{result['count']:>8}{result['errors']:>8}{result['rps']:>10}"
+              f"{result.get('p50_ms', '-'):>10}{result.get('p99_ms', '-'):>10}")
+
+
+async def main(args: argparse.Namespace):
+    stubs = ProviderStubs(latency=args.latency_ms / 1000, failure_rate=args.failure_rate)
+    await stubs.start_async()
+
+    app = None
+    if not args.external_app:
+        os.makedirs(os.path.dirname(args.app_log) or ".", exist_ok=True)
+        with open(args.app_log, "w") as app_log:
+            app = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "serve.py")], stdout=app_log, stderr=subprocess.STDOUT)
+    try:
+        await _wait_for_app_async(args.startup_timeout)
+        report = await Benchmark(args, stubs).run_async()
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        await stubs.stop_async()
+
+    _print_report(report)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices", type=int, default=1000, help="количество счетов")
+    parser.add_argument("--concurrency", type=int, default=20, help="количество одновременных клиентов")
+    parser.add_argument("--methods", type=lambda s: s.split(","), default=list(METHODS),
+                        help=f"способы оплаты через запятую, по умолчанию {','.join(METHODS)}")
+    parser.add_argument("--latency-ms", type=float, default=50, help="средняя задержка ответа платежных систем")
+    parser.add_argument("--failure-rate", type=float, default=0, help="доля ошибок платежных систем при создании счета")
+    parser.add_argument("--lost-webhooks", type=float, default=0, help="доля счетов enot и pally, оплачиваемых без вебхука")
+    parser.add_argument("--reconcile-timeout", type=float, default=60, help="сколько секунд ждать вебхук клиенту после сверки")
+    parser.add_argument("--outbound-timeout", type=float, default=30, help="сколько секунд ждать вебхук клиенту")
+    parser.add_argument("--external-app", action="store_true", help="не запускать сервис, а использовать уже запущенный serve.py")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--app-log", default=os.path.join(BENCH_DIR, "results", "app.log"))
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", f"bench_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"))
+    parsed = parser.parse_args()
+
+    unknown = set(parsed.methods) - set(METHODS)
+    if unknown:
+        parser.error(f"no provider stub for: {', '.join(sorted(unknown))}")
+    asyncio.run(main(parsed))
@@ -0,0 +1,21 @@
+"""
+Запускает сервис с конфигурацией бенчмарка (benchmarks/config.py).
+Команда для запуска: python benchmarks/serve.py
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+
+# папка скрипта уже первая в sys.path, поэтому import config находит конфигурацию бенчмарка, а не сервиса
+sys.path.insert(1, SERVICE_DIR)
+os.chdir(SERVICE_DIR)
+
+import uvicorn
+
+import config
+
+
+if __name__ == '__main__':
+    uvicorn.run("main:app", host=config.APP_HOST, port=config.APP_PORT, log_level="warning")
@@ -0,0 +1,227 @@
+"""
+Заглушки платежных систем для бенчмарка.
+
+Отвечают на создание счетов в enot, nicepay и pally с заданной задержкой и долей ошибок,
+формируют подписанные вебхуки всех платежных систем и принимают вебхуки, которые сервис отправляет клиенту.
+Счета enot и pally можно оплатить без вебхука (pay_bill): тогда их статус видно только через API статуса, как при потерянном вебхуке.
+Команда для запуска отдельно от run.py: python benchmarks/stubs.py
+"""
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import random
+import urllib.parse
+import uuid
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+import config
+
+
+@dataclass
+class StubWebhook:
+    """
+    Вебхук платежной системы, готовый к отправке в сервис.
+    """
+    method: str
+    path: str
+    body: bytes = b""
+    query: str = ""
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+class ProviderStubs:
+
+    latency: float
+    jitter: float
+    failure_rate: float
+
+    _provider_ids: dict[str, str]    # ID счета в сервисе -> ID счета в платежной системе
+    _bills: dict[str, dict]    # ID счета в платежной системе -> order_id, amount, paid
+    _client_webhooks: dict[str, asyncio.Future]
+    _runner: web.AppRunner | None
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, failure_rate: float = 0):
+        """
+        :param latency: средняя задержка ответа платежной системы в секундах
+        :param jitter: разброс задержки относительно latency (0.5 - от 0.5 до 1.5 latency)
+        :param failure_rate: доля запросов на создание счета, на которые платежная система отвечает ошибкой
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._provider_ids = {}
+        self._bills = {}
+        self._client_webhooks = {}
+        self._runner = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/enot/invoice/create", self._enot_create)
+        app.router.add_post("/nicepay/public/api/payment", self._nicepay_create)
+        app.router.add_post("/pally/api/v1/bill/create", self._pally_create)
+        app.router.add_get("/enot/invoice/info", self._enot_info)
+        app.router.add_get("/pally/api/v1/bill/status", self._pally_status)
+        app.router.add_post("/client/webhook", self._client_webhook)
+        return app
+
+    async def start_async(self, host: str = config.STUBS_HOST, port: int = config.STUBS_PORT):
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop_async(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @property
+    def client_webhook_url(self) -> str:
+        return f"{config.STUBS_URL}/client/webhook"
+
+    def expect_client_webhook(self, invoice_id: str) -> asyncio.Future:
+        """
+        Возвращает future, который завершится, когда сервис отправит клиенту вебхук об оплате счета.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._client_webhooks[invoice_id] = future
+        return future
+
+    def pay_bill(self, invoice_id: str) -> bool:
+        """
+        Оплачивает счет в заглушке без отправки вебхука. Возвращает False, если счет в заглушке не создавался.
+        """
+        bill = self._bills.get(self._provider_ids.pop(invoice_id, None))
+        if bill is None:
+            return False
+        bill["paid"] = True
+        return True
+
+    def build_webhook(self, method_id: str, invoice_id: str, amount: float) -> StubWebhook:
+        """
+        Формирует подписанный вебхук об успешной оплате счета так же, как его отправила бы платежная система.
+        """
+        provider_id = self._provider_ids.pop(invoice_id, None) or str(uuid.uuid4())
+        match method_id:
+            case "enot":
+                body = {"invoice_id": provider_id, "status": "success", "amount": f"{amount:.2f}", "currency": "RUB",
+                        "order_id": invoice_id, "type": 1, "code": 1, "credited": f"{amount:.2f}",
+                        "pay_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+                raw = json.dumps(body, sort_keys=True, separators=(', ', ': ')).encode("utf-8")
+                signature = hmac.new(config.ENOT_WEBHOOK_KEY.encode("utf-8"), raw, hashlib.sha256).hexdigest()
+                return StubWebhook("POST", "enot_webhook", raw, headers={"Content-Type": "application/json",
+                                                                          "x-api-sha256-signature": signature})
+            case "lava":
+                body = {"invoice_id": provider_id, "order_id": invoice_id, "status": "success",
+                        "pay_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "amount": amount, "credited": amount}
+                raw = json.dumps(body).encode("utf-8")
+                signature = hmac.new(config.LAVA_WEBHOOK_KEY.encode("utf-8"), raw, hashlib.sha256).hexdigest()
+                return StubWebhook("POST", "lava_webhook", raw, headers={"Content-Type": "application/json",
+                                                                          "Authorization": signature})
+            case "aaio":
+                form = {"merchant_id": config.AAIO_SHOP_ID, "invoice_id": provider_id, "order_id": invoice_id,
+                        "amount": f"{amount:.2f}", "currency": "RUB", "profit": f"{amount:.2f}"}
+                form["sign"] = hashlib.sha256(f"{config.AAIO_SHOP_ID}:{form['amount']}:RUB:{config.AAIO_KEY2}:{invoice_id}".encode("utf-8")).hexdigest()
+                return StubWebhook("POST", "aaio_webhook", urllib.parse.urlencode(form).encode("utf-8"),
+                                   headers={"Content-Type": "application/x-www-form-urlencoded"})
+            case "nicepay":
+                cents = str(int(round(amount * 100)))
+                query = {"result": "success", "payment_id": provider_id, "merchant_id": config.NICEPAY_MERCHANT_ID,
+                         "order_id": invoice_id, "amount": cents, "amount_currency": "RUB", "profit": cents,
+                         "profit_currency": "RUB", "method": "card"}
+                values = [value for _, value in sorted(query.items())] + [config.NICEPAY_SECRET_KEY]
+                query["hash"] = hashlib.sha256("{np}".join(values).encode()).hexdigest()
+                return StubWebhook("GET", "nicepay_webhook", query=urllib.parse.urlencode(query))
+            case "pally":
+                form = {"InvId": invoice_id, "OutSum": f"{amount:.2f}", "Commission": "0", "TrsId": str(uuid.uuid4()), "Status": "SUCCESS"}
+                form["SignatureValue"] = hashlib.md5(f"{form['OutSum']}:{invoice_id}:{config.PALLY_SECRET_KEY}".encode("utf-8")).hexdigest().upper()
+                return StubWebhook("POST", "pally_webhook", urllib.parse.urlencode(form).encode("utf-8"),
+                                   headers={"Content-Type": "application/x-www-form-urlencoded"})
+        raise ValueError(f"Unknown payment method: {method_id}")
+
+    async def _respond_delay_async(self) -> bool:
+        """
+        Ждет, как ждала бы платежная система. Возвращает False, если запрос должен завершиться ошибкой.
+        """
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        return random.random() >= self.failure_rate
+
+    async def _enot_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if not await self._respond_delay_async():
+            return web.json_response({"status": 500, "error": "Stub failure"}, status=500)
+
+        provider_id = self._add_bill(data["order_id"], float(data["amount"]))
+        expired = (datetime.datetime.now() + datetime.timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        return web.json_response({"data": {"id": provider_id, "amount": data["amount"], "currency": "RUB",
+                                           "url": f"{config.STUBS_URL}/pay/{provider_id}", "expired": expired}})
+
+    async def _nicepay_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if not await self._respond_delay_async():
+            return web.json_response({"status": "error", "data": {"message": "Stub failure"}}, status=500)
+
+        provider_id = str(uuid.uuid4())
+        self._provider_ids[data["order_id"]] = provider_id
+        expired = (datetime.datetime.now() + datetime.timedelta(hours=1)).timestamp()
+        return web.json_response({"status": "success", "data": {"payment_id": provider_id, "amount": data["amount"], "currency": "RUB",
+                                                                "link": f"{config.STUBS_URL}/pay/{provider_id}", "expired": expired}})
+
+    async def _pally_create(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        if not await self._respond_delay_async():
+            return web.json_response({"code": 500, "error": "Stub failure"}, status=500)
+
+        provider_id = self._add_bill(data["order_id"], float(data["amount"]))
+        return web.json_response({"success": "true", "bill_id": provider_id, "link_page_url": f"{config.STUBS_URL}/pay/{provider_id}"})
+
+    async def _enot_info(self, request: web.Request) -> web.Response:
+        if not await self._respond_delay_async():
+            return web.json_response({"status": 500, "error": "Stub failure"}, status=500)
+
+        provider_id = request.query.get("invoice_id")
+        bill = self._bills.get(provider_id)
+        if bill is None:
+            return web.json_response({"status": 404, "error": "Invoice not found"}, status=404)
+        pay_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") if bill["paid"] else None
+        return web.json_response({"data": {"invoice_id": provider_id, "order_id": bill["order_id"],
+                                           "status": "success" if bill["paid"] else "created",
+                                           "invoice_amount": bill["amount"], "credited": bill["amount"] if bill["paid"] else None,
+                                           "currency": "RUB", "pay_time": pay_time}, "status": 200})
+
+    async def _pally_status(self, request: web.Request) -> web.Response:
+        if not await self._respond_delay_async():
+            return web.json_response({"code": 500, "error": "Stub failure"}, status=500)
+
+        provider_id = request.query.get("id")
+        bill = self._bills.get(provider_id)
+        if bill is None:
+            return web.json_response({"success": "false", "message": "Bill not found"}, status=404)
+        return web.json_response({"success": "true", "id": provider_id, "status": "SUCCESS" if bill["paid"] else "NEW"})
+
+    def _add_bill(self, order_id: str, amount: float) -> str:
+        provider_id = str(uuid.uuid4())
+        self._provider_ids[order_id] = provider_id
+        self._bills[provider_id] = {"order_id": order_id, "amount": amount, "paid": False}
+        return provider_id
+
+    async def _client_webhook(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        future = self._client_webhooks.pop(data.get("invoice_id"), None)
+        if future is not None and not future.done():
+            future.set_result(asyncio.get_running_loop().time())
+        return web.json_response({"success": True})
+
+
+async def main():
+    stubs = ProviderStubs()
+    await stubs.start_async()
+    print(f"Provider stubs are listening on {config.STUBS_URL}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
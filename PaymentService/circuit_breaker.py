@@ -0,0 +1,142 @@
+"""
+Защита от зависших и отказывающих платежных систем.
+
+Для каждой платежной системы ограничивается количество одновременных запросов и их время (bulkhead),
+а после серии ошибок или медленных ответов запросы к ней временно не выполняются (circuit breaker).
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable, TypeVar
+
+import metrics
+
+
+T = TypeVar("T")
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"    # запросы выполняются
+    OPEN = "open"    # запросы отклоняются без обращения к платежной системе
+    HALF_OPEN = "half_open"    # выполняется пробный запрос, по результату которого цепь замыкается или снова размыкается
+
+
+class ProviderRejectedError(Exception):
+    """Запрос отклонен без обращения к платежной системе"""
+    def __init__(self, provider: str, reason: str):
+        self.provider = provider
+        super().__init__(f"Request to '{provider}' rejected: {reason}")
+
+
+class ProviderGuard:
+
+    name: str
+
+    _semaphore: asyncio.Semaphore
+    _timeout: float
+    _outcomes: deque[tuple[bool, bool]]    # (успешно, медленно) для последних запросов
+    _min_calls: int
+    _error_rate: float
+    _slow_call_seconds: float
+    _slow_call_rate: float
+    _open_seconds: float
+    _state: CircuitState
+    _opened_at: float
+    _probe_in_flight: bool
+    _logger: logging.Logger
+
+    def __init__(self, name: str, max_concurrency: int = 20, timeout: float = 15, window: int = 20, min_calls: int = 5,
+                 error_rate: float = 0.5, slow_call_seconds: float = 10, slow_call_rate: float = 0.8, open_seconds: float = 30):
+        """
+        :param max_concurrency: максимальное количество одновременных запросов; сверх него запросы сразу отклоняются
+        :param timeout: максимальное время запроса
+        :param window: по скольким последним запросам считается доля ошибок и медленных ответов
+        :param min_calls: минимальное количество запросов в окне, после которого цепь может разомкнуться
+        :param error_rate: доля ошибок, при которой цепь размыкается
+        :param slow_call_seconds: время, после которого ответ считается медленным
+        :param slow_call_rate: доля медленных ответов, при которой цепь размыкается
+        :param open_seconds: через сколько секунд после размыкания выполняется пробный запрос
+        """
+        self.name = name
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._timeout = timeout
+        self._outcomes = deque(maxlen=window)
+        self._min_calls = min_calls
+        self._error_rate = error_rate
+        self._slow_call_seconds = slow_call_seconds
+        self._slow_call_rate = slow_call_rate
+        self._open_seconds = open_seconds
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0
+        self._probe_in_flight = False
+        self._logger = logging.getLogger("payment_api_logger")
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self._open_seconds:
+            return CircuitState.HALF_OPEN
+        return self._state
+
+    def is_available(self) -> bool:
+        return self.state != CircuitState.OPEN
+
+    async def call_async(self, func: Callable[[], Awaitable[T]]) -> T:
+        state = self.state
+        if state == CircuitState.OPEN:
+            raise ProviderRejectedError(self.name, "circuit is open")
+        if state == CircuitState.HALF_OPEN:
+            if self._probe_in_flight:
+                raise ProviderRejectedError(self.name, "circuit is half-open")
+            self._probe_in_flight = True
+        if self._semaphore.locked():
+            if state == CircuitState.HALF_OPEN:
+                self._probe_in_flight = False
+            raise ProviderRejectedError(self.name, "too many concurrent requests")
+
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(func(), self._timeout)
+            except asyncio.CancelledError:
+                if state == CircuitState.HALF_OPEN:
+                    self._probe_in_flight = False
+                raise
+            except Exception:
+                self._record(False, time.monotonic() - started, state)
+                raise
+            self._record(True, time.monotonic() - started, state)
+            return result
+
+    def _record(self, success: bool, elapsed: float, state: CircuitState):
+        slow = elapsed >= self._slow_call_seconds
+        if state == CircuitState.HALF_OPEN:
+            self._probe_in_flight = False
+            if success and not slow:
+                self._close()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append((success, slow))
+        if self._state != CircuitState.CLOSED or len(self._outcomes) < self._min_calls:
+            return
+
+        errors = sum(1 for s, _ in self._outcomes if not s)
+        slow_calls = sum(1 for _, sl in self._outcomes if sl)
+        if errors / len(self._outcomes) >= self._error_rate or slow_calls / len(self._outcomes) >= self._slow_call_rate:
+            self._open()
+
+    def _open(self):
+        if self._state != CircuitState.OPEN:
+            self._logger.warning("Circuit for '%s' opened", self.name, extra={"provider": self.name})
+        self._state = CircuitState.OPEN
+        self._opened_at = time.monotonic()
+        metrics.PROVIDER_CIRCUIT_OPEN.labels(self.name).set(1)
+
+    def _close(self):
+        self._logger.info("Circuit for '%s' closed", self.name, extra={"provider": self.name})
+        self._state = CircuitState.CLOSED
+        self._outcomes.clear()
+        metrics.PROVIDER_CIRCUIT_OPEN.labels(self.name).set(0)
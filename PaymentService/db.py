@@ -3,18 +3,27 @@
 """
 import asyncio
 import datetime
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
 import aiomysql
+import pymysql
+from pymysql.constants import ER
 from aiomysql import Pool
+from redis.asyncio import Redis
 import asyncio
 import secrets
 from typing import Tuple
 import traceback
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Optional, Iterable
 
 import config
+import metrics
 
 
 class InvoiceStatus(Enum):
@@ -55,42 +64,398 @@ class PaymentMethod:
     delegate_url: str = ""
 
 
+class StatsGranularity(Enum):
+    HOUR = "hour"
+    DAY = "day"
+
+
+@dataclass
+class StatsBucket:
+    """
+    Статистика по способу оплаты за один час или день.
+    """
+    granularity: StatsGranularity
+    bucket: datetime.datetime    # начало периода
+    payment_method: str    # пустая строка - способ оплаты еще не выбран
+    created: int
+    processing: int
+    paid: int
+    failed: int
+    timed_out: int
+    amount_sum: float    # сумма оплаченных счетов
+    credited_sum: float    # сумма, зачисленная по оплаченным счетам
+
+
+@dataclass
+class InvoiceTransition:
+    """
+    Результат попытки перевода счета в другой статус.
+    """
+    applied: bool    # False, если счет не найден или его статус не позволял переход
+    invoice: InvoiceInfo | None    # состояние счета после попытки перехода; None, если счет не найден
+
+
+@dataclass
+class PoolStats:
+    """
+    Состояние пула соединений и статистика ожидания свободного соединения.
+    """
+    size: int    # текущее количество открытых соединений
+    free: int    # количество свободных соединений
+    minsize: int
+    maxsize: int
+    acquired: int    # сколько раз соединение было получено из пула
+    wait_seconds_total: float    # суммарное время ожидания соединения
+    wait_seconds_max: float    # максимальное время ожидания соединения
+    pinged: int    # количество проверок простаивавших соединений
+
+
+@dataclass
+class CacheStats:
+    """
+    Статистика кэша счетов в Redis.
+    """
+    hits: int
+    misses: int
+    errors: int    # ошибки Redis; в этом случае счет читается из БД
+
+
+class ExportLimitExceededError(Exception):
+    def __init__(self, max_concurrent: int):
+        super().__init__(f"Too many invoice exports in progress (max {max_concurrent})")
+        self.max_concurrent = max_concurrent
+
+
+class InvoiceStream:
+    """
+    Счета выгрузки порциями (см. DatabaseManager.stream_invoices_async).
+    Занимает отдельное соединение с БД и место в лимите одновременных выгрузок, пока не будут прочитаны все счета
+    или не вызван close_async. close_async нужно вызвать, даже если итерация не начиналась: генератор, который
+    не был запущен, при удалении свой finally не выполняет.
+    """
+    _conn: aiomysql.Connection | None
+    _cur: aiomysql.SSCursor
+    _batch_size: int
+    _semaphore: asyncio.Semaphore
+
+    def __init__(self, conn: aiomysql.Connection, cur: aiomysql.SSCursor, batch_size: int, semaphore: asyncio.Semaphore):
+        self._conn = conn
+        self._cur = cur
+        self._batch_size = batch_size
+        self._semaphore = semaphore
+
+    def __aiter__(self) -> AsyncIterator[list[InvoiceInfo]]:
+        return self._read_batches_async()
+
+    async def _read_batches_async(self) -> AsyncIterator[list[InvoiceInfo]]:
+        try:
+            while self._conn is not None and (rows := await self._cur.fetchmany(self._batch_size)):
+                yield [DatabaseManager._row_to_invoice(row) for row in rows]
+        finally:
+            await self.close_async()
+
+    async def close_async(self):
+        """
+        Закрывает соединение выгрузки. Повторные вызовы ничего не делают.
+        """
+        if self._conn is None:
+            return
+        # курсор не закрывается, а соединение закрывается без ensure_closed: иначе при прерванной выгрузке
+        # все непрочитанные строки были бы дочитаны с сервера
+        self._conn.close()
+        self._conn = None
+        self._semaphore.release()
+
+
 class DatabaseManager:
     _host: str
+    _port: int
     _user: str
     _password: str
     _db_name: str
+    _minsize: int
+    _maxsize: int
+    _pool_recycle: int
+    _ping_after: float
+    _pool: Pool | None
+    _group_commit_window: float
+    _group_commit_max_batch: int
+    _pending_inserts: list[tuple[InvoiceInfo, asyncio.Future]]
+    _flush_handle: asyncio.TimerHandle | None
+    _flush_tasks: set[asyncio.Task]
+    _stats_flush_interval: float
+    _pending_stats: dict[tuple[str, datetime.datetime, str], list[float]]
+    _stats_flush_handle: asyncio.TimerHandle | None
+    _cache: Redis | None
+    _cache_ttl: int
+    _cache_hits: int
+    _cache_misses: int
+    _cache_errors: int
+    _export_max_concurrent: int
+    _export_semaphore: asyncio.Semaphore
+    _logger: logging.Logger
+
+    _acquired: int
+    _wait_seconds_total: float
+    _wait_seconds_max: float
+    _pinged: int
+
+    CACHE_PREFIX = "payment_service:invoice:"
+    # изменения счетов записывают в кэш новую версию счета, а чтение из БД кладет счет в кэш только при отсутствии записи,
+    # поэтому запрос, прочитавший счет до изменения, не заменит новую версию старой. Если новая версия неизвестна
+    # (expire_invoices_async), на время _CACHE_TOMBSTONE_SECONDS записывается заглушка, которую чтение из БД тоже не заменяет
+    _CACHE_TOMBSTONE = b"-"
+    _CACHE_TOMBSTONE_SECONDS = 10
 
-    _GET_INVOICES_QUERY = "SELECT * FROM invoices WHERE invoice_id = %s;"
+    # счет ищется сначала в оперативной таблице, затем в архиве. Оба поиска по первичному ключу, за одно обращение к серверу
+    _GET_INVOICE_WITH_ARCHIVE_QUERY = "SELECT * FROM invoices WHERE invoice_id = %s " \
+                                      "UNION ALL SELECT * FROM invoices_archive WHERE invoice_id = %s LIMIT 1;"
     _SAVE_INVOICE_QUERY = "INSERT INTO invoices VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " \
                           "ON DUPLICATE KEY UPDATE invoice_id = %s, status = %s, amount = %s, credited = %s, created = %s, payed = %s, comment = %s, custom_fields = %s, webhook_url = %s, payment_method = %s, payment_url = %s, payment_method_invoice_id = %s;"
+    _INSERT_INVOICES_QUERY = "INSERT INTO invoices VALUES "
+    _INVOICE_ROW_PLACEHOLDERS = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
     _GET_PAYMENT_METHODS_QUERY = "SELECT * FROM payment_methods;"
     _GET_PAYMENT_METHOD_QUERY = "SELECT * FROM payment_methods WHERE method_id = %s;"
 
-    def __init__(self, host: str, user: str, password: str, db_name: str):
+    _INCREMENT_STATS_QUERY = "INSERT INTO payment_stats VALUES {} " \
+                             "ON DUPLICATE KEY UPDATE created = created + VALUES(created), processing = processing + VALUES(processing), " \
+                             "paid = paid + VALUES(paid), failed = failed + VALUES(failed), timed_out = timed_out + VALUES(timed_out), " \
+                             "amount_sum = amount_sum + VALUES(amount_sum), credited_sum = credited_sum + VALUES(credited_sum);"
+    _STATS_ROW_PLACEHOLDERS = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    _GET_STATS_QUERY = "SELECT * FROM payment_stats WHERE granularity = %s AND bucket >= %s AND bucket < %s"
+
+    _GET_INVOICE_BY_PROVIDER_ID_QUERY = "SELECT * FROM invoices WHERE payment_method_invoice_id = %s AND payment_method = %s " \
+                                        "UNION ALL SELECT * FROM invoices_archive WHERE payment_method_invoice_id = %s AND payment_method = %s LIMIT 1;"
+
+    # изменения схемы существующих таблиц. Каждая миграция применяется один раз, ее номер сохраняется в schema_migrations.
+    # Новые миграции добавляются только в конец
+    _MIGRATIONS = (
+        (1, "CREATE INDEX ix_invoices_created ON invoices (created);"),
+        (2, "CREATE INDEX ix_invoices_status_created ON invoices (status, created);"),
+        (3, "CREATE INDEX ix_invoices_method_created ON invoices (payment_method, created);"),
+        (4, "CREATE INDEX ix_invoices_provider_invoice_id ON invoices (payment_method_invoice_id);"),
+        # закрытые старые счета переносятся в архив (см. archive_invoices_async). LIKE копирует и индексы,
+        # поэтому новые индексы invoices, нужные для поиска в архиве, добавляются в обе таблицы
+        (5, "CREATE TABLE IF NOT EXISTS invoices_archive LIKE invoices;"),
+    )
+
+    _INVOICE_COLUMNS = ("invoice_id", "status", "amount", "credited", "created", "payed", "comment", "custom_fields",
+                        "webhook_url", "payment_method", "payment_url", "payment_method_invoice_id")
+    # колонка, значение которой получает колонка из ключа, если при переходе для нее передан None.
+    # Для остальных колонок None означает "оставить как есть"
+    _TRANSITION_FALLBACKS = {"credited": "amount"}
+
+    def __init__(self, host: str, user: str, password: str, db_name: str,
+                 minsize: int = 1, maxsize: int = 10, pool_recycle: int = 3600, ping_after: float = 30,
+                 group_commit_window: float = 0, group_commit_max_batch: int = 100, port: int = 3306,
+                 cache: Redis | None = None, cache_ttl: int = 300, stats_flush_interval: float = 1,
+                 export_max_concurrent: int = 2):
+        """
+        :param minsize: минимальное количество соединений, которые пул держит открытыми
+        :param maxsize: максимальное количество одновременно открытых соединений
+        :param pool_recycle: через сколько секунд простоя соединение закрывается и открывается заново
+        :param ping_after: через сколько секунд простоя соединение проверяется через COM_PING перед использованием
+        :param group_commit_window: сколько секунд insert_invoice_async ждет другие новые счета, чтобы сохранить их одним INSERT.
+                                    0 - каждый счет сохраняется сразу
+        :param group_commit_max_batch: максимальное количество счетов в одном INSERT; при его достижении счета сохраняются, не дожидаясь окна
+        :param cache: Redis для кэширования счетов. None - счета всегда читаются из БД
+        :param cache_ttl: сколько секунд счет хранится в кэше. Все изменения счетов через DatabaseManager обновляют кэш,
+                          а изменения в обход него становятся видны не позже, чем через это время
+        :param stats_flush_interval: раз в сколько секунд статистика, накопленная add_stats, сохраняется в БД
+        :param export_max_concurrent: максимальное количество одновременных выгрузок (stream_invoices_async).
+                                      Каждая выгрузка занимает отдельное соединение с сервером
+        """
         self._host = host
+        self._port = port
         self._user = user
         self._password = password
         self._db_name = db_name
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._pool_recycle = pool_recycle
+        self._ping_after = ping_after
+        self._pool = None
+        self._group_commit_window = group_commit_window
+        self._group_commit_max_batch = group_commit_max_batch
+        self._pending_inserts = []
+        self._flush_handle = None
+        self._flush_tasks = set()
+        self._stats_flush_interval = stats_flush_interval
+        self._pending_stats = {}
+        self._stats_flush_handle = None
+        self._cache = cache
+        self._cache_ttl = cache_ttl
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_errors = 0
+        self._export_max_concurrent = export_max_concurrent
+        self._export_semaphore = asyncio.Semaphore(export_max_concurrent)
+        self._logger = logging.getLogger("payment_api_logger")
+
+        self._acquired = 0
+        self._wait_seconds_total = 0
+        self._wait_seconds_max = 0
+        self._pinged = 0
+
+    async def open_async(self):
+        """
+        Создает пул соединений. Должен быть вызван до первого запроса к БД.
+        """
+        self._pool = await aiomysql.create_pool(host=self._host, port=self._port, user=self._user, password=self._password, db=self._db_name,
+                                                minsize=self._minsize, maxsize=self._maxsize, pool_recycle=self._pool_recycle,
+                                                # все запросы состоят из одного оператора, поэтому отдельный COMMIT не нужен
+                                                autocommit=True)
+
+    async def close_async(self):
+        """
+        Сохраняет накопленные счета и закрывает пул, дожидаясь возврата всех выданных соединений.
+        """
+        if self._pool is None:
+            return
+        self._flush_pending_inserts()
+        self._flush_pending_stats()
+        await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        self._pool.close()
+        await self._pool.wait_closed()
+        self._pool = None
+
+    def get_pool_stats(self) -> PoolStats:
+        size = self._pool.size if self._pool else 0
+        free = self._pool.freesize if self._pool else 0
+        return PoolStats(size, free, self._minsize, self._maxsize, self._acquired,
+                         self._wait_seconds_total, self._wait_seconds_max, self._pinged)
+
+    def get_cache_stats(self) -> CacheStats:
+        return CacheStats(self._cache_hits, self._cache_misses, self._cache_errors)
+
+    @asynccontextmanager
+    async def _get_connection(self, query: str):
+        """
+        Выдает соединение из пула.
+        :param query: название запроса для метрик; время выполнения считается от получения соединения до его возврата
+        """
+        if self._pool is None:
+            raise RuntimeError("Connection pool is not opened. Call open_async first.")
+
+        started = time.perf_counter()
+        conn = await self._pool.acquire()
+        wait = time.perf_counter() - started
+        self._acquired += 1
+        self._wait_seconds_total += wait
+        self._wait_seconds_max = max(self._wait_seconds_max, wait)
+        metrics.DB_POOL_WAIT_SECONDS.observe(wait)
 
-    def _get_connection(self):
-        return aiomysql.connect(host=self._host, user=self._user, password=self._password, db=self._db_name)
+        try:
+            # соединение могло быть закрыто сервером (wait_timeout, перезапуск MySQL), пока лежало в пуле.
+            # ping с reconnect=True в таком случае прозрачно переподключается
+            if asyncio.get_running_loop().time() - conn.last_usage > self._ping_after:
+                self._pinged += 1
+                await conn.ping(reconnect=True)
+            with metrics.observe(metrics.DB_QUERY_SECONDS, query):
+                yield conn
+        except (aiomysql.Error, OSError, asyncio.CancelledError):
+            # после ошибки соединение может остаться в неопределенном состоянии, поэтому в пул оно не возвращается
+            conn.close()
+            raise
+        finally:
+            self._pool.release(conn)
 
     async def get_invoice_info_async(self, invoice_id: str) -> InvoiceInfo | None:
-        async with self._get_connection() as conn:
+        """
+        Возвращает счет из кэша, оперативной таблицы или архива.
+        """
+        cached = await self._get_cached_invoice_async(invoice_id)
+        if cached is not None:
+            return cached
+
+        async with self._get_connection("get_invoice") as conn:
             async with conn.cursor() as cur:
-                await cur.execute(self._GET_INVOICES_QUERY, invoice_id)
+                await cur.execute(self._GET_INVOICE_WITH_ARCHIVE_QUERY, (invoice_id, invoice_id))
                 rows = await cur.fetchall()
 
         if not any(rows):
             return None
 
-        inv = InvoiceInfo(*rows[0])
+        invoice = self._row_to_invoice(rows[0])
+        await self._cache_invoices_async([invoice], only_missing=True)
+        return invoice
+
+    async def _get_cached_invoice_async(self, invoice_id: str) -> InvoiceInfo | None:
+        if self._cache is None:
+            return None
+
+        try:
+            cached = await self._cache.get(self.CACHE_PREFIX + invoice_id)
+        except Exception as ex:
+            # без кэша счет просто читается из БД
+            self._cache_errors += 1
+            metrics.DB_CACHE_REQUESTS.labels("error").inc()
+            self._logger.warning("Failed to get invoice from cache: %s", ex, extra={"invoice_id": invoice_id})
+            return None
+
+        if cached is None or cached == self._CACHE_TOMBSTONE:
+            self._cache_misses += 1
+            metrics.DB_CACHE_REQUESTS.labels("miss").inc()
+            return None
+
+        self._cache_hits += 1
+        metrics.DB_CACHE_REQUESTS.labels("hit").inc()
+        return self._deserialize_invoice(cached)
+
+    async def _cache_invoices_async(self, invoices: list[InvoiceInfo], only_missing: bool = False):
+        """
+        :param only_missing: не заменять запись в кэше, в том числе заглушку измененного счета. Для счетов, прочитанных из БД
+        """
+        if self._cache is None:
+            return
+
+        try:
+            async with self._cache.pipeline(transaction=False) as pipe:
+                for invoice in invoices:
+                    pipe.set(self.CACHE_PREFIX + invoice.invoice_id, self._serialize_invoice(invoice), ex=self._cache_ttl,
+                             nx=only_missing)
+                await pipe.execute()
+        except Exception as ex:
+            self._cache_errors += 1
+            self._logger.warning("Failed to cache invoices: %s", ex)
+
+    async def _invalidate_cached_invoices_async(self, invoice_ids: list[str]):
+        if self._cache is None or not invoice_ids:
+            return
+
+        try:
+            async with self._cache.pipeline(transaction=False) as pipe:
+                for invoice_id in invoice_ids:
+                    pipe.set(self.CACHE_PREFIX + invoice_id, self._CACHE_TOMBSTONE, ex=self._CACHE_TOMBSTONE_SECONDS)
+                await pipe.execute()
+        except Exception as ex:
+            # устаревшая запись исчезнет не позже, чем через cache_ttl. Переходы статусов проверяются в БД и от нее не зависят
+            self._cache_errors += 1
+            self._logger.warning("Failed to invalidate cached invoices: %s", ex, extra={"invoice_ids": invoice_ids})
+
+    @staticmethod
+    def _serialize_invoice(invoice: InvoiceInfo) -> str:
+        # поля в порядке колонок таблицы, без имен - так запись в Redis занимает меньше места
+        return json.dumps([invoice.invoice_id, invoice.status.value, invoice.amount, invoice.credited,
+                           invoice.created.isoformat(), invoice.payed.isoformat() if invoice.payed else None,
+                           invoice.comment, invoice.custom_fields, invoice.webhook_url, invoice.payment_method,
+                           invoice.payment_url, invoice.payment_method_invoice_id], separators=(",", ":"))
+
+    @classmethod
+    def _deserialize_invoice(cls, data: bytes | str) -> InvoiceInfo:
+        row = json.loads(data)
+        row[4] = datetime.datetime.fromisoformat(row[4])
+        row[5] = datetime.datetime.fromisoformat(row[5]) if row[5] else None
+        return cls._row_to_invoice(row)
+
+    @staticmethod
+    def _row_to_invoice(row: tuple) -> InvoiceInfo:
+        inv = InvoiceInfo(*row)
         inv.status = InvoiceStatus(inv.status)
         return inv
 
     async def save_invoice_info_async(self, invoice_info: InvoiceInfo):
-        async with self._get_connection() as conn:
+        async with self._get_connection("save_invoice") as conn:
             async with conn.cursor() as cur:
                 await cur.execute(self._SAVE_INVOICE_QUERY,
                                   (invoice_info.invoice_id, invoice_info.status.value, invoice_info.amount,
@@ -101,10 +466,348 @@ class DatabaseManager:
                                    invoice_info.credited, invoice_info.created, invoice_info.payed,
                                    invoice_info.comment, invoice_info.custom_fields,
                                    invoice_info.webhook_url, invoice_info.payment_method, invoice_info.payment_url, invoice_info.payment_method_invoice_id))
+        await self._cache_invoices_async([invoice_info])
+
+    async def insert_invoices_async(self, invoices: list[InvoiceInfo]):
+        """
+        Сохраняет новые счета одним многострочным INSERT.
+        """
+        if not invoices:
+            return
+
+        query = self._INSERT_INVOICES_QUERY + ", ".join([self._INVOICE_ROW_PLACEHOLDERS] * len(invoices)) + ";"
+        params = []
+        for invoice_info in invoices:
+            params.extend((invoice_info.invoice_id, invoice_info.status.value, invoice_info.amount,
+                           invoice_info.credited, invoice_info.created, invoice_info.payed,
+                           invoice_info.comment, invoice_info.custom_fields,
+                           invoice_info.webhook_url, invoice_info.payment_method, invoice_info.payment_url, invoice_info.payment_method_invoice_id))
+
+        async with self._get_connection("insert_invoices") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+        await self._cache_invoices_async(invoices)
+
+    async def insert_invoice_async(self, invoice_info: InvoiceInfo):
+        """
+        Сохраняет новый счет. Если включен group commit, счета, созданные в течение group_commit_window,
+        сохраняются одним INSERT. Метод завершается только после того, как счет сохранен.
+        """
+        if self._group_commit_window <= 0:
+            await self.insert_invoices_async([invoice_info])
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_inserts.append((invoice_info, future))
+        if len(self._pending_inserts) >= self._group_commit_max_batch:
+            self._flush_pending_inserts()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self._group_commit_window, self._flush_pending_inserts)
+        await future
+
+    def _flush_pending_inserts(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_inserts:
+            return
+
+        batch, self._pending_inserts = self._pending_inserts, []
+        task = asyncio.create_task(self._insert_batch_async(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _insert_batch_async(self, batch: list[tuple[InvoiceInfo, asyncio.Future]]):
+        try:
+            await self.insert_invoices_async([invoice_info for invoice_info, _ in batch])
+        except (pymysql.err.DataError, pymysql.err.IntegrityError) as ex:
+            if len(batch) == 1:
+                self._set_insert_result(batch[0][1], ex)
+                return
+            # ошибка в одной строке отменяет весь INSERT: счета сохраняются по одному,
+            # чтобы ошибку получил только тот, чей счет ее вызвал
+            self._logger.warning("Group insert of %s invoices failed, inserting one by one: %s", len(batch), ex)
+            for invoice_info, future in batch:
+                try:
+                    await self.insert_invoices_async([invoice_info])
+                except Exception as row_ex:
+                    self._set_insert_result(future, row_ex)
+                else:
+                    self._set_insert_result(future)
+        except Exception as ex:
+            # остальные ошибки (соединение, таймаут) не зависят от строк и относятся ко всем счетам
+            for _, future in batch:
+                self._set_insert_result(future, ex)
+        else:
+            for _, future in batch:
+                self._set_insert_result(future)
+
+    @staticmethod
+    def _set_insert_result(future: asyncio.Future, ex: Exception | None = None):
+        # запрос, ожидающий сохранения, мог быть отменен
+        if future.done():
+            return
+        if ex is None:
+            future.set_result(None)
+        else:
+            future.set_exception(ex)
+
+    async def transition_invoice_async(self, invoice_id: str, from_statuses: Iterable[InvoiceStatus], to_status: InvoiceStatus,
+                                       **changes) -> InvoiceTransition:
+        """
+        Переводит счет в статус to_status, если его текущий статус входит в from_statuses.
+        Проверка и изменение выполняются одним UPDATE, поэтому одновременные переходы одного счета не мешают друг другу.
+        Счета в архиве не изменяются: для них возвращается applied = False и счет из архива.
+        :param changes: колонки, которые нужно изменить вместе со статусом. None оставляет текущее значение (см. _TRANSITION_FALLBACKS)
+        """
+        from_statuses = list(from_statuses)
+        assignments = ["status = %s"]
+        params = [to_status.value]
+        for column, value in changes.items():
+            if column not in self._INVOICE_COLUMNS:
+                raise ValueError(f"Unknown invoice column: {column}")
+            assignments.append(f"{column} = COALESCE(%s, {self._TRANSITION_FALLBACKS.get(column, column)})")
+            params.append(value)
+
+        statuses_placeholders = ", ".join(["%s"] * len(from_statuses))
+        query = f"UPDATE invoices SET {', '.join(assignments)} WHERE invoice_id = %s AND status IN ({statuses_placeholders});"
+        params += [invoice_id, *(s.value for s in from_statuses)]
+
+        async with self._get_connection("transition_invoice") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                applied = cur.rowcount > 0
+                await cur.execute(self._GET_INVOICE_WITH_ARCHIVE_QUERY, (invoice_id, invoice_id))
+                rows = await cur.fetchall()
+
+        invoice = self._row_to_invoice(rows[0]) if any(rows) else None
+        if invoice is not None:
+            # счет прочитан после UPDATE, поэтому он не старше версии, которую мог положить в кэш любой другой запрос.
+            # Даже если переход не выполнен, запись в кэше могла устареть, поэтому она заменяется в обоих случаях
+            await self._cache_invoices_async([invoice])
+        return InvoiceTransition(applied, invoice)
+
+    async def get_invoice_by_provider_id_async(self, payment_method: str, payment_method_invoice_id: str) -> InvoiceInfo | None:
+        async with self._get_connection("get_invoice_by_provider_id") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self._GET_INVOICE_BY_PROVIDER_ID_QUERY,
+                                  (payment_method_invoice_id, payment_method, payment_method_invoice_id, payment_method))
+                rows = await cur.fetchall()
+
+        if not any(rows):
+            return None
+
+        return self._row_to_invoice(rows[0])
+
+    async def list_invoices_async(self, limit: int, status: InvoiceStatus | None = None, payment_method: str | None = None,
+                                  created_from: datetime.datetime | None = None, created_to: datetime.datetime | None = None,
+                                  after: tuple[datetime.datetime, str] | None = None) -> list[InvoiceInfo]:
+        """
+        Возвращает счета оперативной таблицы (без архива) от новых к старым.
+        :param after: (created, invoice_id) последнего счета предыдущей страницы. Следующая страница начинается сразу после него
+        """
+        conditions = []
+        params = []
+        if status is not None:
+            conditions.append("status = %s")
+            params.append(status.value)
+        if payment_method is not None:
+            conditions.append("payment_method = %s")
+            params.append(payment_method)
+        if created_from is not None:
+            conditions.append("created >= %s")
+            params.append(created_from)
+        if created_to is not None:
+            conditions.append("created < %s")
+            params.append(created_to)
+        if after is not None:
+            # продолжение с места остановки по индексу вместо OFFSET, который перебирает все пропущенные строки
+            conditions.append("(created < %s OR (created = %s AND invoice_id < %s))")
+            params += [after[0], after[0], after[1]]
+
+        query = "SELECT * FROM invoices"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created DESC, invoice_id DESC LIMIT %s;"
+        params.append(limit)
+
+        async with self._get_connection("list_invoices") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+
+        return [self._row_to_invoice(r) for r in rows]
+
+    async def stream_invoices_async(self, created_from: datetime.datetime, created_to: datetime.datetime,
+                                    status: InvoiceStatus | None = None, payment_method: str | None = None,
+                                    batch_size: int = 1000) -> InvoiceStream:
+        """
+        Выполняет запрос счетов оперативной таблицы и архива, созданных в [created_from, created_to),
+        и возвращает итератор по ним порциями по batch_size. Ошибки подключения и запроса возникают здесь, до первой порции.
+        Строки читаются с сервера по мере обработки (SSCursor), поэтому память не зависит от количества счетов.
+        Порядок счетов не гарантируется: сортировка потребовала бы от сервера собрать весь результат.
+        Для чтения открывается отдельное соединение, чтобы долгая выгрузка не занимала соединение пула.
+        :raises ExportLimitExceededError: если уже выполняется export_max_concurrent выгрузок
+        """
+        conditions = ["created >= %s", "created < %s"]
+        params = [created_from, created_to]
+        if status is not None:
+            conditions.append("status = %s")
+            params.append(status.value)
+        if payment_method is not None:
+            conditions.append("payment_method = %s")
+            params.append(payment_method)
+        where = " AND ".join(conditions)
+        query = f"SELECT * FROM invoices WHERE {where} UNION ALL SELECT * FROM invoices_archive WHERE {where};"
+
+        # выгрузка не ждет освобождения места: клиенту лучше повторить запрос позже, чем держать соединение в очереди
+        if self._export_semaphore.locked():
+            raise ExportLimitExceededError(self._export_max_concurrent)
+        await self._export_semaphore.acquire()
+
+        conn = None
+        try:
+            # сервер ждет, пока клиент прочитает строки, не дольше net_write_timeout, а клиент выгрузки может читать медленно
+            conn = await aiomysql.connect(host=self._host, port=self._port, user=self._user, password=self._password, db=self._db_name,
+                                          cursorclass=aiomysql.SSCursor, autocommit=True,
+                                          init_command="SET SESSION net_write_timeout = 3600;")
+            cur = await conn.cursor()
+            await cur.execute(query, params * 2)
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            self._export_semaphore.release()
+            raise
+        return InvoiceStream(conn, cur, batch_size, self._export_semaphore)
+
+    async def expire_invoices_async(self, payment_method: str | None, created_before: datetime.datetime, limit: int) -> list[str]:
+        """
+        Переводит в TIMEOUT не более limit самых старых открытых счетов способа оплаты, созданных до created_before.
+        :param payment_method: None - счета, для которых способ оплаты еще не выбран
+        :return: ID измененных счетов
+        """
+        method_condition = "payment_method IS NULL" if payment_method is None else "payment_method = %s"
+        params = [payment_method] if payment_method is not None else []
+        params += [InvoiceStatus.CREATED.value, InvoiceStatus.PROCESSING.value, created_before, limit]
+
+        async with self._get_connection("expire_invoices") as conn:
+            async with conn.cursor() as cur:
+                # FOR UPDATE блокирует выбранные счета до конца транзакции, поэтому изменяются ровно они
+                # при ошибке _get_connection закрывает соединение, и сервер откатывает незавершенную транзакцию
+                await conn.begin()
+                await cur.execute(f"SELECT invoice_id FROM invoices WHERE {method_condition} AND status IN (%s, %s) AND created < %s "
+                                  f"ORDER BY created LIMIT %s FOR UPDATE;", params)
+                invoice_ids = [row[0] for row in await cur.fetchall()]
+                if invoice_ids:
+                    await cur.execute(f"UPDATE invoices SET status = %s WHERE invoice_id IN ({', '.join(['%s'] * len(invoice_ids))});",
+                                      (InvoiceStatus.TIMEOUT.value, *invoice_ids))
                 await conn.commit()
 
+        await self._invalidate_cached_invoices_async(invoice_ids)
+        return invoice_ids
+
+    async def archive_invoices_async(self, statuses: Iterable[InvoiceStatus], created_before: datetime.datetime, limit: int) -> int:
+        """
+        Переносит в invoices_archive не более limit самых старых счетов с одним из статусов statuses, созданных до created_before.
+        :return: количество перенесенных счетов
+        """
+        statuses = [s.value for s in statuses]
+        statuses_placeholders = ", ".join(["%s"] * len(statuses))
+        async with self._get_connection("archive_invoices") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f"SELECT invoice_id FROM invoices WHERE status IN ({statuses_placeholders}) AND created < %s "
+                                  f"ORDER BY created LIMIT %s;", (*statuses, created_before, limit))
+                invoice_ids = [row[0] for row in await cur.fetchall()]
+                if not invoice_ids:
+                    return 0
+
+                # INSERT ... SELECT блокирует копируемые строки до конца транзакции, поэтому счет не может измениться
+                # между копированием и удалением. Статус проверяется повторно: счет мог измениться после выборки ID
+                condition = f"invoice_id IN ({', '.join(['%s'] * len(invoice_ids))}) AND status IN ({statuses_placeholders})"
+                params = (*invoice_ids, *statuses)
+                # при ошибке _get_connection закрывает соединение, и сервер откатывает незавершенную транзакцию
+                await conn.begin()
+                await cur.execute(f"REPLACE INTO invoices_archive SELECT * FROM invoices WHERE {condition};", params)
+                await cur.execute(f"DELETE FROM invoices WHERE {condition};", params)
+                archived = cur.rowcount
+                await conn.commit()
+                return archived
+
+    async def increment_stats_async(self, moment: datetime.datetime, payment_method: str | None, created: int = 0,
+                                    processing: int = 0, paid: int = 0, failed: int = 0, timed_out: int = 0,
+                                    amount: float = 0, credited: float = 0):
+        """
+        Прибавляет значения к часовой и дневной статистике способа оплаты за период, в который входит moment.
+        """
+        rows = self._make_stats_rows(moment, payment_method, (created, processing, paid, failed, timed_out, amount, credited))
+        await self._write_stats_async(rows)
+
+    def add_stats(self, moment: datetime.datetime, payment_method: str | None, created: int = 0,
+                  processing: int = 0, paid: int = 0, failed: int = 0, timed_out: int = 0,
+                  amount: float = 0, credited: float = 0):
+        """
+        То же, что increment_stats_async, но без обращения к БД: значения суммируются в памяти и сохраняются
+        одним запросом раз в stats_flush_interval. Если экземпляр сервиса упадет, несохраненные значения будут потеряны
+        """
+        counters = (created, processing, paid, failed, timed_out, amount, credited)
+        for row in self._make_stats_rows(moment, payment_method, counters):
+            pending = self._pending_stats.setdefault(row[:3], [0] * len(counters))
+            for i, value in enumerate(row[3:]):
+                pending[i] += value
+        if self._stats_flush_handle is None:
+            self._stats_flush_handle = asyncio.get_running_loop().call_later(self._stats_flush_interval, self._flush_pending_stats)
+
+    def _flush_pending_stats(self):
+        if self._stats_flush_handle is not None:
+            self._stats_flush_handle.cancel()
+            self._stats_flush_handle = None
+        if not self._pending_stats:
+            return
+
+        rows = [(*key, *values) for key, values in self._pending_stats.items()]
+        self._pending_stats = {}
+        task = asyncio.create_task(self._flush_stats_async(rows))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_stats_async(self, rows: list[tuple]):
+        try:
+            await self._write_stats_async(rows)
+        except Exception as ex:
+            # статистика не должна мешать обработке платежей, поэтому ошибки только логируются
+            self._logger.exception("Failed to update payment statistics: %s rows lost", len(rows), exc_info=ex)
+
+    @staticmethod
+    def _make_stats_rows(moment: datetime.datetime, payment_method: str | None, counters: tuple) -> list[tuple]:
+        hour = moment.replace(minute=0, second=0, microsecond=0)
+        day = hour.replace(hour=0)
+        return [(StatsGranularity.HOUR.value, hour, payment_method or "", *counters),
+                (StatsGranularity.DAY.value, day, payment_method or "", *counters)]
+
+    async def _write_stats_async(self, rows: list[tuple]):
+        query = self._INCREMENT_STATS_QUERY.format(", ".join([self._STATS_ROW_PLACEHOLDERS] * len(rows)))
+        async with self._get_connection("increment_stats") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, [value for row in rows for value in row])
+
+    async def get_stats_async(self, granularity: StatsGranularity, since: datetime.datetime, until: datetime.datetime,
+                              payment_method: str | None = None) -> list[StatsBucket]:
+        query = self._GET_STATS_QUERY
+        params = [granularity.value, since, until]
+        if payment_method is not None:
+            query += " AND payment_method = %s"
+            params.append(payment_method)
+        query += " ORDER BY bucket, payment_method;"
+
+        async with self._get_connection("get_stats") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+
+        return [StatsBucket(StatsGranularity(r[0]), *r[1:]) for r in rows]
+
     async def get_payment_methods_async(self) -> list[PaymentMethod]:
-        async with self._get_connection() as conn:
+        async with self._get_connection("get_payment_methods") as conn:
             async with conn.cursor() as cur:
                 await cur.execute(self._GET_PAYMENT_METHODS_QUERY)
                 rows = await cur.fetchall()
@@ -114,7 +817,7 @@ class DatabaseManager:
         return [PaymentMethod(*r) for r in rows]
 
     async def get_payment_method_async(self, method_id: str) -> PaymentMethod | None:
-        async with self._get_connection() as conn:
+        async with self._get_connection("get_payment_method") as conn:
             async with conn.cursor() as cur:
                 await cur.execute(self._GET_PAYMENT_METHOD_QUERY, method_id)
                 rows = await cur.fetchall()
@@ -125,7 +828,7 @@ class DatabaseManager:
         return PaymentMethod(*rows[0])
 
     async def create_tables_async(self):
-        async with self._get_connection() as conn:
+        async with self._get_connection("create_tables") as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "CREATE TABLE IF NOT EXISTS invoices "
@@ -137,11 +840,48 @@ class DatabaseManager:
                     "CREATE TABLE IF NOT EXISTS payment_methods "
                     "(method_id VARCHAR(32) NOT NULL, name VARCHAR(64) NOT NULL, description VARCHAR(256) NOT NULL DEFAULT '', icon_url VARCHAR(256) NOT NULL, instructions TEXT, PRIMARY KEY (method_id));"
                 )
-                await conn.commit()
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS payment_stats "
+                    "(granularity VARCHAR(8) NOT NULL, bucket DATETIME NOT NULL, payment_method VARCHAR(32) NOT NULL DEFAULT '', "
+                    "created INT NOT NULL DEFAULT 0, processing INT NOT NULL DEFAULT 0, paid INT NOT NULL DEFAULT 0, "
+                    "failed INT NOT NULL DEFAULT 0, timed_out INT NOT NULL DEFAULT 0, "
+                    "amount_sum DOUBLE NOT NULL DEFAULT 0, credited_sum DOUBLE NOT NULL DEFAULT 0, "
+                    "PRIMARY KEY (granularity, bucket, payment_method));"
+                )
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS schema_migrations "
+                    "(version INT NOT NULL, applied DATETIME NOT NULL, PRIMARY KEY (version));"
+                )
+                await self._apply_migrations_async(cur)
+
+    async def _apply_migrations_async(self, cur: aiomysql.Cursor):
+        # несколько экземпляров сервиса могут запускаться одновременно
+        await cur.execute("SELECT GET_LOCK('payment_service_migrations', 60);")
+        locked = await cur.fetchone()
+        if locked is None or locked[0] != 1:
+            raise RuntimeError("Failed to acquire the schema migrations lock")
+        try:
+            await cur.execute("SELECT version FROM schema_migrations;")
+            applied = {r[0] for r in await cur.fetchall()}
+            for version, statement in self._MIGRATIONS:
+                if version in applied:
+                    continue
+                try:
+                    await cur.execute(statement)
+                except pymysql.err.OperationalError as ex:
+                    # DDL в MySQL не откатывается: если экземпляр упал между изменением схемы и записью в schema_migrations,
+                    # индекс уже создан, и миграция только отмечается примененной
+                    if ex.args[0] != ER.DUP_KEYNAME:
+                        raise
+                    self._logger.warning("Migration %s is already applied to the schema: %s", version, ex)
+                await cur.execute("INSERT INTO schema_migrations VALUES (%s, %s);", (version, datetime.datetime.now()))
+        finally:
+            await cur.execute("SELECT RELEASE_LOCK('payment_service_migrations');")
 
 
 async def debug():
     manager = DatabaseManager(config.MYSQL_HOST, config.MYSQL_USER, config.MYSQL_PASSWORD, config.MYSQL_DATABASE)
+    await manager.open_async()
 
     await manager.create_tables_async()
 
@@ -151,6 +891,8 @@ async def debug():
     #invoice = await manager.get_invoice_info_async("test_inv")
     #print(invoice)
 
+    await manager.close_async()
+
 
 if __name__ == "__main__":
     asyncio.run(debug(), debug=True)
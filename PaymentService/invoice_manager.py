@@ -1,18 +1,26 @@
-from db import DatabaseManager, InvoiceInfo, InvoiceStatus, PaymentMethod
+from db import DatabaseManager, InvoiceInfo, InvoiceStatus, PaymentMethod, InvoiceTransition
 import uuid
 import datetime
 import logging
 import config
-import hashlib
 
-from AaioAsync import AaioAsync
-from lava_api.business import LavaBusinessAPI, CreateInvoiceException, InvoiceInfo as LavaInvoiceInfo
-from apis import enot, nicepay, pally
+from fastapi import APIRouter
+
+from apis.sessions import ProviderSessions
+from methods_catalogue import PaymentMethodsCatalogue
+from invoice_notifier import InvoiceStatusNotifier
+import metrics
+from circuit_breaker import ProviderRejectedError
+from providers import ProviderRegistry, WebhookContext
+from providers.base import PaymentProvider
 
 
 class InvalidInvoiceStatusError(Exception):
-    def __init__(self, invoice_id: str, invoice_status: InvoiceStatus, *args, **kwargs):
+    def __init__(self, invoice_id: str, invoice_status: InvoiceStatus, *args, invoice: InvoiceInfo | None = None, **kwargs):
         super().__init__(f"The operation cannot be performed on the invoice '{invoice_id}' with status '{invoice_status}'.", *args)
+        self.invoice_id = invoice_id
+        self.invoice_status = invoice_status
+        self.invoice = invoice    # текущее состояние счета, если оно известно
 
 
 class InvalidInvoiceError(Exception):
@@ -30,19 +38,56 @@ class PaymentSystemError(Exception):
         super().__init__(f"An error occured in '{method_id}' payment method.", *args)
 
 
+class ProviderUnavailableError(PaymentSystemError):
+    def __init__(self, method_id: str, *args, **kwargs):
+        Exception.__init__(self, f"Payment method '{method_id}' is temporarily unavailable.", *args)
+
+
 class InvoiceManager:
 
+    # статусы, из которых счет может быть переведен в другой статус
+    _OPEN_STATUSES = (InvoiceStatus.CREATED, InvoiceStatus.PROCESSING, InvoiceStatus.TIMEOUT, InvoiceStatus.DELEGATED)
+
     _db_manager: DatabaseManager
+    _catalogue: PaymentMethodsCatalogue
+    _notifier: InvoiceStatusNotifier | None
     _logger: logging.Logger
-    _aaio: AaioAsync
-    _lava: LavaBusinessAPI
+    _sessions: ProviderSessions
+    _registry: ProviderRegistry
 
-    def __init__(self, db_manager: DatabaseManager):
+    def __init__(self, db_manager: DatabaseManager, catalogue: PaymentMethodsCatalogue, notifier: InvoiceStatusNotifier | None = None):
+        """
+        :param notifier: уведомляет клиентов, ожидающих изменения статуса счета
+        """
         self._db_manager = db_manager
+        self._catalogue = catalogue
+        self._notifier = notifier
         self._logger = logging.getLogger("payment_api_logger")
 
-        self._aaio = AaioAsync(config.AAIO_API_KEY, config.AAIO_SHOP_ID, config.AAIO_KEY1)
-        self._lava = LavaBusinessAPI(config.LAVA_SECRET_KEY)
+        self._sessions = ProviderSessions(default_limit=getattr(config, "PROVIDER_HTTP_LIMIT", 20),
+                                          limits=getattr(config, "PROVIDER_HTTP_LIMITS", None),
+                                          timeout=getattr(config, "PROVIDER_HTTP_TIMEOUT", 30))
+        self._registry = ProviderRegistry(self._sessions)
+
+    async def init_providers_async(self, router: APIRouter, webhook_context: WebhookContext):
+        """
+        Загружает адаптеры включенных способов оплаты и регистрирует вебхуки всех адаптеров.
+        """
+        self._registry.load(m.method_id for m in await self._catalogue.get_all_async())
+        self._registry.bind_webhooks(router, webhook_context)
+
+    async def close_async(self):
+        await self._sessions.close_async()
+
+    def is_method_available(self, method_id: str) -> bool:
+        """
+        False, если запросы к платежной системе временно не выполняются из-за ошибок или медленных ответов.
+        """
+        provider = self._registry.get_loaded(method_id)
+        return provider is None or provider.guard is None or provider.guard.is_available()
+
+    def get_provider(self, method_id: str) -> PaymentProvider:
+        return self._registry.get(method_id)
 
     @staticmethod
     def get_choose_method_url(invoice_id: str):
@@ -52,12 +97,31 @@ class InvoiceManager:
         invoice_id = str(uuid.uuid4())
 
         invoice = InvoiceInfo(invoice_id, InvoiceStatus.CREATED, amount, 0, datetime.datetime.now(), None, comment, custom_fields, webhook_url, None, self.get_choose_method_url(invoice_id))
-        await self._db_manager.save_invoice_info_async(invoice)
+        await self._db_manager.insert_invoice_async(invoice)
+        self._record_stats(None, created=1)
 
-        self._logger.info(f"Created invoice: {invoice}")
+        self._logger.info("Created invoice: %s", invoice.invoice_id, extra={"invoice_id": invoice.invoice_id, "amount": invoice.amount})
 
         return invoice
 
+    async def create_invoices_async(self, requests: list[tuple[float, str, str, str]]) -> list[InvoiceInfo]:
+        """
+        Создает несколько счетов одним запросом к БД.
+        :param requests: (amount, comment, custom_fields, webhook_url) для каждого счета
+        :return: созданные счета в том же порядке
+        """
+        invoices = []
+        for amount, comment, custom_fields, webhook_url in requests:
+            invoice_id = str(uuid.uuid4())
+            invoices.append(InvoiceInfo(invoice_id, InvoiceStatus.CREATED, amount, 0, datetime.datetime.now(), None, comment, custom_fields, webhook_url, None, self.get_choose_method_url(invoice_id)))
+
+        await self._db_manager.insert_invoices_async(invoices)
+        self._record_stats(None, created=len(invoices))
+
+        self._logger.info("Created %s invoices", len(invoices), extra={"invoice_ids": [invoice.invoice_id for invoice in invoices]})
+
+        return invoices
+
     async def process_invoice_async(self, invoice_id: str, method_id: str) -> InvoiceInfo:
         invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
         if invoice_info is None:
@@ -66,135 +130,57 @@ class InvoiceManager:
         if invoice_info.status != InvoiceStatus.CREATED or invoice_info.payment_method is not None:
             raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
 
-        method = await self._db_manager.get_payment_method_async(method_id)
+        method = await self._catalogue.get_async(method_id)
         if method is None:
             raise InvalidPaymentMethodError(method_id)
 
-        invoice_info.status = InvoiceStatus.PROCESSING
-
-        match method.method_id:
-            case "aaio":
-                invoice_info.payment_url = await self._create_aaio_invoice(invoice_info)
-            case "lava":
-                lava_invoice_info = await self._create_lava_invoice(invoice_info)
-                invoice_info.payment_url = lava_invoice_info.url
-                invoice_info.payment_method_invoice_id = lava_invoice_info.invoice_id
-            case "enot":
-                enot_invoice_info = await self._create_enot_invoice(invoice_info)
-                invoice_info.payment_url = enot_invoice_info.url
-                invoice_info.payment_method_invoice_id = enot_invoice_info.invoice_id
-            case "nicepay":
-                nicepay_invoice_info = await self._create_nicepay_invoice(invoice_info)
-                invoice_info.payment_url = nicepay_invoice_info.link
-                invoice_info.payment_method_invoice_id = nicepay_invoice_info.payment_id
-            case "pally":
-                pally_invoice_info = await self._create_pally_invoice(invoice_info)
-                invoice_info.payment_url = pally_invoice_info.url
-                invoice_info.payment_method_invoice_id = pally_invoice_info.id
-            case _:
-                await self._delegate_invoice_async(invoice_info, method)
-
+        provider = self._registry.get(method.method_id)
+        if provider.guard is None:
+            provider_invoice = await provider.create_invoice_async(invoice_info, method)
+        else:
+            try:
+                provider_invoice = await provider.guard.call_async(lambda: self._create_provider_invoice_async(provider, invoice_info, method))
+            except ProviderRejectedError as ex:
+                raise ProviderUnavailableError(method.method_id) from ex
+            except TimeoutError as ex:
+                raise PaymentSystemError(method.method_id) from ex
+
+        invoice_info.status = provider_invoice.status
+        invoice_info.payment_url = provider_invoice.payment_url
+        invoice_info.payment_method_invoice_id = provider_invoice.provider_invoice_id
         invoice_info.payment_method = method.method_id
 
-        await self._db_manager.save_invoice_info_async(invoice_info)
+        # счет мог быть обработан параллельным запросом, пока создавался счет в платежной системе
+        transition = await self._db_manager.transition_invoice_async(invoice_id, (InvoiceStatus.CREATED, ), invoice_info.status,
+                                                                     payment_method=invoice_info.payment_method,
+                                                                     payment_url=invoice_info.payment_url,
+                                                                     payment_method_invoice_id=invoice_info.payment_method_invoice_id)
+        invoice_info = self._get_transitioned_invoice(invoice_id, transition)
+        self._record_stats(invoice_info.payment_method, processing=1)
+        await self._notify_async(invoice_info)
 
-        self._logger.info(f"Processed invoice: {invoice_info}")
+        self._logger.info("Processed invoice: %s", invoice_id, extra={"invoice_id": invoice_id, "provider": invoice_info.payment_method,
+                                                                      "status": invoice_info.status.value,
+                                                                      "provider_invoice_id": invoice_info.payment_method_invoice_id})
 
         return invoice_info
 
-    async def _create_aaio_invoice(self, invoice_info: InvoiceInfo) -> str:
-        try:
-            return await self._aaio.generatepaymenturl(invoice_info.amount, invoice_info.invoice_id, desc=invoice_info.comment)
-        except Exception as ex:
-            raise PaymentSystemError("aaio") from ex
-
-    async def _create_lava_invoice(self, invoice_info: InvoiceInfo) -> LavaInvoiceInfo:
-        try:
-            return await self._lava.create_invoice(invoice_info.amount, config.LAVA_SHOP_ID,
-                                                   order_id=invoice_info.invoice_id,
-                                                   comment=invoice_info.comment,
-                                                   webhook_url=config.LAVA_WEBHOOK_URL,
-                                                   success_url=config.SUCCESS_URL,
-                                                   fail_url=config.FAILED_URL)
-        except CreateInvoiceException as ex:
-            raise PaymentSystemError("lava") from ex
-
-    @staticmethod
-    async def _create_enot_invoice(invoice_info: InvoiceInfo) -> enot.EnotInvoiceInfo:
-        try:
-            return await enot.create_invoice_async(
-                shop_id=config.ENOT_SHOP_ID,
-                secret_key=config.ENOT_SECRET_KEY,
-                amount=invoice_info.amount,
-                order_id=invoice_info.invoice_id,
-                hook_url=config.ENOT_WEBHOOK_URL,
-                comment=invoice_info.comment,
-                success_url=config.SUCCESS_URL,
-                fail_url=config.FAILED_URL,
-            )
-        except enot.APIError as e:
-            raise PaymentSystemError("enot") from e
-
-    @staticmethod
-    async def _create_nicepay_invoice(invoice_info: InvoiceInfo) -> nicepay.NicepayInvoiceInfo:
-        try:
-            return await nicepay.create_invoice_async(config.NICEPAY_MERCHANT_ID,
-                                                      config.NICEPAY_SECRET_KEY,
-                                                      invoice_info.invoice_id,
-                                                      "customer@untstrong.ru",
-                                                      invoice_info.amount,
-                                                      "RUB",
-                                                      description=invoice_info.comment,
-                                                      success_url=config.SUCCESS_URL,
-                                                      fail_url=config.FAILED_URL,
-                                                      )
-        except nicepay.APIError as e:
-            raise PaymentSystemError("nicepay") from e
-
-    @staticmethod
-    async def _create_pally_invoice(invoice_info: InvoiceInfo) -> pally.PallyBillInfo:
-        try:
-            return await pally.create_bill_async(
-                config.PALLY_SHOP_ID,
-                config.PALLY_SECRET_KEY,
-                invoice_info.amount,
-                invoice_info.invoice_id,
-                invoice_info.comment,
-                invoice_info.comment,
-            )
-        except pally.APIError as e:
-            raise PaymentSystemError("pally") from e
-
-    @staticmethod
-    async def _delegate_invoice_async(invoice_info: InvoiceInfo, method: PaymentMethod):
-        invoice_info.payment_url = method.delegate_url
-        invoice_info.status = InvoiceStatus.DELEGATED
-
-    @staticmethod
-    def _get_aaio_webhook_sign(shop_id: str, amount: str, currency: str, key2: str, invoice_id: str):
-        return hashlib.sha256(f"{shop_id}:{amount}:{currency}:{key2}:{invoice_id}".encode('utf-8')).hexdigest()
-
     @staticmethod
-    def check_aaio_sign(sign: str, amount: str, currency: str, invoice_id: str) -> bool:
-        s = InvoiceManager._get_aaio_webhook_sign(config.AAIO_SHOP_ID, amount, currency, config.AAIO_KEY2, invoice_id)
-        return s == sign
+    async def _create_provider_invoice_async(provider: PaymentProvider, invoice_info: InvoiceInfo, method: PaymentMethod):
+        async with metrics.track_provider_call(provider.method_id):
+            return await provider.create_invoice_async(invoice_info, method)
 
     async def set_invoice_payed_async(self, invoice_id: str, credited: float | None = None, payed: datetime.datetime | None = None, payment_method_invoice_id: str | None = None) -> InvoiceInfo:
-        invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
-        if invoice_info is None:
-            raise InvalidInvoiceError(invoice_id)
-
-        if invoice_info.status == InvoiceStatus.SUCCESS or invoice_info.status == InvoiceStatus.ERROR:
-            raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
+        transition = await self._db_manager.transition_invoice_async(invoice_id, self._OPEN_STATUSES, InvoiceStatus.SUCCESS,
+                                                                     credited=credited or None,    # None - зачислена вся сумма счета
+                                                                     payed=payed or datetime.datetime.now(),
+                                                                     payment_method_invoice_id=payment_method_invoice_id)
+        invoice_info = self._get_transitioned_invoice(invoice_id, transition)
+        self._record_stats(invoice_info.payment_method, paid=1, amount=invoice_info.amount, credited=invoice_info.credited)
+        await self._notify_async(invoice_info)
 
-        invoice_info.status = InvoiceStatus.SUCCESS
-        invoice_info.credited = credited or invoice_info.amount
-        invoice_info.payed = payed or datetime.datetime.now()
-        invoice_info.payment_method_invoice_id = payment_method_invoice_id
-
-        await self._db_manager.save_invoice_info_async(invoice_info)
-
-        self._logger.info(f"Invoice payed: {invoice_info}")
+        self._logger.info("Invoice payed: %s", invoice_id, extra={"invoice_id": invoice_id, "provider": invoice_info.payment_method,
+                                                                  "amount": invoice_info.amount, "credited": invoice_info.credited})
 
         return invoice_info
 
@@ -202,19 +188,34 @@ class InvoiceManager:
         if status == InvoiceStatus.SUCCESS:
             return await self.set_invoice_payed_async(invoice_id)
 
-        invoice_info = await self._db_manager.get_invoice_info_async(invoice_id)
-        if invoice_info is None:
-            raise InvalidInvoiceError(invoice_id)
+        # из открытых статусов счет не мог быть оплачен, поэтому credited и payed сбрасывать не нужно.
+        # Повторный перевод в тот же статус считается недопустимым, как и повторная оплата
+        from_statuses = [s for s in self._OPEN_STATUSES if s != status]
+        transition = await self._db_manager.transition_invoice_async(invoice_id, from_statuses, status)
+        invoice_info = self._get_transitioned_invoice(invoice_id, transition)
+        if status == InvoiceStatus.ERROR:
+            self._record_stats(invoice_info.payment_method, failed=1)
+        elif status == InvoiceStatus.TIMEOUT:
+            self._record_stats(invoice_info.payment_method, timed_out=1)
+        await self._notify_async(invoice_info)
 
-        if invoice_info.status == InvoiceStatus.SUCCESS or invoice_info.status == InvoiceStatus.ERROR:
-            raise InvalidInvoiceStatusError(invoice_info.invoice_id, invoice_info.status)
+        self._logger.info("Invoice status updated: [%s] %s", status, invoice_id,
+                          extra={"invoice_id": invoice_id, "provider": invoice_info.payment_method, "status": status.value})
 
-        invoice_info.status = status
-        invoice_info.credited = 0
-        invoice_info.payed = None
+        return invoice_info
 
-        await self._db_manager.save_invoice_info_async(invoice_info)
+    def _record_stats(self, payment_method: str | None, **counters):
+        # статистика сохраняется в БД фоном, чтобы не добавлять обращение к БД к обработке счета
+        self._db_manager.add_stats(datetime.datetime.now(), payment_method, **counters)
 
-        self._logger.info("Invoice status updated: [%s] %s", status, invoice_id)
+    async def _notify_async(self, invoice_info: InvoiceInfo):
+        if self._notifier is not None:
+            await self._notifier.notify_async(invoice_info)
 
-        return invoice_info
+    @staticmethod
+    def _get_transitioned_invoice(invoice_id: str, transition: InvoiceTransition) -> InvoiceInfo:
+        if transition.invoice is None:
+            raise InvalidInvoiceError(invoice_id)
+        if not transition.applied:
+            raise InvalidInvoiceStatusError(invoice_id, transition.invoice.status, invoice=transition.invoice)
+        return transition.invoice
@@ -0,0 +1,115 @@
+"""
+Уведомления об изменении статуса счета для ожидающих его клиентов (long-poll и Server-Sent Events).
+
+Ожидающие запросы подписываются на счет в памяти процесса и не обращаются к БД, пока статус не изменится.
+Изменения, сделанные на других экземплярах сервиса, приходят через канал Redis, который слушает одна задача на процесс.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from redis.asyncio import Redis
+
+from db import InvoiceInfo, InvoiceStatus
+
+
+class InvoiceStatusNotifier:
+    REDIS_CHANNEL = "payment_service:invoice_status"
+
+    _redis: Redis
+    _instance_id: str
+    _waiters: dict[str, set[asyncio.Queue]]
+    _logger: logging.Logger
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        # свои сообщения приходят и из канала, но ожидающие уже разбужены при отправке
+        self._instance_id = uuid.uuid4().hex
+        self._waiters = {}
+        self._logger = logging.getLogger("payment_api_logger")
+
+    def get_waiters_count(self) -> int:
+        return sum(len(queues) for queues in self._waiters.values())
+
+    @contextmanager
+    def watch(self, invoice_id: str) -> Iterator[asyncio.Queue]:
+        """
+        Подписывает на изменения статуса счета. В очередь приходят новые статусы,
+        а None означает, что уведомления могли быть потеряны и статус нужно перечитать из БД.
+        Подписываться нужно до чтения статуса из БД, чтобы не пропустить изменение между чтением и подпиской.
+        """
+        queue = asyncio.Queue()
+        self._waiters.setdefault(invoice_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._waiters.get(invoice_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._waiters[invoice_id]
+
+    async def notify_async(self, invoice: InvoiceInfo):
+        """
+        Будит ожидающих в текущем процессе и отправляет изменение остальным экземплярам сервиса.
+        """
+        await self.notify_many_async([invoice.invoice_id], invoice.status)
+
+    async def notify_many_async(self, invoice_ids: list[str], status: InvoiceStatus):
+        """
+        То же, что notify_async, для нескольких счетов, перешедших в один статус. Сообщения отправляются одним обращением к Redis.
+        """
+        if not invoice_ids:
+            return
+
+        for invoice_id in invoice_ids:
+            self._wake(invoice_id, status)
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for invoice_id in invoice_ids:
+                    pipe.publish(self.REDIS_CHANNEL, json.dumps({"invoice_id": invoice_id, "status": status.value,
+                                                                 "source": self._instance_id}))
+                await pipe.execute()
+        except Exception as ex:
+            # ожидающие на других экземплярах увидят изменение, когда истечет время ожидания
+            self._logger.exception("Failed to publish invoice status: %s", ", ".join(invoice_ids), exc_info=ex,
+                                   extra={"invoice_ids": invoice_ids})
+
+    async def listen_async(self):
+        """
+        Слушает изменения статусов с других экземпляров сервиса. Запускается как фоновая задача на все время работы сервиса.
+        """
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.REDIS_CHANNEL)
+                    # сообщения, отправленные во время переподключения, могли быть потеряны
+                    self._wake_all()
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                        if message is not None:
+                            self._handle_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._logger.exception("An error occured while listening for invoice status updates", exc_info=ex)
+                await asyncio.sleep(5)
+
+    def _handle_message(self, data: bytes):
+        try:
+            message = json.loads(data)
+            if message["source"] != self._instance_id:
+                self._wake(message["invoice_id"], InvoiceStatus(message["status"]))
+        except (ValueError, KeyError, TypeError) as ex:
+            self._logger.warning("Invalid invoice status message: %s", ex)
+
+    def _wake(self, invoice_id: str, status: InvoiceStatus | None):
+        for queue in self._waiters.get(invoice_id, ()):
+            queue.put_nowait(status)
+
+    def _wake_all(self):
+        for invoice_id in self._waiters:
+            self._wake(invoice_id, None)
@@ -0,0 +1,285 @@
+"""
+Периодические фоновые задачи сервиса.
+"""
+import asyncio
+import collections
+import datetime
+import logging
+
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+
+import metrics
+from circuit_breaker import ProviderRejectedError
+from db import DatabaseManager, InvoiceInfo, InvoiceStatus
+from invoice_notifier import InvoiceStatusNotifier
+from methods_catalogue import PaymentMethodsCatalogue
+from providers import PaymentProvider, WebhookContext
+from providers.webhooks import apply_event_async
+
+
+class PeriodicJob:
+    """
+    Задача, которая выполняется раз в interval секунд.
+    Одновременно она выполняется только на одном экземпляре сервиса: остальные пропускают запуск, пока занята блокировка в Redis.
+    """
+    REDIS_PREFIX = "payment_service:jobs:"
+
+    name: str
+
+    _redis: Redis
+    _interval: float
+    _lock_timeout: float
+    _logger: logging.Logger
+    _task: asyncio.Task | None
+
+    def __init__(self, redis: Redis, interval: float, lock_timeout: float = 300):
+        """
+        :param lock_timeout: через сколько секунд блокировка освобождается, если экземпляр, выполнявший задачу, упал.
+                             Должен быть больше времени одного запуска
+        """
+        self._redis = redis
+        self._interval = interval
+        self._lock_timeout = lock_timeout
+        self._logger = logging.getLogger("payment_api_logger")
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop_async())
+
+    async def stop_async(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def run_once_async(self):
+        raise NotImplementedError
+
+    async def _loop_async(self):
+        while True:
+            try:
+                lock = self._redis.lock(self.REDIS_PREFIX + self.name, timeout=self._lock_timeout, blocking=False)
+                if await lock.acquire():
+                    try:
+                        await self.run_once_async()
+                    finally:
+                        try:
+                            await lock.release()
+                        except LockError:
+                            # блокировка истекла раньше, чем закончилась задача
+                            self._logger.warning("[JOB %s] Lock expired before the job finished", self.name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._logger.exception("[JOB %s] An error occured", self.name, exc_info=ex)
+
+            await asyncio.sleep(self._interval)
+
+
+class InvoiceExpirySweeper(PeriodicJob):
+    """
+    Переводит в статус TIMEOUT счета, которые слишком долго остаются в статусе CREATED или PROCESSING.
+    """
+    name = "invoice_expiry"
+
+    _db_manager: DatabaseManager
+    _catalogue: PaymentMethodsCatalogue
+    _notifier: InvoiceStatusNotifier | None
+    _expiry_minutes: dict[str | None, float]
+    _default_expiry_minutes: float
+    _chunk_size: int
+    _max_chunks: int
+
+    def __init__(self, redis: Redis, db_manager: DatabaseManager, catalogue: PaymentMethodsCatalogue,
+                 expiry_minutes: dict[str | None, float] | None = None, default_expiry_minutes: float = 1440,
+                 chunk_size: int = 500, max_chunks: int = 20, interval: float = 60, notifier: InvoiceStatusNotifier | None = None):
+        """
+        :param notifier: уведомляет клиентов, ожидающих изменения статуса счета
+        :param expiry_minutes: время жизни счета по способам оплаты. Ключ None - счета, для которых способ оплаты еще не выбран
+        :param default_expiry_minutes: время жизни счета для способов оплаты, которых нет в expiry_minutes
+        :param chunk_size: максимальное количество счетов, изменяемых одним запросом
+        :param max_chunks: максимальное количество запросов для одного способа оплаты за один запуск
+        """
+        super().__init__(redis, interval)
+        self._db_manager = db_manager
+        self._catalogue = catalogue
+        self._notifier = notifier
+        self._expiry_minutes = expiry_minutes or {}
+        self._default_expiry_minutes = default_expiry_minutes
+        self._chunk_size = chunk_size
+        self._max_chunks = max_chunks
+
+    async def run_once_async(self):
+        methods = {None, *self._expiry_minutes.keys(), *(m.method_id for m in await self._catalogue.get_all_async())}
+        for method in methods:
+            minutes = self._expiry_minutes.get(method, self._default_expiry_minutes)
+            created_before = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+
+            for _ in range(self._max_chunks):
+                expired = await self._db_manager.expire_invoices_async(method, created_before, self._chunk_size)
+                if expired:
+                    self._logger.info("[JOB %s] Expired %s invoices with payment method '%s'", self.name, len(expired), method, extra={"provider": method})
+                    # статистика не должна мешать уведомлениям и следующим порциям, поэтому ошибки только логируются
+                    try:
+                        await self._db_manager.increment_stats_async(datetime.datetime.now(), method, timed_out=len(expired))
+                    except Exception as ex:
+                        self._logger.exception("[JOB %s] Failed to update payment statistics", self.name, exc_info=ex)
+                    if self._notifier is not None:
+                        await self._notifier.notify_many_async(expired, InvoiceStatus.TIMEOUT)
+                if len(expired) < self._chunk_size:
+                    break
+
+
+class InvoiceArchiver(PeriodicJob):
+    """
+    Переносит закрытые счета старше archive_after_days в таблицу invoices_archive, чтобы таблица invoices и ее индексы
+    содержали только счета, с которыми еще работают. Счета из архива по-прежнему находятся по ID.
+    """
+    name = "invoice_archive"
+
+    # TIMEOUT формально допускает оплату, но за время до архивации платежные системы вебхуков уже не присылают
+    _ARCHIVED_STATUSES = (InvoiceStatus.SUCCESS, InvoiceStatus.ERROR, InvoiceStatus.TIMEOUT)
+
+    _db_manager: DatabaseManager
+    _archive_after_days: float
+    _chunk_size: int
+    _max_chunks: int
+
+    def __init__(self, redis: Redis, db_manager: DatabaseManager, archive_after_days: float = 90,
+                 chunk_size: int = 1000, max_chunks: int = 50, interval: float = 3600):
+        """
+        :param archive_after_days: через сколько дней после создания закрытый счет переносится в архив
+        :param chunk_size: максимальное количество счетов, переносимых одной транзакцией
+        :param max_chunks: максимальное количество транзакций за один запуск
+        """
+        super().__init__(redis, interval)
+        self._db_manager = db_manager
+        self._archive_after_days = archive_after_days
+        self._chunk_size = chunk_size
+        self._max_chunks = max_chunks
+
+    async def run_once_async(self):
+        created_before = datetime.datetime.now() - datetime.timedelta(days=self._archive_after_days)
+        total = 0
+        for _ in range(self._max_chunks):
+            archived = await self._db_manager.archive_invoices_async(self._ARCHIVED_STATUSES, created_before, self._chunk_size)
+            total += archived
+            if archived < self._chunk_size:
+                break
+        if total:
+            self._logger.info("[JOB %s] Archived %s invoices", self.name, total)
+
+
+class _RateLimiter:
+    """
+    Не больше rate запросов в секунду: каждый следующий запрос начинается не раньше, чем через 1 / rate после предыдущего.
+    """
+    _interval: float
+    _next_at: float
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_at = 0
+
+    async def wait_async(self):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_at)
+        self._next_at = start + self._interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class InvoiceReconciler(PeriodicJob):
+    """
+    Сверяет с платежными системами счета, которые слишком долго остаются в статусе PROCESSING (например, потерян вебхук).
+    Статус запрашивается через API платежной системы и применяется так же, как вебхук.
+    """
+    name = "invoice_reconcile"
+
+    _db_manager: DatabaseManager
+    _catalogue: PaymentMethodsCatalogue
+    _context: WebhookContext
+    _stale_minutes: float
+    _batch_size: int
+    _max_batches: int
+    _concurrency: int
+    _rate_limits: dict[str, float]
+    _default_rate_limit: float
+
+    def __init__(self, redis: Redis, db_manager: DatabaseManager, catalogue: PaymentMethodsCatalogue, context: WebhookContext,
+                 stale_minutes: float = 15, batch_size: int = 100, max_batches: int = 10, concurrency: int = 5,
+                 rate_limits: dict[str, float] | None = None, default_rate_limit: float = 5, interval: float = 300):
+        """
+        :param stale_minutes: через сколько минут после создания счет в статусе PROCESSING сверяется с платежной системой
+        :param batch_size: количество счетов, выбираемых из БД одним запросом
+        :param max_batches: максимальное количество выборок для одного способа оплаты за один запуск
+        :param concurrency: максимальное количество одновременных запросов к одной платежной системе
+        :param rate_limits: максимальное количество запросов в секунду по способам оплаты
+        :param default_rate_limit: максимальное количество запросов в секунду для способов оплаты, которых нет в rate_limits
+        """
+        super().__init__(redis, interval)
+        self._db_manager = db_manager
+        self._catalogue = catalogue
+        self._context = context
+        self._stale_minutes = stale_minutes
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+        self._concurrency = concurrency
+        self._rate_limits = rate_limits or {}
+        self._default_rate_limit = default_rate_limit
+
+    async def run_once_async(self):
+        for method in await self._catalogue.get_all_async():
+            provider = self._context.invoice_manager.get_provider(method.method_id)
+            if provider.status_check:
+                await self._reconcile_method_async(provider)
+
+    async def _reconcile_method_async(self, provider: PaymentProvider):
+        created_before = datetime.datetime.now() - datetime.timedelta(minutes=self._stale_minutes)
+        limiter = _RateLimiter(self._rate_limits.get(provider.method_id, self._default_rate_limit))
+        semaphore = asyncio.Semaphore(self._concurrency)
+        results = collections.Counter()
+
+        after = None
+        for _ in range(self._max_batches):
+            invoices = await self._db_manager.list_invoices_async(self._batch_size, InvoiceStatus.PROCESSING, provider.method_id,
+                                                                  created_to=created_before, after=after)
+            results.update(await asyncio.gather(*(self._reconcile_invoice_async(provider, invoice, limiter, semaphore)
+                                                  for invoice in invoices)))
+            if len(invoices) < self._batch_size:
+                break
+            after = (invoices[-1].created, invoices[-1].invoice_id)
+
+        for result, count in results.items():
+            metrics.RECONCILED_INVOICES.labels(provider.method_id, result).inc(count)
+        if results:
+            self._logger.info("[JOB %s] Reconciled '%s' invoices: %s", self.name, provider.method_id, dict(results),
+                              extra={"provider": provider.method_id})
+
+    async def _reconcile_invoice_async(self, provider: PaymentProvider, invoice: InvoiceInfo, limiter: _RateLimiter,
+                                       semaphore: asyncio.Semaphore) -> str:
+        log_fields = {"invoice_id": invoice.invoice_id, "provider": provider.method_id}
+        async with semaphore:
+            await limiter.wait_async()
+            try:
+                if provider.guard is None:
+                    event = await provider.fetch_status_async(invoice)
+                else:
+                    event = await provider.guard.call_async(lambda: provider.fetch_status_async(invoice))
+            except ProviderRejectedError:
+                # платежная система сейчас недоступна: счет будет сверен при следующем запуске
+                return "rejected"
+            except Exception as ex:
+                self._logger.warning("[JOB %s] Failed to get invoice status: %s", self.name, ex, extra=log_fields)
+                return "error"
+
+        if event is None:
+            return "pending"
+        if event.invoice_id != invoice.invoice_id:
+            self._logger.error("[JOB %s] Provider returned another invoice: %s", self.name, event.invoice_id, extra=log_fields)
+            return "error"
+
+        response = await apply_event_async(provider, self._context, event)
+        return "updated" if response.status_code < 400 else "error"
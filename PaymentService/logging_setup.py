@@ -0,0 +1,103 @@
+"""
+Настройка логирования сервиса.
+
+Логгер только кладет записи в очередь, а форматирование и запись в файл и консоль выполняются в отдельном потоке,
+поэтому запись логов не блокирует event loop. В файл записи пишутся в JSON по одной на строку.
+"""
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+
+# атрибуты LogRecord, которые есть у любой записи. Все остальные атрибуты переданы через extra и попадают в JSON
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None)).keys()) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в JSON. Поля из extra (invoice_id, provider и т.д.) добавляются как есть.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Начинает новый файл, когда текущий превышает max_bytes или с его начала прошло rotate_seconds.
+    Старые файлы получают суффиксы .1, .2, ... как у RotatingFileHandler.
+    """
+    _rotate_seconds: float
+    _rollover_at: float
+
+    def __init__(self, filename: str, max_bytes: int, rotate_seconds: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self._rotate_seconds = rotate_seconds
+        self._rollover_at = time.time() + rotate_seconds
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._rotate_seconds > 0 and time.time() >= self._rollover_at and self.stream is not None and self.stream.tell() > 0:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self._rollover_at = time.time() + self._rotate_seconds
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    В отличие от стандартного QueueHandler не форматирует запись в потоке, который ее создал:
+    подставляются только аргументы сообщения, а трассировка исключения и JSON формируются в потоке записи.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # аргументы подставляются сразу, потому что переданные объекты могут измениться до записи
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(logger: logging.Logger, debug: bool, log_dir: str = "logs", level: int = logging.DEBUG,
+                  max_bytes: int = 50 * 1024 * 1024, rotate_seconds: float = 86400, backup_count: int = 14) -> logging.handlers.QueueListener:
+    """
+    Подключает к logger очередь с потоком записи. Возвращает запущенный QueueListener.
+    Он останавливается при завершении процесса, записав все оставшиеся в очереди записи.
+    :param debug: в режиме отладки логи пишутся только в консоль
+    :param max_bytes: максимальный размер файла лога
+    :param rotate_seconds: через сколько секунд начинается новый файл лога, даже если размер не превышен. 0 - только по размеру
+    :param backup_count: количество хранимых старых файлов лога
+    """
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+
+    if not debug:
+        os.makedirs(log_dir, exist_ok=True)
+        fh = SizeAndTimeRotatingFileHandler(os.path.join(log_dir, "payment_service.log"), max_bytes, rotate_seconds, backup_count)
+        fh.setFormatter(JsonFormatter())
+        handlers.append(fh)
+
+    log_queue = queue.SimpleQueue()
+    logger.setLevel(level)
+    logger.addHandler(_QueueHandler(log_queue))
+    # записи обрабатываются только очередью, поэтому передавать их выше (в корневой логгер) не нужно
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
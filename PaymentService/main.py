@@ -2,18 +2,24 @@
 Основной файл.
 Команда для запуска: uvicorn main:app --reload
 """
-import threading
-import time
-
 import fastapi
-import requests
 import datetime
+import time
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import ipaddress
+import json
+import math
 import os
-from fastapi import FastAPI, Request, Form, Response, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Form, Response, Query, Header, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 import config
 import db as database
 import logging
@@ -22,30 +28,134 @@ import asyncio
 import config as cfg
 from starlette.datastructures import Headers
 from dataclasses import dataclass
-from apis import enot, nicepay, pally
+from enum import Enum
+from contextlib import asynccontextmanager
+from redis.asyncio import Redis
+import logging_setup
 
 # настройка логгера до импорта других частей проекта, чтобы в них корректно работал logging.getLogger
 logger = logging.getLogger("payment_api_logger")
-
-if not os.path.exists("logs"):
-    os.makedirs("logs")
-
-logger.setLevel(logging.DEBUG)
-if not cfg.DEBUG:
-    fh = logging.FileHandler(f'logs/log_{datetime.datetime.now().strftime("%m-%d-%Y-%H-%M-%S")}.log')
-    fh.setFormatter(logging.Formatter(fmt='[%(asctime)s: %(levelname)s] %(message)s'))
-    fh.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-logger.addHandler(ch)
-
-from invoice_manager import InvoiceManager, InvalidInvoiceStatusError, InvalidInvoiceError, InvalidPaymentMethodError, PaymentSystemError
-
-
-app = FastAPI(docs_url=None, redoc_url=None)    # docs_url и redoc_url отключают автоматическую документацию
-db = database.DatabaseManager(cfg.MYSQL_HOST, cfg.MYSQL_USER, cfg.MYSQL_PASSWORD, cfg.MYSQL_DATABASE)    # экземпляр класса для доступа к данным из БД.
-invoice_manager = InvoiceManager(db)
+logging_setup.setup_logging(logger, cfg.DEBUG,
+                            level=getattr(cfg, "LOG_LEVEL", logging.DEBUG),
+                            max_bytes=getattr(cfg, "LOG_MAX_BYTES", 50 * 1024 * 1024),
+                            rotate_seconds=getattr(cfg, "LOG_ROTATE_SECONDS", 86400),
+                            backup_count=getattr(cfg, "LOG_BACKUP_COUNT", 14))
+
+from invoice_manager import InvoiceManager, InvalidInvoiceStatusError, InvalidInvoiceError, InvalidPaymentMethodError, PaymentSystemError, ProviderUnavailableError
+from webhook_sender import WebhookSender
+from methods_catalogue import PaymentMethodsCatalogue
+from invoice_notifier import InvoiceStatusNotifier
+from webhook_dedup import WebhookDeduplicator
+from webhook_queue import WebhookIngestQueue
+from rate_limiter import RateLimiter, RateLimitExceededError
+from jobs import InvoiceArchiver, InvoiceExpirySweeper, InvoiceReconciler
+from providers import WebhookContext
+import metrics
+
+
+redis = Redis.from_url(str(cfg.REDIS_URL), protocol=3)
+db = database.DatabaseManager(cfg.MYSQL_HOST, cfg.MYSQL_USER, cfg.MYSQL_PASSWORD, cfg.MYSQL_DATABASE,
+                              minsize=getattr(cfg, "MYSQL_POOL_MIN_SIZE", 1),
+                              maxsize=getattr(cfg, "MYSQL_POOL_MAX_SIZE", 10),
+                              pool_recycle=getattr(cfg, "MYSQL_POOL_RECYCLE", 3600),
+                              ping_after=getattr(cfg, "MYSQL_POOL_PING_AFTER", 30),
+                              group_commit_window=getattr(cfg, "MYSQL_GROUP_COMMIT_WINDOW", 0),
+                              group_commit_max_batch=getattr(cfg, "MYSQL_GROUP_COMMIT_MAX_BATCH", 100),
+                              port=getattr(cfg, "MYSQL_PORT", 3306),
+                              cache=redis if getattr(cfg, "INVOICE_CACHE_ENABLED", True) else None,
+                              cache_ttl=getattr(cfg, "INVOICE_CACHE_TTL", 300),
+                              stats_flush_interval=getattr(cfg, "PAYMENT_STATS_FLUSH_INTERVAL", 1),
+                              export_max_concurrent=getattr(cfg, "INVOICE_EXPORT_MAX_CONCURRENT", 2))    # экземпляр класса для доступа к данным из БД.
+catalogue = PaymentMethodsCatalogue(db, redis, ttl=getattr(cfg, "PAYMENT_METHODS_CACHE_TTL", 300))    # кэш таблицы payment_methods
+invoice_notifier = InvoiceStatusNotifier(redis)    # будит клиентов, ожидающих изменения статуса счета
+invoice_manager = InvoiceManager(db, catalogue, invoice_notifier)
+webhook_sender = WebhookSender(redis,
+                               workers=getattr(cfg, "WEBHOOK_WORKERS", 8),
+                               per_host_limit=getattr(cfg, "WEBHOOK_PER_HOST_LIMIT", 4),
+                               max_attempts=getattr(cfg, "WEBHOOK_MAX_ATTEMPTS", 10))    # отправка вебхуков об оплате на webhook_url счета
+webhook_dedup = WebhookDeduplicator(redis, ttl=getattr(cfg, "WEBHOOK_DEDUP_TTL", 86400))    # ответы на уже обработанные вебхуки платежных систем
+expiry_sweeper = InvoiceExpirySweeper(redis, db, catalogue,
+                                      expiry_minutes=getattr(cfg, "INVOICE_EXPIRY_MINUTES", None),
+                                      default_expiry_minutes=getattr(cfg, "INVOICE_EXPIRY_DEFAULT_MINUTES", 1440),
+                                      notifier=invoice_notifier)    # закрывает брошенные счета
+invoice_archiver = InvoiceArchiver(redis, db,
+                                   archive_after_days=getattr(cfg, "INVOICE_ARCHIVE_AFTER_DAYS", 90),
+                                   chunk_size=getattr(cfg, "INVOICE_ARCHIVE_CHUNK_SIZE", 1000),
+                                   max_chunks=getattr(cfg, "INVOICE_ARCHIVE_MAX_CHUNKS", 50))    # переносит старые закрытые счета в архив
+
+
+async def enqueue_webhook_async(invoice_info: database.InvoiceInfo):
+    """
+    Ставит в очередь вебхук клиенту об оплате счета. Ошибка передается дальше, чтобы платежная система повторила свой вебхук.
+    """
+    try:
+        await webhook_sender.enqueue_async(invoice_info)
+    except Exception as ex:
+        logger.exception("Failed to enqueue webhook: id = %s", invoice_info.invoice_id, exc_info=ex, extra={"invoice_id": invoice_info.invoice_id})
+        raise
+
+
+webhook_queue = None
+if getattr(cfg, "WEBHOOK_INGEST_MODE", "sync") == "queue":
+    # вебхуки платежных систем подтверждаются сразу после записи в Redis и применяются фоновыми обработчиками
+    webhook_queue = WebhookIngestQueue(redis,
+                                       shards=getattr(cfg, "WEBHOOK_QUEUE_SHARDS", 16),
+                                       batch_size=getattr(cfg, "WEBHOOK_QUEUE_BATCH_SIZE", 50),
+                                       max_attempts=getattr(cfg, "WEBHOOK_QUEUE_MAX_ATTEMPTS", 10),
+                                       lease_seconds=getattr(cfg, "WEBHOOK_QUEUE_LEASE_SECONDS", 30),
+                                       max_retry_delay=getattr(cfg, "WEBHOOK_QUEUE_MAX_RETRY_DELAY", 300))
+webhook_context = WebhookContext(invoice_manager, webhook_dedup, enqueue_webhook_async, webhook_queue)
+invoice_reconciler = InvoiceReconciler(redis, db, catalogue, webhook_context,
+                                       stale_minutes=getattr(cfg, "RECONCILE_STALE_MINUTES", 15),
+                                       batch_size=getattr(cfg, "RECONCILE_BATCH_SIZE", 100),
+                                       max_batches=getattr(cfg, "RECONCILE_MAX_BATCHES", 10),
+                                       concurrency=getattr(cfg, "RECONCILE_CONCURRENCY", 5),
+                                       rate_limits=getattr(cfg, "RECONCILE_RATE_LIMITS", None),
+                                       default_rate_limit=getattr(cfg, "RECONCILE_RATE_LIMIT", 5),
+                                       interval=getattr(cfg, "RECONCILE_INTERVAL", 300))    # сверяет зависшие счета с платежными системами
+# вид запросов -> тип ключа -> (запросов в секунду, запросов подряд). process_invoice вызывается со страницы оплаты без токена,
+# поэтому ограничивается только по IP, а количество счетов, которые можно обработать, ограничено лимитом на их создание
+rate_limiter = RateLimiter(redis, getattr(cfg, "RATE_LIMITS", {
+    "create": {"token": (50, 500), "ip": (20, 200)},
+    "process": {"ip": (1, 10)},
+}))
+# адреса обратных прокси, которым можно доверять X-Forwarded-For. Прокси перед сервисом должен передавать адрес клиента
+# в X-Forwarded-For, иначе все клиенты видны с адресом прокси и ограничение по IP не применяется
+TRUSTED_PROXIES = [ipaddress.ip_network(network) for network in getattr(cfg, "TRUSTED_PROXIES", (
+    "127.0.0.0/8", "::1/128", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "fc00::/7",
+))]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.open_async()
+    await db.create_tables_async()
+    # вебхуки платежных систем регистрируются адаптерами включенных способов оплаты
+    await invoice_manager.init_providers_async(app.router, webhook_context)
+    await webhook_sender.start_async()
+    if webhook_queue is not None:
+        await webhook_queue.start_async(webhook_context)
+    catalogue_listener = asyncio.create_task(catalogue.listen_async())
+    notifier_listener = asyncio.create_task(invoice_notifier.listen_async())
+    expiry_sweeper.start()
+    invoice_reconciler.start()
+    invoice_archiver.start()
+    yield
+    await invoice_archiver.stop_async()
+    await invoice_reconciler.stop_async()
+    await expiry_sweeper.stop_async()
+    catalogue_listener.cancel()
+    notifier_listener.cancel()
+    await asyncio.gather(catalogue_listener, notifier_listener, return_exceptions=True)
+    if webhook_queue is not None:
+        await webhook_queue.stop_async()
+    await webhook_sender.stop_async()
+    await invoice_manager.close_async()
+    await db.close_async()
+    await redis.aclose()
+
+
+app = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)    # docs_url и redoc_url отключают автоматическую документацию
 
 
 origins = [
@@ -62,197 +172,103 @@ app.add_middleware(
 )
 
 
-class APIException(Exception):
-    def __init__(self, code: int | str, message: str):
-        self.code = int(code)
-        self.message = message
+@app.middleware("http")
+async def measure_request_time(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # шаблон пути, а не сам путь, чтобы ID счетов не создавали отдельные серии метрик
+    route = request.scope.get("route")
+    metrics.HTTP_REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched", str(response.status_code)) \
+        .observe(time.perf_counter() - started)
+    return response
 
 
-@app.exception_handler(APIException)
-def api_exception_handler(request: Request, exc: APIException):
-    return JSONResponse(status_code=exc.code,
-                        content={"status": "error", "code": str(exc.code), "message": exc.message, "detail": exc.message})
+@app.get("/metrics")
+async def get_metrics():
+    queue_depth = await webhook_sender.get_queue_depth_async()
+    for state, value in queue_depth.items():
+        metrics.OUTBOUND_WEBHOOKS.labels(state).set(value)
+    if webhook_queue is not None:
+        for state, value in (await webhook_queue.get_queue_depth_async()).items():
+            metrics.INBOUND_WEBHOOKS.labels(state).set(value)
 
+    pool_stats = db.get_pool_stats()
+    metrics.DB_POOL_CONNECTIONS.labels("open").set(pool_stats.size)
+    metrics.DB_POOL_CONNECTIONS.labels("free").set(pool_stats.free)
 
-def send_webhook(invoice_info: database.InvoiceInfo):
-    retryings = 5
-    pause = 5
+    metrics.INVOICE_STATUS_WAITERS.set(invoice_notifier.get_waiters_count())
 
-    for trying in range(retryings):
+    content, content_type = metrics.render()
+    return Response(content, media_type=content_type)
 
-        try:
-            webhook_data = {
-                "invoice_id": invoice_info.invoice_id,
-                "sum": invoice_info.amount,
-                "comment": invoice_info.comment,
-                "custom_field": invoice_info.custom_fields,
-            }
-            resp = requests.post(invoice_info.webhook_url, json=webhook_data, headers={"User-Id": config.AUTH_TOKEN})
-            if resp.status_code != 200:
-                logger.error(f"Failed to send webhook with status code {resp.status_code}: id = {invoice_info.invoice_id}")
-                time.sleep(pause)
-                continue
-            logger.info(f"[USER WEBHOOK] Sended successfully: id = {invoice_info.invoice_id}")
-            return
-        except Exception as ex:
-            logger.exception(f"Internal error occured while sending webhook: id = {invoice_info.invoice_id}", exc_info=ex)
-            time.sleep(pause)
-            continue
-
-
-@app.post("/payment_service/aaio_webhook/")
-@app.post("/payment_service/aaio_webhook")
-async def aaio_webhook(invoice_id=Form(), order_id=Form(), amount=Form(), currency=Form(), sign=Form(), profit=Form()):
-    if not InvoiceManager.check_aaio_sign(str(sign), str(amount), str(currency), str(order_id)):
-        logger.error(f"[AAIO WEBHOOK] Failed to check sign: invoice_id={invoice_id}, order_id={order_id}, amount={amount}, currency={currency}, sign={sign}")
 
-    try:
-        invoice = await invoice_manager.set_invoice_payed_async(str(order_id), float(profit), payment_method_invoice_id=str(invoice_id))
-    except Exception as ex:
-        logger.error(f"[AAIO WEBHOOK] Failed to handle: invoice_id={invoice_id}, order_id={order_id}, amount={amount}, currency={currency}, sign={sign}", exc_info=ex)
-        return
-
-    if invoice.webhook_url:
-        send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-        send_webhook_thread.start()
+class APIException(Exception):
+    def __init__(self, code: int | str, message: str, headers: dict[str, str] | None = None):
+        self.code = int(code)
+        self.message = message
+        self.headers = headers
 
 
-class LavaWebhook(BaseModel):
-    invoice_id: str
-    order_id: str
-    status: str
-    pay_time: str
-    amount: float
-    custom_fields: Optional[str | None] = None
-    credited: float
+@app.exception_handler(APIException)
+def api_exception_handler(request: Request, exc: APIException):
+    return JSONResponse(status_code=exc.code,
+                        content={"status": "error", "code": str(exc.code), "message": exc.message, "detail": exc.message},
+                        headers=exc.headers)
 
 
-@app.post("/payment_service/lava_webhook/")
-@app.post("/payment_service/lava_webhook")
-async def lava_webhook(webhook: LavaWebhook, response: Response):
-    pay_time = None
+def is_trusted_proxy(address: str) -> bool:
     try:
-        pay_time = datetime.datetime.strptime(webhook.pay_time, "%Y-%m-%d %H:%M:%S")
-    except ValueError as ex:
-        logger.error(f"[LAVA WEBHOOK] Failed to parse pay time '{webhook.pay_time}'", exc_info=ex)
-
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def get_client_ip(request: Request) -> str | None:
+    """
+    Возвращает адрес клиента. Если запрос пришел от доверенного прокси, адрес берется из X-Forwarded-For:
+    первый справа адрес, который не принадлежит доверенному прокси (левые адреса клиент может подставить сам).
+    Возвращает None, если адрес клиента неизвестен: запрос от доверенного прокси без X-Forwarded-For.
+    """
+    if request.client is None:
+        return None
+    if not is_trusted_proxy(request.client.host):
+        return request.client.host
+    forwarded = [address.strip() for address in request.headers.get("x-forwarded-for", "").split(",") if address.strip()]
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address):
+            return address
+    # все адреса цепочки доверенные: клиент во внутренней сети
+    return forwarded[0] if forwarded else None
+
+
+async def check_rate_limit_async(scope: str, request: Request, user_token: str | None = None, cost: int = 1):
+    """
+    Отклоняет запрос с кодом 429, если клиент превысил лимит запросов вида scope по токену или IP.
+    Вызывается до проверки токена, чтобы подбор токена тоже ограничивался по IP: user_token передается, только если он верный.
+    """
+    client_ip = get_client_ip(request)
     try:
-        invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.credited), payed=pay_time, payment_method_invoice_id=str(webhook.invoice_id))
-    except Exception as ex:
-        logger.error(f"[LAVA WEBHOOK] Failed to handle: invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-        response.status_code = 500
-        return JSONResponse({"success": False, "error": str(ex)})
-
-    if invoice.webhook_url:
-        send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-        send_webhook_thread.start()
-
-    response.status_code = 200
-    return JSONResponse({"success": True})
-
-
-@app.post("/payment_service/enot_webhook/")
-@app.post("/payment_service/enot_webhook")
-async def enot_webhook(webhook: enot.EnotWebhook, response: Response):
-    if webhook.status == enot.EnotWebhookStatus.success:
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.credited), payed=webhook.pay_time, payment_method_invoice_id=str(webhook.invoice_id))
-        except Exception as ex:
-            logger.error(f"[ENOT WEBHOOK] Failed to handle: invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
-
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    elif webhook.status != enot.EnotWebhookStatus.refund:
-        try:
-            status = database.InvoiceStatus.TIMEOUT if webhook.status == webhook.status.expired else database.InvoiceStatus.ERROR
-            invoice = await invoice_manager.set_invoice_status_async(str(webhook.order_id), status)
-        except Exception as ex:
-            logger.error(
-                f"[ENOT WEBHOOK] Failed to handle: status={webhook.status}, invoice_id={webhook.invoice_id}, order_id={webhook.order_id}, amount={webhook.amount}",exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
-        return JSONResponse({"success": True})
-
-
-@app.get("/payment_service/nicepay_webhook/")
-@app.get("/payment_service/nicepay_webhook")
-async def nicepay_webhook(request: Request, webhook: Annotated[nicepay.NicepayWebhook, Query()], response: Response):
-    if not nicepay.is_hash_valid(config.NICEPAY_SECRET_KEY, dict(request.query_params)):
-        raise HTTPException(status_code=401, detail="Invalid hash")
+        await rate_limiter.check_async(scope, {"token": user_token, "ip": client_ip}, cost)
+    except RateLimitExceededError as ex:
+        logger.warning("Rate limit exceeded: %s by %s", scope, ex.key_type, extra={"ip": client_ip})
+        raise APIException(429, "Too many requests", headers={"Retry-After": str(max(1, math.ceil(ex.retry_after)))})
 
-    if webhook.result == nicepay.WebhookInvoiceStatus.success:
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(str(webhook.order_id), float(webhook.profit), payment_method_invoice_id=webhook.payment_id)
-        except Exception as ex:
-            logger.error(f"[NICEPAY WEBHOOK] Failed to handle: payment_id={webhook.payment_id}, order_id={webhook.order_id}, amount={webhook.amount}", exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
 
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
+def is_auth_header_valid(authorization: str | None) -> bool:
+    """
+    Проверяет токен служебных запросов, переданный в заголовке Authorization: Bearer <токен>.
+    В заголовке, а не в параметрах запроса, токен не попадает в логи uvicorn и прокси.
+    """
+    return authorization is not None and hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {config.AUTH_TOKEN}".encode("utf-8"))
 
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    else:
-        try:
-            invoice = await invoice_manager.set_invoice_status_async(webhook.order_id, database.InvoiceStatus.ERROR)
-        except Exception as ex:
-            logger.error(
-                f"[NICEPAY WEBHOOK] Failed to handle: status={webhook.result}, payment_id={webhook.payment_id}, order_id={webhook.order_id}, amount={webhook.amount}",exc_info=ex)
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
-        return JSONResponse({"success": True})
 
+def require_auth_token(authorization: Annotated[str | None, Header()] = None):
+    if not is_auth_header_valid(authorization):
+        raise APIException(403, "Invalid user token")
 
-@app.post("/payment_service/pally_webhook/")
-@app.post("/payment_service/pally_webhook")
-async def pally_webhook(request: Request, webhook: Annotated[pally.PostbackForm, Form()], response: Response):
-    if not pally.is_signature_valid(webhook.SignatureValue, webhook.OutSum, webhook.InvId):
-        raise HTTPException(status_code=401, detail="Invalid signature")
 
-    if webhook.Status in ("SUCCESS", "OVERPAID"):
-        try:
-            invoice = await invoice_manager.set_invoice_payed_async(
-                str(webhook.InvId),
-                float(webhook.OutSum),
-            )
-        except Exception as ex:
-            logger.error(
-                f"[PALLY WEBHOOK] Failed to handle: InvId={webhook.InvId}, OutSum={webhook.OutSum}",
-                exc_info=ex,
-            )
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-
-        if invoice.webhook_url:
-            send_webhook_thread = threading.Thread(target=send_webhook, args=(invoice,))
-            send_webhook_thread.start()
-
-        response.status_code = 200
-        return JSONResponse({"success": True})
-    else:
-        try:
-            invoice = await invoice_manager.set_invoice_status_async(
-                webhook.InvId, database.InvoiceStatus.ERROR
-            )
-        except Exception as ex:
-            logger.error(
-                f"[PALLY WEBHOOK] Failed to handle: Status={webhook.Status}, InvId={webhook.InvId}, ErrorCode={webhook.ErrorCode}, ErrorMessage={webhook.ErrorMessage}",
-                exc_info=ex,
-            )
-            response.status_code = 500
-            return JSONResponse({"success": False, "error": str(ex)})
-        response.status_code = 200
-        return JSONResponse({"success": True})
+AuthToken = Annotated[None, Depends(require_auth_token)]
 
 
 @dataclass
@@ -262,18 +278,24 @@ class ResponseCreateInvoice:
     url: str
 
 
-class CreateInvoiceRequest(BaseModel):
-    user_token: str
+class InvoiceParams(BaseModel):
+    # длины ограничены размерами колонок таблицы invoices
     amount: int    # сумма счета
-    comment: Optional[str] = Field("")   # комментарий
-    webhook_url: Optional[str] = ""    # URL для отправки вебхука при оплате
-    webhook_field: Optional[str] = ""    # дополнительное поле, которое будет передано в вебхук
+    comment: Optional[str] = Field("", max_length=256)   # комментарий
+    webhook_url: Optional[str] = Field("", max_length=128)    # URL для отправки вебхука при оплате
+    webhook_field: Optional[str] = Field("", max_length=128)    # дополнительное поле, которое будет передано в вебхук (custom_fields)
+
+
+class CreateInvoiceRequest(InvoiceParams):
+    user_token: str
 
 
 @app.post("/payment_service/create_invoice/")
 @app.post("/payment_service/create_invoice")
 async def create_invoice(request: fastapi.Request, invoice_request: CreateInvoiceRequest) -> ResponseCreateInvoice:
-    if invoice_request.user_token != config.AUTH_TOKEN:
+    token_valid = invoice_request.user_token == config.AUTH_TOKEN
+    await check_rate_limit_async("create", request, invoice_request.user_token if token_valid else None)
+    if not token_valid:
         raise APIException(403, "Invalid user token")
 
     try:
@@ -284,6 +306,67 @@ async def create_invoice(request: fastapi.Request, invoice_request: CreateInvoic
         raise APIException(500, "Internal server error")
 
 
+@dataclass
+class BulkInvoiceResult:
+    status: str    # "success" или "error"
+    id: str | None = None
+    url: str | None = None
+    code: str | None = None    # код ошибки, как у ответов с ошибкой
+    message: str | None = None
+
+
+@dataclass
+class ResponseCreateInvoices:
+    status: str    # "success" - созданы все счета, "partial" - часть, "error" - ни одного
+    invoices: list[BulkInvoiceResult]    # в порядке элементов запроса
+
+
+@app.post("/payment_service/create_invoices/")
+@app.post("/payment_service/create_invoices")
+async def create_invoices(request: Request, items: list[dict],
+                          authorization: Annotated[str | None, Header()] = None) -> ResponseCreateInvoices:
+    """
+    Создает несколько счетов за один запрос. Токен передается один раз, в заголовке Authorization: Bearer <токен>.
+    Каждый элемент проверяется отдельно, поэтому ошибка в одном элементе не мешает создать остальные счета.
+    Каждый счет расходует лимит на создание, как отдельный запрос create_invoice.
+    """
+    max_items = getattr(cfg, "BULK_CREATE_MAX_ITEMS", 1000)
+    if len(items) > max_items:
+        raise APIException(413, f"Too many invoices in one request, max {max_items}")
+
+    results: list[BulkInvoiceResult | None] = [None] * len(items)
+    valid: list[tuple[int, InvoiceParams]] = []
+    for i, item in enumerate(items):
+        try:
+            valid.append((i, InvoiceParams.model_validate(item)))
+        except ValidationError as ex:
+            message = "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in ex.errors())
+            results[i] = BulkInvoiceResult("error", code="422", message=message)
+
+    # как и в create_invoice, лимит проверяется до токена, чтобы подбор токена ограничивался лимитом IP.
+    # Запрос с неверным токеном или без верных элементов расходует лимит как один счет
+    token_valid = is_auth_header_valid(authorization)
+    await check_rate_limit_async("create", request, config.AUTH_TOKEN if token_valid else None,
+                                 cost=max(len(valid), 1) if token_valid else 1)
+    if not token_valid:
+        raise APIException(403, "Invalid user token")
+
+    if valid:
+        try:
+            invoices = await invoice_manager.create_invoices_async([(r.amount, r.comment, r.webhook_field, r.webhook_url) for _, r in valid])
+        except Exception as ex:
+            logger.exception("An error occured in create_invoices", exc_info=ex)
+            raise APIException(500, "Internal server error")
+        for (i, _), invoice in zip(valid, invoices):
+            results[i] = BulkInvoiceResult("success", invoice.invoice_id, invoice.payment_url)
+
+    if len(valid) == len(items):
+        status = "success"
+    else:
+        status = "partial" if valid else "error"
+    return ResponseCreateInvoices(status, results)
+
+
 @dataclass
 class RequestProcessInvoice:
     invoice_id: str
@@ -299,28 +382,110 @@ class ResponseProcessInvoice:
 
 @app.post("/payment_service/process_invoice/")
 @app.post("/payment_service/process_invoice")
-async def process_invoice(request: RequestProcessInvoice) -> ResponseProcessInvoice:
+async def process_invoice(http_request: Request, request: RequestProcessInvoice) -> ResponseProcessInvoice:
+    log_fields = {"invoice_id": request.invoice_id, "provider": request.method_id}
+    await check_rate_limit_async("process", http_request)
     try:
         invoice = await invoice_manager.process_invoice_async(request.invoice_id, request.method_id)
         return ResponseProcessInvoice("success", invoice.invoice_id, invoice.payment_url)
     except InvalidInvoiceError as ex:
-        logger.exception(str(ex), exc_info=ex)
+        logger.exception(str(ex), exc_info=ex, extra=log_fields)
         raise APIException(404, str(ex))
     except InvalidInvoiceStatusError as ex:
-        logger.exception(str(ex), exc_info=ex)
+        logger.exception(str(ex), exc_info=ex, extra=log_fields)
         raise APIException(409, str(ex))
     except InvalidPaymentMethodError as ex:
-        logger.exception(str(ex), exc_info=ex)
+        logger.exception(str(ex), exc_info=ex, extra=log_fields)
         raise APIException(405, str(ex))
+    except ProviderUnavailableError as ex:
+        logger.warning(str(ex), extra=log_fields)
+        raise APIException(503, str(ex))
     except PaymentSystemError as ex:
-        logger.exception(str(ex), exc_info=ex)
+        logger.exception(str(ex), exc_info=ex, extra=log_fields)
         raise APIException(500, str(ex))
 
     except Exception as ex:
-        logger.exception("An error occured in process_invoice", exc_info=ex)
+        logger.exception("An error occured in process_invoice", exc_info=ex, extra=log_fields)
         raise APIException(500, "Internal server error")
 
 
+# статусы, из которых счет уже не выходит: после них поток SSE закрывается
+FINAL_INVOICE_STATUSES = (database.InvoiceStatus.SUCCESS, database.InvoiceStatus.ERROR)
+INVOICE_STATUS_MAX_WAIT = getattr(cfg, "INVOICE_STATUS_MAX_WAIT", 60)
+INVOICE_STATUS_STREAM_SECONDS = getattr(cfg, "INVOICE_STATUS_STREAM_SECONDS", 300)
+INVOICE_STATUS_HEARTBEAT = getattr(cfg, "INVOICE_STATUS_HEARTBEAT", 15)
+
+
+@dataclass
+class ResponseInvoiceStatus:
+    id: str
+    status: database.InvoiceStatus
+
+
+async def get_invoice_status_async(invoice_id: str) -> database.InvoiceStatus:
+    invoice = await db.get_invoice_info_async(invoice_id)
+    if invoice is None:
+        raise APIException(404, f"Invoice '{invoice_id}' not found.")
+    return invoice.status
+
+
+@app.get("/payment_service/invoice/{invoice_id}/status/")
+@app.get("/payment_service/invoice/{invoice_id}/status")
+async def get_invoice_status(request: Request, invoice_id: str, known_status: database.InvoiceStatus | None = None,
+                             wait: Annotated[float, Query(ge=0)] = 0, stream: bool = False) -> ResponseInvoiceStatus:
+    """
+    Статус счета для страницы оплаты и плагинов, ожидающих оплату.
+    Long-poll: если статус равен known_status, ответ ждет его изменения до wait секунд и возвращает текущий статус.
+    SSE (stream=true или Accept: text/event-stream): событие status приходит сразу и при каждом изменении,
+    поток закрывается после конечного статуса или через INVOICE_STATUS_STREAM_SECONDS.
+    """
+    if stream or "text/event-stream" in request.headers.get("accept", ""):
+        # счет проверяется до ответа, чтобы на несуществующий счет вернуть 404, а не пустой поток
+        await get_invoice_status_async(invoice_id)
+        return StreamingResponse(stream_invoice_status(invoice_id), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    with invoice_notifier.watch(invoice_id) as queue:
+        status = await get_invoice_status_async(invoice_id)
+        deadline = asyncio.get_running_loop().time() + min(wait, INVOICE_STATUS_MAX_WAIT)
+        while status == known_status:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                status = await asyncio.wait_for(queue.get(), timeout)
+            except TimeoutError:
+                break
+            if status is None:
+                status = await get_invoice_status_async(invoice_id)
+    return ResponseInvoiceStatus(invoice_id, status)
+
+
+async def stream_invoice_status(invoice_id: str):
+    with invoice_notifier.watch(invoice_id) as queue:
+        status = (await db.get_invoice_info_async(invoice_id)).status
+        deadline = asyncio.get_running_loop().time() + INVOICE_STATUS_STREAM_SECONDS
+        while True:
+            yield f"event: status\ndata: {json.dumps({'id': invoice_id, 'status': status.value})}\n\n"
+            if status in FINAL_INVOICE_STATUSES:
+                return
+
+            new_status = status
+            while new_status == status:
+                timeout = min(INVOICE_STATUS_HEARTBEAT, deadline - asyncio.get_running_loop().time())
+                if timeout <= 0:
+                    return
+                try:
+                    new_status = await asyncio.wait_for(queue.get(), timeout)
+                except TimeoutError:
+                    # комментарий не дает прокси закрыть простаивающее соединение
+                    yield ": ping\n\n"
+                    continue
+                if new_status is None:
+                    new_status = (await db.get_invoice_info_async(invoice_id)).status
+            status = new_status
+
+
 @dataclass
 class PaymentMethod:
     id: str
@@ -328,13 +493,245 @@ class PaymentMethod:
     description: str
     icon_url: str
     instructions: str
+    available: bool    # False, если платежная система сейчас не отвечает или отвечает с ошибками
+
+
+async def get_available_methods_async() -> tuple[list[PaymentMethod], str]:
+    """
+    Способы оплаты с текущей доступностью и ETag этого списка. Берутся из кэша способов оплаты без обращения к БД.
+    """
+    snapshot = await catalogue.get_snapshot_async()
+    available = {m.method_id: invoice_manager.is_method_available(m.method_id) for m in snapshot.methods}
+
+    # доступность способов оплаты меняется независимо от списка, поэтому тоже входит в ETag
+    unavailable = ",".join(method_id for method_id, is_available in available.items() if not is_available)
+    etag = snapshot.etag
+    if unavailable:
+        etag = etag[:-1] + "-" + hashlib.sha1(unavailable.encode("utf-8")).hexdigest()[:8] + '"'
+
+    methods = [PaymentMethod(m.method_id, m.name, m.description, m.icon_url, m.instructions or "", available[m.method_id])
+               for m in snapshot.methods]
+    return methods, etag
 
 
 @app.get("/payment_service/methods/")
 @app.get("/payment_service/methods")
-async def get_payment_methods() -> list[PaymentMethod]:
-    methods = await db.get_payment_methods_async()
-    return [PaymentMethod(m.method_id, m.name, m.description, m.icon_url, m.instructions or "") for m in methods]
+async def get_payment_methods(request: Request) -> list[PaymentMethod]:
+    methods, etag = await get_available_methods_async()
+
+    # клиент уже получал этот список - отправлять его повторно не нужно
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(jsonable_encoder(methods), headers=headers)
+
+
+@dataclass
+class CheckoutInvoice:
+    id: str
+    status: database.InvoiceStatus
+    amount: float
+    comment: str
+    created: datetime.datetime
+    payment_method: str | None
+    payment_url: str
+
+
+@dataclass
+class CheckoutPayload:
+    invoice: CheckoutInvoice
+    methods: list[PaymentMethod]
+
+
+@app.get("/payment_service/invoice/{invoice_id}/checkout/")
+@app.get("/payment_service/invoice/{invoice_id}/checkout")
+async def get_checkout(request: Request, invoice_id: str) -> CheckoutPayload:
+    """
+    Все данные для страницы выбора способа оплаты одним запросом: счет из кэша счетов и способы оплаты из кэша способов оплаты.
+    """
+    invoice = await db.get_invoice_info_async(invoice_id)
+    if invoice is None:
+        raise APIException(404, f"Invoice '{invoice_id}' not found.")
+    methods, methods_etag = await get_available_methods_async()
+
+    checkout_invoice = CheckoutInvoice(invoice.invoice_id, invoice.status, invoice.amount, invoice.comment, invoice.created,
+                                       invoice.payment_method, invoice.payment_url)
+    encoded_invoice = jsonable_encoder(checkout_invoice)
+    invoice_hash = hashlib.sha1(json.dumps(encoded_invoice, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    etag = methods_etag[:-1] + "-" + invoice_hash + '"'
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse({"invoice": encoded_invoice, "methods": jsonable_encoder(methods)}, headers=headers)
+
+
+class InvalidateMethodsRequest(BaseModel):
+    user_token: str
+
+
+@app.post("/payment_service/methods/invalidate/")
+@app.post("/payment_service/methods/invalidate")
+async def invalidate_payment_methods(request: InvalidateMethodsRequest):
+    """
+    Сбрасывает кэш способов оплаты во всех экземплярах сервиса. Вызывается после изменения таблицы payment_methods.
+    """
+    if request.user_token != config.AUTH_TOKEN:
+        raise APIException(403, "Invalid user token")
+
+    await catalogue.publish_invalidation_async()
+    return {"status": "success"}
+
+
+@dataclass
+class StatsBucket:
+    bucket: datetime.datetime
+    payment_method: str
+    created: int
+    processing: int
+    paid: int
+    failed: int
+    timed_out: int
+    amount_sum: float
+    credited_sum: float
+
+
+@app.get("/payment_service/stats/")
+@app.get("/payment_service/stats")
+async def get_stats(auth: AuthToken, since: datetime.datetime, until: datetime.datetime,
+                    granularity: database.StatsGranularity = database.StatsGranularity.DAY,
+                    method: str | None = None) -> list[StatsBucket]:
+    """
+    Статистика платежей из предварительно посчитанных таблиц, без агрегации по таблице invoices.
+    since включительно, until не включительно.
+    """
+    buckets = await db.get_stats_async(granularity, since, until, method)
+    return [StatsBucket(b.bucket, b.payment_method, b.created, b.processing, b.paid, b.failed, b.timed_out,
+                        b.amount_sum, b.credited_sum) for b in buckets]
+
+
+@dataclass
+class InvoicesPage:
+    invoices: list[database.InvoiceInfo]
+    next_cursor: str | None    # передается в cursor для получения следующей страницы; None - это последняя страница
+
+
+def encode_invoices_cursor(invoice: database.InvoiceInfo) -> str:
+    raw = json.dumps([invoice.created.isoformat(), invoice.invoice_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_invoices_cursor(cursor: str) -> tuple[datetime.datetime, str]:
+    try:
+        created, invoice_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.datetime.fromisoformat(created), str(invoice_id)
+    except Exception:
+        raise APIException(400, "Invalid cursor")
+
+
+@app.get("/payment_service/invoices/")
+@app.get("/payment_service/invoices")
+async def list_invoices(auth: AuthToken, status: database.InvoiceStatus | None = None, method: str | None = None,
+                        created_from: datetime.datetime | None = None, created_to: datetime.datetime | None = None,
+                        limit: Annotated[int, Query(ge=1, le=500)] = 100, cursor: str | None = None) -> InvoicesPage:
+    """
+    Список счетов от новых к старым с постраничной выдачей по курсору.
+    """
+    after = decode_invoices_cursor(cursor) if cursor else None
+    # лишний счет показывает, есть ли следующая страница
+    invoices = await db.list_invoices_async(limit + 1, status, method, created_from, created_to, after)
+    if len(invoices) <= limit:
+        return InvoicesPage(invoices, None)
+    invoices = invoices[:limit]
+    return InvoicesPage(invoices, encode_invoices_cursor(invoices[-1]))
+
+
+@app.get("/payment_service/invoices/by_provider/{method_id}/{provider_invoice_id}/")
+@app.get("/payment_service/invoices/by_provider/{method_id}/{provider_invoice_id}")
+async def get_invoice_by_provider_id(auth: AuthToken, method_id: str, provider_invoice_id: str) -> database.InvoiceInfo:
+    """
+    Поиск счета по его ID в платежной системе.
+    """
+    invoice = await db.get_invoice_by_provider_id_async(method_id, provider_invoice_id)
+    if invoice is None:
+        raise APIException(404, f"Invoice '{provider_invoice_id}' not found in '{method_id}'")
+    return invoice
+
+
+class ExportFormat(Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+EXPORT_COLUMNS = ("invoice_id", "status", "amount", "credited", "created", "payed", "comment", "custom_fields",
+                  "payment_method", "payment_method_invoice_id")
+
+
+def export_invoice_values(invoice: database.InvoiceInfo) -> list:
+    return [invoice.invoice_id, invoice.status.value, invoice.amount, invoice.credited,
+            invoice.created.isoformat(), invoice.payed.isoformat() if invoice.payed else None, invoice.comment,
+            invoice.custom_fields, invoice.payment_method, invoice.payment_method_invoice_id]
+
+
+class ExportResponse(StreamingResponse):
+    """
+    Ответ выгрузки. Закрывает соединение выгрузки, когда ответ отправлен, клиент отключился или произошла ошибка,
+    в том числе если чтение счетов не начиналось.
+    """
+    def __init__(self, batches: database.InvoiceStream, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.batches = batches
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.batches.close_async()
+
+
+async def export_invoices_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for invoices in batches:
+        writer.writerows(export_invoice_values(invoice) for invoice in invoices)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+async def export_invoices_ndjson(batches):
+    async for invoices in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, export_invoice_values(invoice))), ensure_ascii=False) + "\n"
+                      for invoice in invoices)
+
+
+@app.get("/payment_service/invoices/export/")
+@app.get("/payment_service/invoices/export")
+async def export_invoices(auth: AuthToken, created_from: datetime.datetime, created_to: datetime.datetime,
+                          output: ExportFormat = ExportFormat.CSV, status: database.InvoiceStatus | None = None,
+                          method: str | None = None):
+    """
+    Выгрузка счетов (включая архив), созданных в [created_from, created_to), в CSV или NDJSON.
+    Счета читаются из БД и отправляются клиенту порциями, поэтому размер выгрузки не ограничен памятью сервиса.
+    """
+    if created_from >= created_to:
+        raise APIException(400, "created_from must be earlier than created_to")
+
+    try:
+        batches = await db.stream_invoices_async(created_from, created_to, status, method,
+                                                 batch_size=getattr(cfg, "INVOICE_EXPORT_BATCH_SIZE", 1000))
+    except database.ExportLimitExceededError as ex:
+        raise APIException(429, str(ex), headers={"Retry-After": "60"})
+    if output == ExportFormat.CSV:
+        content, media_type = export_invoices_csv(batches), "text/csv"
+    else:
+        content, media_type = export_invoices_ndjson(batches), "application/x-ndjson"
+    filename = f"invoices_{created_from:%Y%m%d}_{created_to:%Y%m%d}.{output.value}"
+    return ExportResponse(batches, content, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 # только для тестирования
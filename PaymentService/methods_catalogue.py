@@ -0,0 +1,103 @@
+"""
+Кэш списка способов оплаты.
+
+Таблица payment_methods меняется очень редко, поэтому она хранится в памяти и перечитывается по истечении TTL
+или после сообщения в канал Redis, которое получают все экземпляры сервиса.
+"""
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+
+from db import DatabaseManager, PaymentMethod
+
+
+@dataclass
+class CatalogueSnapshot:
+    methods: list[PaymentMethod]
+    by_id: dict[str, PaymentMethod]
+    etag: str    # меняется при любом изменении списка способов оплаты
+    loaded_at: float
+
+
+class PaymentMethodsCatalogue:
+    REDIS_CHANNEL = "payment_service:payment_methods:invalidate"
+
+    _db_manager: DatabaseManager
+    _redis: Redis
+    _ttl: float
+    _logger: logging.Logger
+    _snapshot: CatalogueSnapshot | None
+    _lock: asyncio.Lock
+
+    def __init__(self, db_manager: DatabaseManager, redis: Redis, ttl: float = 300):
+        """
+        :param ttl: через сколько секунд список перечитывается из БД, даже если не было сообщения об изменении
+        """
+        self._db_manager = db_manager
+        self._redis = redis
+        self._ttl = ttl
+        self._logger = logging.getLogger("payment_api_logger")
+        self._snapshot = None
+        self._lock = asyncio.Lock()
+
+    async def get_snapshot_async(self) -> CatalogueSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.loaded_at < self._ttl:
+            return snapshot
+
+        async with self._lock:
+            # пока ожидали блокировку, список мог загрузить другой запрос
+            if self._snapshot is not None and self._snapshot is not snapshot:
+                return self._snapshot
+
+            methods = await self._db_manager.get_payment_methods_async()
+            serialized = json.dumps([dataclasses.asdict(m) for m in methods], sort_keys=True, ensure_ascii=False)
+            etag = '"' + hashlib.sha1(serialized.encode("utf-8")).hexdigest() + '"'
+            self._snapshot = CatalogueSnapshot(methods, {m.method_id: m for m in methods}, etag, time.monotonic())
+            return self._snapshot
+
+    async def get_all_async(self) -> list[PaymentMethod]:
+        return (await self.get_snapshot_async()).methods
+
+    async def get_async(self, method_id: str) -> PaymentMethod | None:
+        return (await self.get_snapshot_async()).by_id.get(method_id)
+
+    def invalidate(self):
+        """
+        Сбрасывает кэш только в текущем процессе.
+        """
+        self._snapshot = None
+
+    async def publish_invalidation_async(self):
+        """
+        Сбрасывает кэш во всех экземплярах сервиса, включая текущий.
+        """
+        self.invalidate()
+        await self._redis.publish(self.REDIS_CHANNEL, "invalidate")
+
+    async def listen_async(self):
+        """
+        Слушает канал сброса кэша. Запускается как фоновая задача на все время работы сервиса.
+        """
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.REDIS_CHANNEL)
+                    # сообщения, отправленные во время переподключения, могли быть потеряны
+                    self.invalidate()
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                        if message is not None:
+                            self._logger.info("Payment methods cache invalidated")
+                            self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._logger.exception("An error occured while listening for payment methods updates", exc_info=ex)
+                await asyncio.sleep(5)
@@ -0,0 +1,71 @@
+"""
+Метрики сервиса в формате Prometheus.
+"""
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+
+# границы корзин в секундах: от быстрых запросов к БД до таймаутов платежных систем
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PROVIDER_REQUEST_SECONDS = Histogram("payment_provider_request_seconds", "Время создания счета в платежной системе",
+                                     ["provider"], buckets=_BUCKETS)
+PROVIDER_ERRORS = Counter("payment_provider_errors_total", "Ошибки при создании счета в платежной системе", ["provider"])
+PROVIDER_CIRCUIT_OPEN = Gauge("payment_provider_circuit_open", "1, если запросы к платежной системе временно не выполняются",
+                              ["provider"])
+
+DB_QUERY_SECONDS = Histogram("payment_db_query_seconds", "Время выполнения запроса к БД", ["query"], buckets=_BUCKETS)
+DB_POOL_WAIT_SECONDS = Histogram("payment_db_pool_wait_seconds", "Время ожидания свободного соединения с БД", buckets=_BUCKETS)
+DB_CACHE_REQUESTS = Counter("payment_db_cache_requests_total", "Обращения к кэшу счетов в Redis", ["result"])
+DB_POOL_CONNECTIONS = Gauge("payment_db_pool_connections", "Соединения в пуле БД", ["state"])
+
+WEBHOOK_SECONDS = Histogram("payment_webhook_seconds", "Время обработки вебхука платежной системы", ["provider"], buckets=_BUCKETS)
+WEBHOOK_REJECTED = Counter("payment_webhook_rejected_total", "Вебхуки, отклоненные до обработки (подпись, формат, размер)",
+                           ["provider", "reason"])
+WEBHOOK_QUEUE_LAG_SECONDS = Histogram("payment_webhook_queue_lag_seconds", "Время от приема вебхука в очередь до начала его обработки",
+                                     ["provider"], buckets=_BUCKETS)
+INBOUND_WEBHOOKS = Gauge("payment_inbound_webhooks", "Вебхуки платежных систем в очереди обработки", ["state"])
+
+RECONCILED_INVOICES = Counter("payment_reconciled_invoices_total",
+                              "Счета, сверенные с платежной системой (updated, pending, error, rejected)", ["provider", "result"])
+
+RATE_LIMITED_REQUESTS = Counter("payment_rate_limited_requests_total", "Запросы, отклоненные ограничением частоты",
+                                ["scope", "key"])
+
+HTTP_REQUEST_SECONDS = Histogram("payment_http_request_seconds", "Время обработки HTTP запроса", ["method", "route", "status"],
+                                 buckets=_BUCKETS)
+
+INVOICE_STATUS_WAITERS = Gauge("payment_invoice_status_waiters", "Клиенты, ожидающие изменения статуса счета (long-poll и SSE)")
+
+OUTBOUND_WEBHOOKS = Gauge("payment_outbound_webhooks", "Вебхуки клиентам в очереди доставки", ["state"])
+
+
+@contextmanager
+def observe(histogram: Histogram, *labels: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        (histogram.labels(*labels) if labels else histogram).observe(elapsed)
+
+
+@asynccontextmanager
+async def track_provider_call(provider: str):
+    """
+    Измеряет время запроса к платежной системе и считает ошибки.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        PROVIDER_ERRORS.labels(provider).inc()
+        raise
+    finally:
+        PROVIDER_REQUEST_SECONDS.labels(provider).observe(time.perf_counter() - started)
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,90 @@
+"""
+Реестр адаптеров платежных систем.
+
+Модуль адаптера импортируется и создается при первом обращении к нему: при создании счета включенным способом оплаты
+или при первом вебхуке, поэтому зависимости неиспользуемых платежных систем не загружаются.
+"""
+import importlib
+import logging
+from typing import Iterable
+
+from fastapi import APIRouter
+
+from apis.sessions import ProviderSessions
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookContext, WebhookEvent
+
+
+class ProviderRegistry:
+
+    # method_id -> путь к классу адаптера
+    _ADAPTERS = {
+        "aaio": "providers.aaio.AaioProvider",
+        "lava": "providers.lava.LavaProvider",
+        "enot": "providers.enot.EnotProvider",
+        "nicepay": "providers.nicepay.NicepayProvider",
+        "pally": "providers.pally.PallyProvider",
+    }
+    # все остальные способы оплаты делегируются по delegate_url
+    _DELEGATE_ADAPTER = "providers.delegate.DelegateProvider"
+    # method_id -> (путь вебхука после /payment_service/, HTTP метод). Маршруты регистрируются для всех адаптеров,
+    # а не только для включенных: по счетам, созданным до выключения способа оплаты, вебхуки приходят и после него
+    _WEBHOOKS = {
+        "aaio": ("aaio_webhook", "POST"),
+        "lava": ("lava_webhook", "POST"),
+        "enot": ("enot_webhook", "POST"),
+        "nicepay": ("nicepay_webhook", "GET"),    # nicepay передает данные вебхука в строке запроса
+        "pally": ("pally_webhook", "POST"),
+    }
+
+    _sessions: ProviderSessions
+    _providers: dict[str, PaymentProvider]
+    _delegate: PaymentProvider | None
+    _logger: logging.Logger
+
+    def __init__(self, sessions: ProviderSessions):
+        self._sessions = sessions
+        self._providers = {}
+        self._delegate = None
+        self._logger = logging.getLogger("payment_api_logger")
+
+    def get(self, method_id: str) -> PaymentProvider:
+        """
+        Возвращает адаптер способа оплаты, загружая его при первом обращении.
+        """
+        provider = self._providers.get(method_id)
+        if provider is not None:
+            return provider
+
+        if method_id not in self._ADAPTERS:
+            if self._delegate is None:
+                self._delegate = self._create(self._DELEGATE_ADAPTER)
+            return self._delegate
+
+        provider = self._create(self._ADAPTERS[method_id])
+        self._providers[method_id] = provider
+        self._logger.info("Payment provider loaded: %s", method_id, extra={"provider": method_id})
+        return provider
+
+    def get_loaded(self, method_id: str) -> PaymentProvider | None:
+        """
+        Возвращает адаптер, только если он уже загружен.
+        """
+        return self._providers.get(method_id)
+
+    def load(self, method_ids: Iterable[str]):
+        for method_id in method_ids:
+            self.get(method_id)
+
+    def bind_webhooks(self, router: APIRouter, context: WebhookContext):
+        """
+        Регистрирует в router вебхуки всех адаптеров, в том числе еще не загруженных: адаптер загружается при первом вебхуке.
+        """
+        # providers.webhooks зависит от invoice_manager, который сам импортирует этот модуль
+        from providers import webhooks
+        for method_id, (path, http_method) in self._WEBHOOKS.items():
+            webhooks.register_webhooks(router, path, http_method, lambda method_id=method_id: self.get(method_id), context)
+
+    def _create(self, path: str) -> PaymentProvider:
+        module_name, class_name = path.rsplit(".", 1)
+        provider_class = getattr(importlib.import_module(module_name), class_name)
+        return provider_class(self._sessions)
@@ -0,0 +1,64 @@
+"""
+Адаптер aaio.io
+"""
+import hashlib
+import hmac
+import urllib.parse
+
+from AaioAsync import AaioAsync
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+import config
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from invoice_manager import PaymentSystemError
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookEvent
+
+
+class AaioProvider(PaymentProvider):
+    method_id = "aaio"
+
+    _aaio: AaioAsync
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # клиент библиотеки управляет соединениями сам, поэтому общая сессия не используется
+        self._aaio = AaioAsync(config.AAIO_API_KEY, config.AAIO_SHOP_ID, config.AAIO_KEY1)
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        try:
+            url = await self._aaio.generatepaymenturl(invoice_info.amount, invoice_info.invoice_id, desc=invoice_info.comment)
+        except Exception as ex:
+            raise PaymentSystemError("aaio") from ex
+        return ProviderInvoice(url)
+
+    @staticmethod
+    def _get_webhook_sign(shop_id: str, amount: str, currency: str, key2: str, invoice_id: str):
+        return hashlib.sha256(f"{shop_id}:{amount}:{currency}:{key2}:{invoice_id}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def check_sign(sign: str, amount: str, currency: str, invoice_id: str) -> bool:
+        s = AaioProvider._get_webhook_sign(config.AAIO_SHOP_ID, amount, currency, config.AAIO_KEY2, invoice_id)
+        return hmac.compare_digest(s.encode("utf-8"), sign.encode("utf-8"))
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        form = _parse_form(raw.body)
+        if form is None or not all(form.get(field) for field in ("amount", "currency", "order_id", "sign")):
+            return False
+        return self.check_sign(form["sign"], form["amount"], form["currency"], form["order_id"])
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        form = _parse_form(raw.body)
+        # aaio отправляет вебхук только об успешной оплате
+        return WebhookEvent(form["order_id"], form["invoice_id"], "success", InvoiceStatus.SUCCESS,
+                            credited=float(form["profit"]), provider_invoice_id=form["invoice_id"])
+
+    def webhook_ack(self) -> Response:
+        return JSONResponse(None)
+
+
+def _parse_form(body: bytes) -> dict[str, str] | None:
+    try:
+        return dict(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True, strict_parsing=True))
+    except (UnicodeDecodeError, ValueError):
+        return None
@@ -0,0 +1,122 @@
+"""
+Базовый класс адаптера платежной системы.
+"""
+import datetime
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TYPE_CHECKING
+
+import aiohttp
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+import config
+from apis.sessions import ProviderSessions
+from circuit_breaker import ProviderGuard
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from webhook_dedup import WebhookDeduplicator
+
+if TYPE_CHECKING:
+    from invoice_manager import InvoiceManager
+    from webhook_queue import WebhookIngestQueue
+
+
+@dataclass
+class ProviderInvoice:
+    """
+    Счет, созданный в платежной системе.
+    """
+    payment_url: str
+    provider_invoice_id: str | None = None    # ID счета в платежной системе
+    status: InvoiceStatus = InvoiceStatus.PROCESSING
+
+
+@dataclass
+class RawWebhook:
+    """
+    Вебхук в том виде, в котором он пришел: подпись проверяется по этим байтам до любого разбора.
+    """
+    body: bytes
+    query: str    # строка запроса без "?"
+    headers: dict[str, str]    # имена заголовков в нижнем регистре
+
+
+@dataclass
+class WebhookEvent:
+    """
+    Разобранный вебхук платежной системы.
+    """
+    invoice_id: str    # ID счета в сервисе
+    event_id: str    # ID, по которому платежная система повторяет вебхук; вместе с event_status - ключ дедупликации
+    event_status: str
+    status: InvoiceStatus | None    # новый статус счета. None - вебхук не меняет счет (например, возврат)
+    credited: float | None = None
+    payed: datetime.datetime | None = None
+    provider_invoice_id: str | None = None    # ID счета в платежной системе, если его нужно сохранить
+
+
+@dataclass
+class WebhookContext:
+    """
+    Все, что нужно обработчикам вебхуков платежных систем.
+    """
+    invoice_manager: "InvoiceManager"
+    dedup: WebhookDeduplicator
+    # вызывается после оплаты счета и при повторах вебхука об оплате (отправка вебхука клиенту). Должен быть идемпотентным
+    on_invoice_payed: Callable[[InvoiceInfo], Awaitable[None]]
+    queue: "WebhookIngestQueue | None" = None    # если задана, вебхуки применяются фоновыми обработчиками, а не при приеме
+
+
+class PaymentProvider:
+    """
+    Адаптер платежной системы: создание счетов и прием вебхуков.
+    """
+    method_id: str
+    guarded: bool = True    # False - счет создается без запросов к внешнему API, bulkhead и circuit breaker не нужны
+
+    guard: ProviderGuard | None
+
+    _sessions: ProviderSessions
+
+    def __init__(self, sessions: ProviderSessions):
+        self._sessions = sessions
+        self.guard = None
+        if self.guarded:
+            self.guard = ProviderGuard(self.method_id,
+                                       max_concurrency=getattr(config, "PROVIDER_MAX_CONCURRENCY", 20),
+                                       timeout=getattr(config, "PROVIDER_CALL_TIMEOUT", 15),
+                                       open_seconds=getattr(config, "PROVIDER_CIRCUIT_OPEN_SECONDS", 30))
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._sessions.get(self.method_id)
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        raise NotImplementedError
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        """
+        Проверяет подпись вебхука по исходным байтам запроса. Вызывается до разбора тела.
+        """
+        raise NotImplementedError
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        """
+        Разбирает вебхук с проверенной подписью. При некорректном содержимом выбрасывает ValueError или KeyError.
+        """
+        raise NotImplementedError
+
+    # True - у платежной системы есть API статуса счета, и счета с потерянными вебхуками сверяются через fetch_status_async
+    status_check: bool = False
+
+    async def fetch_status_async(self, invoice_info: InvoiceInfo) -> WebhookEvent | None:
+        """
+        Запрашивает статус счета в платежной системе. Результат применяется так же, как вебхук.
+        :return: None, если счет еще не оплачен и не отклонен
+        """
+        raise NotImplementedError
+
+    def webhook_ack(self) -> Response:
+        """
+        Ответ, после которого платежная система перестает повторять вебхук.
+        """
+        return JSONResponse({"success": True})
@@ -0,0 +1,13 @@
+"""
+Способы оплаты без интеграции: плательщик перенаправляется на delegate_url способа оплаты.
+"""
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from providers.base import PaymentProvider, ProviderInvoice
+
+
+class DelegateProvider(PaymentProvider):
+    method_id = "delegate"
+    guarded = False
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        return ProviderInvoice(method.delegate_url, status=InvoiceStatus.DELEGATED)
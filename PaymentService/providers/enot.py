@@ -0,0 +1,75 @@
+"""
+Адаптер enot.io
+"""
+import hashlib
+import hmac
+
+import config
+from apis import enot
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from invoice_manager import PaymentSystemError
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookEvent
+
+
+# статус enot -> статус счета. Остальные статусы (created, refund) не меняют счет
+_STATUSES = {
+    enot.EnotWebhookStatus.success.value: InvoiceStatus.SUCCESS,
+    enot.EnotWebhookStatus.expired.value: InvoiceStatus.TIMEOUT,
+    enot.EnotWebhookStatus.fail.value: InvoiceStatus.ERROR,
+}
+
+
+class EnotProvider(PaymentProvider):
+    method_id = "enot"
+    status_check = True
+
+    _webhook_hmac: "hmac.HMAC"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # ключ HMAC подготавливается один раз, для каждого вебхука используется его копия
+        self._webhook_hmac = hmac.new(config.ENOT_WEBHOOK_KEY.encode("utf-8"), digestmod=hashlib.sha256)
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        try:
+            enot_invoice_info = await enot.create_invoice_async(
+                shop_id=config.ENOT_SHOP_ID,
+                secret_key=config.ENOT_SECRET_KEY,
+                amount=invoice_info.amount,
+                order_id=invoice_info.invoice_id,
+                hook_url=config.ENOT_WEBHOOK_URL,
+                comment=invoice_info.comment,
+                success_url=config.SUCCESS_URL,
+                fail_url=config.FAILED_URL,
+                session=self.session,
+                api_url=getattr(config, "ENOT_API_URL", enot.API_URL),
+            )
+        except enot.APIError as e:
+            raise PaymentSystemError("enot") from e
+        return ProviderInvoice(enot_invoice_info.url, enot_invoice_info.invoice_id)
+
+    async def fetch_status_async(self, invoice_info: InvoiceInfo) -> WebhookEvent | None:
+        try:
+            info = await enot.get_invoice_info_async(config.ENOT_SHOP_ID, config.ENOT_SECRET_KEY,
+                                                     invoice_id=invoice_info.payment_method_invoice_id,
+                                                     order_id=invoice_info.invoice_id,
+                                                     session=self.session,
+                                                     api_url=getattr(config, "ENOT_API_URL", enot.API_URL))
+        except enot.APIError as e:
+            raise PaymentSystemError("enot") from e
+        status = _STATUSES.get(info.status)
+        if status is None:
+            return None
+        # ключ дедупликации тот же, что у вебхука, поэтому опоздавший вебхук не обрабатывается повторно
+        return WebhookEvent(info.order_id, info.invoice_id, info.status, status, credited=info.credited, payed=info.pay_time,
+                            provider_invoice_id=info.invoice_id)
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        return enot.check_signature(raw.body, raw.headers.get("x-api-sha256-signature", ""), self._webhook_hmac)
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        webhook = enot.EnotWebhook.model_validate_json(raw.body)
+        # возвраты не меняют статус счета
+        return WebhookEvent(webhook.order_id, webhook.invoice_id, webhook.status.value, _STATUSES.get(webhook.status.value),
+                            credited=float(webhook.credited) if webhook.credited else None,
+                            payed=webhook.pay_time, provider_invoice_id=webhook.invoice_id)
@@ -0,0 +1,78 @@
+"""
+Адаптер lava.ru (Business API)
+"""
+import datetime
+import hashlib
+import hmac
+import logging
+from typing import Optional
+
+from lava_api.business import LavaBusinessAPI, CreateInvoiceException
+from pydantic import BaseModel
+
+import config
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from invoice_manager import PaymentSystemError
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookEvent
+
+
+logger = logging.getLogger("payment_api_logger")
+
+
+class LavaWebhook(BaseModel):
+    invoice_id: str
+    order_id: str
+    status: str
+    pay_time: str
+    amount: float
+    custom_fields: Optional[str | None] = None
+    credited: float
+
+
+class LavaProvider(PaymentProvider):
+    method_id = "lava"
+
+    _lava: LavaBusinessAPI
+    _webhook_hmac: "hmac.HMAC"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # клиент библиотеки управляет соединениями сам, поэтому общая сессия не используется
+        self._lava = LavaBusinessAPI(config.LAVA_SECRET_KEY)
+        # ключ HMAC подготавливается один раз, для каждого вебхука используется его копия
+        self._webhook_hmac = hmac.new(config.LAVA_WEBHOOK_KEY.encode("utf-8"), digestmod=hashlib.sha256)
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        try:
+            lava_invoice_info = await self._lava.create_invoice(invoice_info.amount, config.LAVA_SHOP_ID,
+                                                                order_id=invoice_info.invoice_id,
+                                                                comment=invoice_info.comment,
+                                                                webhook_url=config.LAVA_WEBHOOK_URL,
+                                                                success_url=config.SUCCESS_URL,
+                                                                fail_url=config.FAILED_URL)
+        except CreateInvoiceException as ex:
+            raise PaymentSystemError("lava") from ex
+        return ProviderInvoice(lava_invoice_info.url, lava_invoice_info.invoice_id)
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        # lava подписывает тело вебхука дополнительным ключом магазина и передает подпись в Authorization
+        signature = raw.headers.get("authorization")
+        if not signature:
+            return False
+        mac = self._webhook_hmac.copy()
+        mac.update(raw.body)
+        return hmac.compare_digest(mac.hexdigest().encode("utf-8"), signature.encode("utf-8"))
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        webhook = LavaWebhook.model_validate_json(raw.body)
+
+        pay_time = None
+        try:
+            pay_time = datetime.datetime.strptime(webhook.pay_time, "%Y-%m-%d %H:%M:%S")
+        except ValueError as ex:
+            logger.error("[LAVA WEBHOOK] Failed to parse pay time '%s'", webhook.pay_time, exc_info=ex,
+                         extra={"invoice_id": webhook.order_id, "provider": self.method_id})
+
+        status = InvoiceStatus.SUCCESS if webhook.status == "success" else InvoiceStatus.ERROR
+        return WebhookEvent(webhook.order_id, webhook.invoice_id, webhook.status, status,
+                            credited=webhook.credited, payed=pay_time, provider_invoice_id=webhook.invoice_id)
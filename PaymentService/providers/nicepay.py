@@ -0,0 +1,47 @@
+"""
+Адаптер nicepay.io
+"""
+import urllib.parse
+
+import config
+from apis import nicepay
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from invoice_manager import PaymentSystemError
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookEvent
+
+
+class NicepayProvider(PaymentProvider):
+    method_id = "nicepay"
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        try:
+            nicepay_invoice_info = await nicepay.create_invoice_async(config.NICEPAY_MERCHANT_ID,
+                                                                      config.NICEPAY_SECRET_KEY,
+                                                                      invoice_info.invoice_id,
+                                                                      "customer@untstrong.ru",
+                                                                      invoice_info.amount,
+                                                                      "RUB",
+                                                                      description=invoice_info.comment,
+                                                                      success_url=config.SUCCESS_URL,
+                                                                      fail_url=config.FAILED_URL,
+                                                                      session=self.session,
+                                                                      api_url=getattr(config, "NICEPAY_API_URL", nicepay.API_URL),
+                                                                      )
+        except nicepay.APIError as e:
+            raise PaymentSystemError("nicepay") from e
+        return ProviderInvoice(nicepay_invoice_info.link, nicepay_invoice_info.payment_id)
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        return nicepay.is_hash_valid(config.NICEPAY_SECRET_KEY, _parse_query(raw.query))
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        webhook = nicepay.NicepayWebhook.model_validate(_parse_query(raw.query))
+        if webhook.result == nicepay.WebhookInvoiceStatus.success:
+            return WebhookEvent(webhook.order_id, webhook.payment_id, webhook.result.value, InvoiceStatus.SUCCESS,
+                                credited=float(webhook.profit), provider_invoice_id=webhook.payment_id)
+        return WebhookEvent(webhook.order_id, webhook.payment_id, webhook.result.value, InvoiceStatus.ERROR)
+
+
+def _parse_query(query: str) -> dict[str, str]:
+    # пустые параметры тоже входят в подпись
+    return dict(urllib.parse.parse_qsl(query, keep_blank_values=True))
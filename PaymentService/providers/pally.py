@@ -0,0 +1,67 @@
+"""
+Адаптер pally.info
+"""
+import urllib.parse
+
+import config
+from apis import pally
+from db import InvoiceInfo, InvoiceStatus, PaymentMethod
+from invoice_manager import PaymentSystemError
+from providers.base import PaymentProvider, ProviderInvoice, RawWebhook, WebhookEvent
+
+
+class PallyProvider(PaymentProvider):
+    method_id = "pally"
+    status_check = True
+
+    async def create_invoice_async(self, invoice_info: InvoiceInfo, method: PaymentMethod) -> ProviderInvoice:
+        try:
+            pally_invoice_info = await pally.create_bill_async(
+                config.PALLY_SHOP_ID,
+                config.PALLY_SECRET_KEY,
+                invoice_info.amount,
+                invoice_info.invoice_id,
+                invoice_info.comment,
+                invoice_info.comment,
+                session=self.session,
+                api_url=getattr(config, "PALLY_API_URL", pally.API_URL),
+            )
+        except pally.APIError as e:
+            raise PaymentSystemError("pally") from e
+        return ProviderInvoice(pally_invoice_info.url, pally_invoice_info.id)
+
+    async def fetch_status_async(self, invoice_info: InvoiceInfo) -> WebhookEvent | None:
+        if invoice_info.payment_method_invoice_id is None:
+            return None
+        try:
+            bill = await pally.get_bill_status_async(config.PALLY_SECRET_KEY, invoice_info.payment_method_invoice_id,
+                                                     session=self.session,
+                                                     api_url=getattr(config, "PALLY_API_URL", pally.API_URL))
+        except pally.APIError as e:
+            raise PaymentSystemError("pally") from e
+        # API статуса не возвращает зачисленную сумму, поэтому считается, что зачислена вся сумма счета
+        if bill.status in ("SUCCESS", "OVERPAID"):
+            return WebhookEvent(invoice_info.invoice_id, bill.id, bill.status, InvoiceStatus.SUCCESS)
+        if bill.status == "FAIL":
+            return WebhookEvent(invoice_info.invoice_id, bill.id, bill.status, InvoiceStatus.ERROR)
+        return None
+
+    def verify_webhook(self, raw: RawWebhook) -> bool:
+        form = _parse_form(raw.body)
+        if form is None or not all(form.get(field) for field in ("SignatureValue", "OutSum", "InvId")):
+            return False
+        # подпись считается по значениям в том виде, в котором они пришли, без разбора в Decimal
+        return pally.is_signature_valid(form["SignatureValue"], form["OutSum"], form["InvId"])
+
+    def parse_webhook(self, raw: RawWebhook) -> WebhookEvent:
+        webhook = pally.PostbackForm.model_validate(_parse_form(raw.body))
+        if webhook.Status in ("SUCCESS", "OVERPAID"):
+            return WebhookEvent(webhook.InvId, webhook.TrsId, webhook.Status, InvoiceStatus.SUCCESS, credited=float(webhook.OutSum))
+        return WebhookEvent(webhook.InvId, webhook.TrsId, webhook.Status, InvoiceStatus.ERROR)
+
+
+def _parse_form(body: bytes) -> dict[str, str] | None:
+    try:
+        return dict(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True, strict_parsing=True))
+    except (UnicodeDecodeError, ValueError):
+        return None
@@ -0,0 +1,118 @@
+"""
+Общий прием вебхуков платежных систем: подпись по исходным байтам -> разбор -> переход статуса счета -> ответ.
+
+Подпись проверяется до разбора тела и обращений к БД, поэтому поддельные и мусорные запросы отклоняются сразу.
+Если в контексте задана очередь, вебхук после проверки записывается в нее, и платежной системе отвечается без ожидания БД.
+"""
+import logging
+from typing import Callable
+
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse
+
+import metrics
+from db import InvoiceStatus
+from invoice_manager import InvalidInvoiceError, InvalidInvoiceStatusError
+from providers.base import PaymentProvider, RawWebhook, WebhookContext, WebhookEvent
+
+
+logger = logging.getLogger("payment_api_logger")
+
+# вебхуки платежных систем небольшие, а тело большего размера - признак мусорного запроса
+MAX_BODY_SIZE = 64 * 1024
+
+
+def register_webhooks(router: APIRouter, webhook_path: str, http_method: str, get_provider: Callable[[], PaymentProvider],
+                      context: WebhookContext):
+    """
+    Добавляет в router маршруты вебхуков платежной системы (со слешем в конце и без).
+    :param get_provider: возвращает адаптер платежной системы. Вызывается при каждом вебхуке, поэтому адаптер может загружаться лениво
+    """
+    async def webhook(request: Request) -> Response:
+        return await handle_webhook_async(get_provider(), context, request)
+
+    path = f"/payment_service/{webhook_path}"
+    router.add_api_route(path + "/", webhook, methods=[http_method])
+    router.add_api_route(path, webhook, methods=[http_method])
+
+
+async def handle_webhook_async(provider: PaymentProvider, context: WebhookContext, request: Request) -> Response:
+    with metrics.observe(metrics.WEBHOOK_SECONDS, provider.method_id):
+        content_length = request.headers.get("content-length")
+        if content_length is not None and (not content_length.isdigit() or int(content_length) > MAX_BODY_SIZE):
+            return _reject(provider, "too_large", 413)
+
+        raw = RawWebhook(await request.body(), request.url.query, dict(request.headers))
+        if len(raw.body) > MAX_BODY_SIZE:
+            return _reject(provider, "too_large", 413)
+
+        if not provider.verify_webhook(raw):
+            logger.warning("[%s WEBHOOK] Invalid signature from %s", provider.method_id.upper(), request.client.host if request.client else None,
+                           extra={"provider": provider.method_id})
+            return _reject(provider, "signature", 401)
+
+        try:
+            event = provider.parse_webhook(raw)
+        except (ValueError, KeyError) as ex:
+            logger.warning("[%s WEBHOOK] Failed to parse: %s", provider.method_id.upper(), ex, extra={"provider": provider.method_id})
+            return _reject(provider, "parse", 400)
+
+        if context.queue is not None:
+            try:
+                await context.queue.enqueue_async(provider.method_id, event, raw)
+                return provider.webhook_ack()
+            except Exception as ex:
+                # без Redis вебхук применяется сразу, как без очереди
+                logger.exception("[%s WEBHOOK] Failed to enqueue: %s", provider.method_id.upper(), event.invoice_id, exc_info=ex,
+                                 extra={"provider": provider.method_id, "invoice_id": event.invoice_id})
+
+        return await apply_event_async(provider, context, event)
+
+
+async def apply_event_async(provider: PaymentProvider, context: WebhookContext, event: WebhookEvent) -> Response:
+    """
+    Применяет событие платежной системы к счету и возвращает ответ для нее.
+    """
+    dedup_key = context.dedup.make_key(provider.method_id, event.event_id, event.event_status)
+    if (cached := await context.dedup.get_async(dedup_key)) is not None:
+        return cached
+
+    if event.status is None:
+        return provider.webhook_ack()
+
+    tag = f"[{provider.method_id.upper()} WEBHOOK]"
+    log_fields = {"invoice_id": event.invoice_id, "provider": provider.method_id, "provider_event_id": event.event_id,
+                  "provider_status": event.event_status}
+    try:
+        if event.status == InvoiceStatus.SUCCESS:
+            invoice = await context.invoice_manager.set_invoice_payed_async(event.invoice_id, event.credited, payed=event.payed,
+                                                                            payment_method_invoice_id=event.provider_invoice_id)
+        else:
+            invoice = await context.invoice_manager.set_invoice_status_async(event.invoice_id, event.status)
+    except InvalidInvoiceStatusError as ex:
+        # счет уже в конечном статусе: повторять вебхук бессмысленно, поэтому платежной системе отвечается успехом
+        logger.info("%s Invoice is already closed: %s", tag, ex, extra=log_fields)
+        if event.status != InvoiceStatus.SUCCESS or ex.invoice is None or ex.invoice.status != InvoiceStatus.SUCCESS:
+            return await context.dedup.remember_async(dedup_key, provider.webhook_ack())
+        # счет оплачен, но предыдущая обработка могла прерваться до постановки вебхука клиенту в очередь
+        invoice = ex.invoice
+    except InvalidInvoiceError as ex:
+        logger.error("%s Invoice not found: %s", tag, event.invoice_id, extra=log_fields)
+        return JSONResponse({"success": False, "error": str(ex)}, status_code=404)
+    except Exception as ex:
+        logger.error("%s Failed to handle: %s", tag, event, exc_info=ex, extra=log_fields)
+        return JSONResponse({"success": False, "error": str(ex)}, status_code=500)
+
+    if event.status == InvoiceStatus.SUCCESS and invoice.webhook_url:
+        try:
+            await context.on_invoice_payed(invoice)
+        except Exception:
+            # ответ не запоминается: платежная система повторит вебхук, и вебхук клиенту будет поставлен в очередь повторно
+            return JSONResponse({"success": False, "error": "Failed to enqueue webhook"}, status_code=500)
+
+    return await context.dedup.remember_async(dedup_key, provider.webhook_ack())
+
+
+def _reject(provider: PaymentProvider, reason: str, status_code: int) -> Response:
+    metrics.WEBHOOK_REJECTED.labels(provider.method_id, reason).inc()
+    return JSONResponse({"success": False}, status_code=status_code)
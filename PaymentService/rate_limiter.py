@@ -0,0 +1,115 @@
+"""
+Ограничение частоты запросов на создание и обработку счетов (token bucket в Redis).
+
+У каждого ключа (токен авторизации, IP клиента) своя корзина для каждого вида запросов. Корзина вмещает burst запросов
+и пополняется на rate запросов в секунду. Все корзины запроса проверяются и списываются одним Lua скриптом,
+поэтому лимиты общие для всех экземпляров сервиса, а отклоненный запрос не расходует ни одну из корзин.
+"""
+import hashlib
+import logging
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+
+import metrics
+
+
+@dataclass
+class RateLimit:
+    rate: float    # запросов в секунду
+    burst: int    # сколько запросов можно выполнить подряд после простоя
+
+
+class RateLimitExceededError(Exception):
+    def __init__(self, scope: str, key_type: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded: {scope} by {key_type}")
+        self.scope = scope
+        self.key_type = key_type
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    REDIS_PREFIX = "payment_service:rate_limit:"
+
+    # KEYS - корзины, ARGV[1] - стоимость запроса, далее rate и burst каждой корзины.
+    # Возвращает 0, если запрос разрешен, иначе номер корзины и сколько секунд ждать (строкой: Lua отбрасывает дробную часть чисел).
+    # Время берется у Redis, чтобы расхождение часов экземпляров не влияло на пополнение
+    _TAKE_SCRIPT = """
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local cost = tonumber(ARGV[1])
+    local tokens = {}
+    local limited, wait = 0, 0
+    for i, key in ipairs(KEYS) do
+        local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+        local value = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        value = math.min(burst, value + math.max(0, now - updated) * rate)
+        tokens[i] = value
+        -- запрос дороже всей корзины выполняется, когда она полная, иначе он не выполнился бы никогда
+        local need = math.min(cost, burst)
+        if value < need and (need - value) / rate > wait then
+            limited, wait = i, (need - value) / rate
+        end
+    end
+    if limited > 0 then
+        return {limited, tostring(wait)}
+    end
+    for i, key in ipairs(KEYS) do
+        local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        redis.call('HSET', key, 'tokens', tokens[i] - math.min(cost, burst), 'updated', now)
+        redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+    end
+    return 0
+    """
+
+    _redis: Redis
+    _limits: dict[str, dict[str, RateLimit]]
+    _logger: logging.Logger
+
+    def __init__(self, redis: Redis, limits: dict[str, dict[str, tuple[float, int]]]):
+        """
+        :param limits: вид запросов ("create", "process") -> тип ключа ("token", "ip") -> (rate, burst).
+            Виды запросов и типы ключей, которых нет в limits, не ограничиваются
+        """
+        self._redis = redis
+        self._limits = {scope: {key_type: RateLimit(*limit) for key_type, limit in scope_limits.items()}
+                        for scope, scope_limits in limits.items()}
+        self._logger = logging.getLogger("payment_api_logger")
+        self._take = self._redis.register_script(self._TAKE_SCRIPT)
+
+    async def check_async(self, scope: str, keys: dict[str, str | None], cost: int = 1):
+        """
+        Списывает cost запросов из корзин всех ключей запроса.
+        :param keys: тип ключа -> значение. Ключи со значением None не проверяются
+        :raises RateLimitExceededError: если в какой-то корзине недостаточно запросов. Тогда не списывается ни из одной
+        """
+        limits = [(key_type, self._limits[scope][key_type], value) for key_type, value in keys.items()
+                  if value is not None and key_type in self._limits.get(scope, {})]
+        if not limits:
+            return
+
+        redis_keys = [self._make_key(scope, key_type, value) for key_type, _, value in limits]
+        args = [cost]
+        for _, limit, _ in limits:
+            args += [limit.rate, limit.burst]
+        try:
+            result = await self._take(keys=redis_keys, args=args)
+        except Exception as ex:
+            # без Redis запросы не ограничиваются: отказывать всем клиентам хуже, чем пропустить всплеск
+            self._logger.exception("Failed to check rate limit: %s", scope, exc_info=ex)
+            return
+
+        if result == 0:
+            return
+        key_type = limits[int(result[0]) - 1][0]
+        metrics.RATE_LIMITED_REQUESTS.labels(scope, key_type).inc()
+        raise RateLimitExceededError(scope, key_type, float(result[1]))
+
+    def _make_key(self, scope: str, key_type: str, value: str) -> str:
+        # токены авторизации не хранятся в Redis в открытом виде
+        if key_type == "token":
+            value = hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+        return f"{self.REDIS_PREFIX}{scope}:{key_type}:{value}"
+
@@ -0,0 +1,31 @@
+"""
+Вспомогательные функции для работы с Redis Streams.
+"""
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+
+StreamEntry = tuple[bytes, dict[bytes, bytes]]
+
+
+async def ensure_group_async(redis: Redis, stream: str, group: str):
+    """
+    Создает группу потребителей (и сам поток, если его еще нет). Повторный вызов ничего не делает.
+    """
+    try:
+        await redis.xgroup_create(stream, group, id="0", mkstream=True)
+    except ResponseError as ex:
+        if "BUSYGROUP" not in str(ex):
+            raise
+
+
+def read_entries(response) -> list[StreamEntry]:
+    """
+    Приводит ответ XREAD/XREADGROUP к списку записей.
+    В RESP3 ответ - словарь {поток: [[записи]]}, в RESP2 - список [[поток, [записи]]].
+    """
+    if not response:
+        return []
+    if isinstance(response, dict):
+        return [entry for chunks in response.values() for chunk in chunks for entry in chunk]
+    return [entry for _, entries in response for entry in entries]
@@ -0,0 +1,24 @@
+"""
+Общие настройки тестов. Тесты не требуют MySQL и Redis: Redis заменяется fakeredis, БД - заглушками.
+Команда для запуска из папки PaymentService: python -m pytest tests
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+# config.py сервиса не хранится в репозитории, поэтому тесты используют конфигурацию бенчмарка
+_spec = importlib.util.spec_from_file_location("config", os.path.join(SERVICE_DIR, "benchmarks", "config.py"))
+config = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(config)
+sys.modules["config"] = config
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
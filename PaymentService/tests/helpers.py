@@ -0,0 +1,92 @@
+"""
+Общие заглушки для тестов.
+"""
+import asyncio
+import datetime
+
+from db import DatabaseManager, InvoiceInfo, InvoiceStatus
+
+
+def make_invoice(invoice_id: str = "i1", status: InvoiceStatus = InvoiceStatus.CREATED, webhook_url: str = "http://client/hook",
+                 payment_method: str | None = None) -> InvoiceInfo:
+    return InvoiceInfo(invoice_id, status, 100.0, 0.0, datetime.datetime(2024, 1, 1), None, "comment", "{}", webhook_url,
+                       payment_method, "http://pay", None)
+
+
+def invoice_row(invoice: InvoiceInfo) -> tuple:
+    """
+    Строка таблицы invoices, как ее возвращает aiomysql.
+    """
+    return (invoice.invoice_id, invoice.status.value, invoice.amount, invoice.credited, invoice.created, invoice.payed,
+            invoice.comment, invoice.custom_fields, invoice.webhook_url, invoice.payment_method, invoice.payment_url,
+            invoice.payment_method_invoice_id)
+
+
+class FakeCursor:
+    def __init__(self, connection: "FakeConnection"):
+        self._connection = connection
+        self.rowcount = 0
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, query: str, params=None):
+        self._connection.queries.append((query, params))
+        self.rowcount, self._rows = self._connection.handler(query, params)
+
+    async def fetchall(self):
+        return tuple(self._rows)
+
+    async def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class FakeConnection:
+    """
+    Соединение aiomysql, ответы которого задаются функцией handler(query, params) -> (rowcount, rows).
+    Выполненные запросы сохраняются в queries.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.queries = []
+
+    @property
+    def last_usage(self) -> float:
+        # соединение только что использовалось, поэтому DatabaseManager не проверяет его через ping
+        return asyncio.get_running_loop().time()
+
+    def cursor(self, *args) -> FakeCursor:
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+
+    async def acquire(self) -> FakeConnection:
+        return self.connection
+
+    def release(self, conn: FakeConnection):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def make_database(handler, cache=None, **kwargs) -> DatabaseManager:
+    """
+    DatabaseManager, запросы которого выполняет FakeConnection с заданным handler.
+    """
+    database = DatabaseManager("localhost", "user", "password", "db", cache=cache, **kwargs)
+    database._pool = FakePool(FakeConnection(handler))
+    return database
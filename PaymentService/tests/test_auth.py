@@ -0,0 +1,43 @@
+"""
+Авторизация служебных запросов токеном из заголовка Authorization.
+"""
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+import config
+import main
+from helpers import make_invoice
+
+
+@pytest.fixture
+def client() -> TestClient:
+    return TestClient(main.app)
+
+
+AUTH = {"Authorization": f"Bearer {config.AUTH_TOKEN}"}
+
+
+@pytest.mark.parametrize("path", ["/payment_service/invoices/by_provider/enot/p1",
+                                  "/payment_service/invoices/by_provider/enot/p1/"])
+def test_by_provider_accepts_header_token(client: TestClient, path: str):
+    with mock.patch.object(main.db, "get_invoice_by_provider_id_async", mock.AsyncMock(return_value=make_invoice())):
+        response = client.get(path, headers=AUTH)
+    assert response.status_code == 200
+    assert response.json()["invoice_id"] == "i1"
+
+
+@pytest.mark.parametrize("path", ["/payment_service/invoices/by_provider/enot/p1",
+                                  "/payment_service/invoices",
+                                  "/payment_service/stats?since=2024-01-01&until=2024-02-01",
+                                  "/payment_service/invoices/export?created_from=2024-01-01&created_to=2024-02-01"])
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong"}, {"Authorization": config.AUTH_TOKEN}],
+                         ids=["missing", "wrong", "no_scheme"])
+def test_rejects_missing_or_wrong_token(client: TestClient, path: str, headers: dict):
+    assert client.get(path, headers=headers).status_code == 403
+
+
+def test_query_token_is_not_accepted(client: TestClient):
+    response = client.get(f"/payment_service/invoices?user_token={config.AUTH_TOKEN}")
+    assert response.status_code == 403
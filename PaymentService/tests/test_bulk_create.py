@@ -0,0 +1,71 @@
+"""
+Создание нескольких счетов одним запросом.
+"""
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+import config
+import main
+from helpers import make_invoice
+
+
+URL = "/payment_service/create_invoices"
+AUTH = {"Authorization": f"Bearer {config.AUTH_TOKEN}"}
+
+
+@pytest.fixture
+def client() -> TestClient:
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def rate_limit():
+    with mock.patch.object(main.rate_limiter, "check_async", mock.AsyncMock()) as check:
+        yield check
+
+
+@pytest.fixture
+def create_invoices():
+    async def create(requests):
+        return [make_invoice(f"i{i}") for i in range(len(requests))]
+
+    with mock.patch.object(main.invoice_manager, "create_invoices_async", mock.AsyncMock(side_effect=create)) as create_mock:
+        yield create_mock
+
+
+def test_token_is_checked_once_per_batch(client, rate_limit, create_invoices):
+    response = client.post(URL, json=[{"amount": 100}, {"amount": 200}], headers=AUTH)
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "success"
+    assert [item["id"] for item in response.json()["invoices"]] == ["i0", "i1"]
+    assert rate_limit.await_args.args[2] == 2
+
+
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong"}], ids=["missing", "wrong"])
+def test_invalid_token_rejects_batch(client, rate_limit, create_invoices, headers):
+    response = client.post(URL, json=[{"amount": 100, "user_token": config.AUTH_TOKEN}], headers=headers)
+
+    assert response.status_code == 403
+    create_invoices.assert_not_awaited()
+    # лимит проверяется до токена и расходуется как один счет
+    assert rate_limit.await_args.args[1]["token"] is None
+    assert rate_limit.await_args.args[2] == 1
+
+
+def test_partial_failure_is_reported(client, rate_limit, create_invoices):
+    response = client.post(URL, json=[{"amount": 100}, {"amount": "many"}], headers=AUTH)
+
+    assert response.json()["status"] == "partial"
+    assert [item["status"] for item in response.json()["invoices"]] == ["success", "error"]
+    assert rate_limit.await_args.args[2] == 1
+
+
+def test_all_items_failed(client, rate_limit, create_invoices):
+    response = client.post(URL, json=[{"amount": "many"}, {"comment": "no amount"}], headers=AUTH)
+
+    assert response.json()["status"] == "error"
+    assert [item["code"] for item in response.json()["invoices"]] == ["422", "422"]
+    create_invoices.assert_not_awaited()
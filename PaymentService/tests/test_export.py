@@ -0,0 +1,115 @@
+"""
+Выгрузка счетов: лимит одновременных выгрузок и закрытие их соединений.
+"""
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+import config
+import db
+import main
+from helpers import invoice_row, make_database, make_invoice
+
+
+pytestmark = pytest.mark.anyio
+
+AUTH = {"Authorization": f"Bearer {config.AUTH_TOKEN}"}
+
+
+class _ExportConnection:
+    """
+    Соединение aiomysql с SSCursor, возвращающее rows порциями.
+    """
+    def __init__(self, rows: list[tuple]):
+        self.rows = list(rows)
+        self.closed = False
+
+    async def cursor(self):
+        return self
+
+    async def execute(self, query, params):
+        pass
+
+    async def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+def _rows(count: int) -> list[tuple]:
+    return [invoice_row(make_invoice(f"i{i}")) for i in range(count)]
+
+
+async def _stream(database, rows: list[tuple] | None = None) -> tuple[db.InvoiceStream, _ExportConnection]:
+    conn = _ExportConnection(rows or [])
+    with mock.patch.object(db.aiomysql, "connect", mock.AsyncMock(return_value=conn)):
+        stream = await database.stream_invoices_async(None, None, batch_size=2)
+    return stream, conn
+
+
+async def test_export_limit():
+    database = make_database(None, export_max_concurrent=2)
+    first, first_conn = await _stream(database)
+    await _stream(database)
+
+    with pytest.raises(db.ExportLimitExceededError):
+        await _stream(database)
+
+    # выгрузка, которую не начали читать, освобождает место только после close_async
+    await first.close_async()
+    await first.close_async()
+    assert first_conn.closed
+    await _stream(database)
+
+
+async def test_stream_closes_connection_after_last_batch():
+    database = make_database(None, export_max_concurrent=1)
+    stream, conn = await _stream(database, _rows(3))
+
+    batches = [[invoice.invoice_id for invoice in batch] async for batch in stream]
+
+    assert batches == [["i0", "i1"], ["i2"]]
+    assert conn.closed
+    await _stream(database)
+
+
+async def test_failed_connect_releases_slot():
+    database = make_database(None, export_max_concurrent=1)
+    with mock.patch.object(db.aiomysql, "connect", mock.AsyncMock(side_effect=OSError())):
+        with pytest.raises(OSError):
+            await database.stream_invoices_async(None, None)
+    await _stream(database)
+
+
+async def test_response_closes_stream_when_client_disconnects_before_reading():
+    database = make_database(None, export_max_concurrent=1)
+    stream, conn = await _stream(database, _rows(3))
+    response = main.ExportResponse(stream, main.export_invoices_csv(stream), media_type="text/csv")
+
+    async def send(message):
+        raise OSError("connection reset")
+
+    with pytest.raises(Exception):
+        await response({"type": "http", "asgi": {"spec_version": "2.4"}}, mock.AsyncMock(), send)
+
+    assert conn.closed
+
+
+def test_export_endpoint():
+    url = "/payment_service/invoices/export?created_from=2024-01-01&created_to=2024-02-01"
+    client = TestClient(main.app)
+    conn = _ExportConnection(_rows(3))
+
+    with mock.patch.object(db.aiomysql, "connect", mock.AsyncMock(return_value=conn)):
+        response = client.get(url, headers=AUTH)
+    assert response.status_code == 200
+    assert response.text.count("\n") == 4
+    assert conn.closed
+
+    with mock.patch.object(main.db, "stream_invoices_async", mock.AsyncMock(side_effect=db.ExportLimitExceededError(2))):
+        response = client.get(url, headers=AUTH)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
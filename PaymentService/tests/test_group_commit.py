@@ -0,0 +1,61 @@
+"""
+Group commit: счета, созданные в течение окна, сохраняются одним INSERT.
+"""
+import asyncio
+
+import pymysql
+import pytest
+
+from helpers import make_database, make_invoice
+
+
+pytestmark = pytest.mark.anyio
+
+
+def _inserted_rows(database) -> list[int]:
+    return [len(params) // 12 for query, params in database._pool.connection.queries if query.startswith("INSERT INTO invoices")]
+
+
+async def test_invoices_in_window_share_one_insert():
+    database = make_database(lambda query, params: (1, []), group_commit_window=0.01)
+
+    await asyncio.gather(*(database.insert_invoice_async(make_invoice(f"i{i}")) for i in range(3)))
+
+    assert _inserted_rows(database) == [3]
+
+
+async def test_max_batch_flushes_without_waiting():
+    database = make_database(lambda query, params: (1, []), group_commit_window=60, group_commit_max_batch=2)
+
+    await asyncio.wait_for(asyncio.gather(*(database.insert_invoice_async(make_invoice(f"i{i}")) for i in range(2))), 1)
+
+    assert _inserted_rows(database) == [2]
+
+
+async def test_bad_row_fails_only_its_own_invoice():
+    def handler(query, params):
+        if "bad" in params:
+            raise pymysql.err.DataError(1406, "Data too long")
+        return 1, []
+
+    database = make_database(handler, group_commit_window=0.01)
+
+    results = await asyncio.gather(*(database.insert_invoice_async(make_invoice(invoice_id)) for invoice_id in ("i1", "bad", "i2")),
+                                   return_exceptions=True)
+
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], pymysql.err.DataError)
+    # общий INSERT отклонен, затем счета сохранены по одному
+    assert _inserted_rows(database) == [3, 1, 1, 1]
+
+
+async def test_connection_error_fails_whole_batch():
+    def handler(query, params):
+        raise pymysql.err.OperationalError(2013, "Lost connection")
+
+    database = make_database(handler, group_commit_window=0.01)
+
+    results = await asyncio.gather(*(database.insert_invoice_async(make_invoice(f"i{i}")) for i in range(2)), return_exceptions=True)
+
+    assert all(isinstance(result, pymysql.err.OperationalError) for result in results)
+    assert _inserted_rows(database) == [2]
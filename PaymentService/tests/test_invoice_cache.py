@@ -0,0 +1,72 @@
+"""
+Кэширование счетов в Redis: изменения записывают в кэш новую версию, чтение из БД не заменяет ее старой.
+"""
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from db import DatabaseManager, InvoiceStatus
+from helpers import invoice_row, make_database, make_invoice
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def _cached_status(redis, invoice_id: str = "i1") -> InvoiceStatus | None:
+    data = await redis.get(DatabaseManager.CACHE_PREFIX + invoice_id)
+    return DatabaseManager._deserialize_invoice(data).status if data is not None else None
+
+
+async def test_transition_writes_new_row_to_cache():
+    redis = FakeAsyncRedis()
+    stored = make_invoice(status=InvoiceStatus.CREATED)
+
+    def handler(query, params):
+        if query.startswith("UPDATE"):
+            stored.status = InvoiceStatus.PROCESSING
+            return 1, []
+        return 1, [invoice_row(stored)]
+
+    database = make_database(handler, cache=redis)
+    await database._cache_invoices_async([make_invoice(status=InvoiceStatus.CREATED)])
+
+    transition = await database.transition_invoice_async("i1", [InvoiceStatus.CREATED], InvoiceStatus.PROCESSING)
+
+    assert transition.applied
+    assert await _cached_status(redis) == InvoiceStatus.PROCESSING
+    # следующее чтение обслуживается кэшем, без запроса к БД
+    queries = len(database._pool.connection.queries)
+    assert (await database.get_invoice_info_async("i1")).status == InvoiceStatus.PROCESSING
+    assert len(database._pool.connection.queries) == queries
+
+
+async def test_stale_read_does_not_overwrite_transition():
+    redis = FakeAsyncRedis()
+    stale = make_invoice(status=InvoiceStatus.CREATED)
+    fresh = make_invoice(status=InvoiceStatus.PROCESSING)
+    database = make_database(lambda query, params: (1, [invoice_row(fresh)]), cache=redis)
+
+    await database.transition_invoice_async("i1", [InvoiceStatus.CREATED], InvoiceStatus.PROCESSING)
+    # запрос, прочитавший счет из БД до перехода, кладет его в кэш позже
+    await database._cache_invoices_async([stale], only_missing=True)
+
+    assert await _cached_status(redis) == InvoiceStatus.PROCESSING
+
+
+async def test_save_writes_through():
+    redis = FakeAsyncRedis()
+    database = make_database(lambda query, params: (1, []), cache=redis)
+    await database._cache_invoices_async([make_invoice(status=InvoiceStatus.CREATED)])
+
+    await database.save_invoice_info_async(make_invoice(status=InvoiceStatus.SUCCESS))
+
+    assert await _cached_status(redis) == InvoiceStatus.SUCCESS
+
+
+async def test_expired_invoice_is_not_cached_from_stale_read():
+    redis = FakeAsyncRedis()
+    database = make_database(lambda query, params: (1, []), cache=redis)
+
+    await database._invalidate_cached_invoices_async(["i1"])
+    await database._cache_invoices_async([make_invoice(status=InvoiceStatus.CREATED)], only_missing=True)
+
+    assert await database._get_cached_invoice_async("i1") is None
@@ -0,0 +1,27 @@
+"""
+Фоновые задачи сервиса.
+"""
+from unittest import mock
+
+import pytest
+
+from db import InvoiceStatus
+from jobs import InvoiceExpirySweeper
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_expiry_sweeper_notifies_when_stats_fail():
+    db_manager = mock.Mock(expire_invoices_async=mock.AsyncMock(side_effect=[["i1", "i2"], ["i3"]]),
+                           increment_stats_async=mock.AsyncMock(side_effect=ConnectionError()))
+    catalogue = mock.Mock(get_all_async=mock.AsyncMock(return_value=[]))
+    notifier = mock.Mock(notify_many_async=mock.AsyncMock())
+    sweeper = InvoiceExpirySweeper(mock.Mock(), db_manager, catalogue, chunk_size=2, notifier=notifier)
+
+    await sweeper.run_once_async()
+
+    # ошибка статистики не прерывает ни уведомления, ни следующую порцию
+    assert db_manager.expire_invoices_async.await_count == 2
+    notifier.notify_many_async.assert_has_awaits([mock.call(["i1", "i2"], InvoiceStatus.TIMEOUT),
+                                                  mock.call(["i3"], InvoiceStatus.TIMEOUT)])
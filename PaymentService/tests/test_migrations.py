@@ -0,0 +1,61 @@
+"""
+Применение миграций схемы при запуске сервиса.
+"""
+import pymysql
+import pytest
+
+from db import DatabaseManager
+from helpers import make_database
+
+
+pytestmark = pytest.mark.anyio
+
+
+def _handler(lock_result: int | None = 1, applied: tuple = (), existing_indexes: tuple = ()):
+    def handler(query, params):
+        if query.startswith("SELECT GET_LOCK"):
+            return 1, [(lock_result, )]
+        if query.startswith("SELECT version"):
+            return len(applied), [(v, ) for v in applied]
+        if any(f"INDEX {name} " in query for name in existing_indexes):
+            raise pymysql.err.OperationalError(1061, "Duplicate key name")
+        return 0, []
+    return handler
+
+
+def _recorded_versions(database) -> list[int]:
+    return [params[0] for query, params in database._pool.connection.queries if query.startswith("INSERT INTO schema_migrations")]
+
+
+async def test_existing_index_is_marked_applied():
+    database = make_database(_handler(applied=(1, ), existing_indexes=("ix_invoices_status_created", )))
+
+    await database.create_tables_async()
+
+    assert _recorded_versions(database) == [version for version, _ in DatabaseManager._MIGRATIONS[1:]]
+    assert database._pool.connection.queries[-1][0].startswith("SELECT RELEASE_LOCK")
+
+
+async def test_migrations_are_not_applied_without_lock():
+    database = make_database(_handler(lock_result=0))
+
+    with pytest.raises(RuntimeError):
+        await database.create_tables_async()
+
+    queries = [query for query, _ in database._pool.connection.queries]
+    assert not any(query.startswith(("CREATE INDEX", "RELEASE_LOCK", "SELECT RELEASE_LOCK")) for query in queries)
+
+
+async def test_other_migration_errors_are_raised():
+    def handler(query, params):
+        if query.startswith("CREATE INDEX"):
+            raise pymysql.err.OperationalError(1146, "Table doesn't exist")
+        return _handler()(query, params)
+
+    database = make_database(handler)
+
+    with pytest.raises(pymysql.err.OperationalError):
+        await database.create_tables_async()
+
+    assert _recorded_versions(database) == []
+    assert database._pool.connection.queries[-1][0].startswith("SELECT RELEASE_LOCK")
@@ -0,0 +1,45 @@
+"""
+Статистика, накопленная add_stats, сохраняется в БД одним запросом вне обработки счета.
+"""
+import datetime
+
+import pytest
+
+from helpers import make_database
+
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_add_stats_is_buffered_and_merged():
+    database = make_database(lambda query, params: (1, []), stats_flush_interval=60)
+    connection = database._pool.connection
+    moment = datetime.datetime(2024, 1, 1, 12, 30)
+
+    database.add_stats(moment, "enot", processing=1)
+    database.add_stats(moment, "enot", paid=1, amount=100, credited=95)
+    database.add_stats(moment.replace(hour=13), "enot", failed=1)
+    assert connection.queries == []
+
+    database._flush_pending_stats()
+    await database.close_async()
+
+    assert len(connection.queries) == 1
+    query, params = connection.queries[0]
+    rows = {tuple(params[i:i + 3]): params[i + 3:i + 10] for i in range(0, len(params), 10)}
+    assert rows[("hour", datetime.datetime(2024, 1, 1, 12), "enot")] == [0, 1, 1, 0, 0, 100, 95]
+    assert rows[("hour", datetime.datetime(2024, 1, 1, 13), "enot")] == [0, 0, 0, 1, 0, 0, 0]
+    # дневная строка объединяет оба часа
+    assert rows[("day", datetime.datetime(2024, 1, 1), "enot")] == [0, 1, 1, 1, 0, 100, 95]
+
+
+async def test_stats_write_failure_is_logged(caplog):
+    def handler(query, params):
+        raise ConnectionError()
+
+    database = make_database(handler)
+    database.add_stats(datetime.datetime(2024, 1, 1), None, created=1)
+    database._flush_pending_stats()
+    # ошибка не передается в обработку счетов и в close_async
+    await database.close_async()
+    assert "Failed to update payment statistics" in caplog.text
@@ -0,0 +1,77 @@
+"""
+Ограничение частоты запросов: token bucket в Lua скрипте Redis.
+"""
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from rate_limiter import RateLimiter, RateLimitExceededError
+
+
+pytestmark = pytest.mark.anyio
+
+
+def _limiter(redis, **limits) -> RateLimiter:
+    return RateLimiter(redis, {"create": limits})
+
+
+async def test_burst_then_limited():
+    limiter = _limiter(FakeAsyncRedis(), ip=(1, 3))
+
+    for _ in range(3):
+        await limiter.check_async("create", {"ip": "1.1.1.1"})
+    with pytest.raises(RateLimitExceededError) as ex:
+        await limiter.check_async("create", {"ip": "1.1.1.1"})
+
+    assert ex.value.key_type == "ip"
+    assert 0 < ex.value.retry_after <= 1
+    # корзины разных ключей независимы
+    await limiter.check_async("create", {"ip": "2.2.2.2"})
+
+
+async def test_rejected_request_does_not_spend_other_buckets():
+    redis = FakeAsyncRedis()
+    limiter = _limiter(redis, ip=(1, 10), token=(1, 1))
+
+    await limiter.check_async("create", {"ip": "1.1.1.1", "token": "t"})
+    with pytest.raises(RateLimitExceededError) as ex:
+        await limiter.check_async("create", {"ip": "1.1.1.1", "token": "t"})
+
+    assert ex.value.key_type == "token"
+    tokens = await redis.hget(limiter._make_key("create", "ip", "1.1.1.1"), "tokens")
+    assert float(tokens) == pytest.approx(9, abs=0.01)
+
+
+async def test_cost_larger_than_burst_needs_full_bucket():
+    limiter = _limiter(FakeAsyncRedis(), token=(1, 5))
+
+    await limiter.check_async("create", {"token": "t"}, cost=100)
+    with pytest.raises(RateLimitExceededError) as ex:
+        await limiter.check_async("create", {"token": "t"}, cost=100)
+
+    assert ex.value.retry_after == pytest.approx(5, abs=0.01)
+
+
+async def test_unlimited_scopes_and_missing_keys_are_not_checked():
+    limiter = _limiter(FakeAsyncRedis(), ip=(1, 1))
+
+    for _ in range(3):
+        await limiter.check_async("process", {"ip": "1.1.1.1"})
+        await limiter.check_async("create", {"ip": None, "token": "t"})
+
+
+async def test_fails_open_without_redis(caplog):
+    class _BrokenRedis(FakeAsyncRedis):
+        async def evalsha(self, *args, **kwargs):
+            raise ConnectionError()
+
+    limiter = _limiter(_BrokenRedis(), ip=(1, 1))
+
+    for _ in range(3):
+        await limiter.check_async("create", {"ip": "1.1.1.1"})
+    assert "Failed to check rate limit" in caplog.text
+
+
+async def test_token_is_not_stored_in_plain_text():
+    limiter = _limiter(FakeAsyncRedis(), token=(1, 1))
+
+    assert "secret" not in limiter._make_key("create", "token", "secret")
@@ -0,0 +1,87 @@
+"""
+Переходы статусов счета одним условным UPDATE.
+"""
+from unittest import mock
+
+import pytest
+
+from db import InvoiceStatus
+from helpers import invoice_row, make_database, make_invoice
+from invoice_manager import InvalidInvoiceError, InvalidInvoiceStatusError, InvoiceManager
+
+
+pytestmark = pytest.mark.anyio
+
+
+def _handler(rowcount: int, invoice=None):
+    def handler(query, params):
+        if query.startswith("UPDATE"):
+            return rowcount, []
+        return (1, [invoice_row(invoice)]) if invoice else (0, [])
+    return handler
+
+
+async def test_update_is_conditional_on_current_status():
+    database = make_database(_handler(1, make_invoice(status=InvoiceStatus.SUCCESS)))
+
+    transition = await database.transition_invoice_async("i1", [InvoiceStatus.CREATED, InvoiceStatus.PROCESSING],
+                                                         InvoiceStatus.SUCCESS, credited=None, payment_method_invoice_id="p1")
+
+    query, params = database._pool.connection.queries[0]
+    assert query == ("UPDATE invoices SET status = %s, credited = COALESCE(%s, amount), "
+                     "payment_method_invoice_id = COALESCE(%s, payment_method_invoice_id) "
+                     "WHERE invoice_id = %s AND status IN (%s, %s);")
+    assert params == ["success", None, "p1", "i1", "created", "processing"]
+    assert transition.applied
+    assert transition.invoice.status == InvoiceStatus.SUCCESS
+
+
+async def test_not_applied_returns_current_invoice():
+    database = make_database(_handler(0, make_invoice(status=InvoiceStatus.ERROR)))
+
+    transition = await database.transition_invoice_async("i1", [InvoiceStatus.CREATED], InvoiceStatus.SUCCESS)
+
+    assert not transition.applied
+    assert transition.invoice.status == InvoiceStatus.ERROR
+
+
+async def test_unknown_column_is_rejected():
+    database = make_database(_handler(1))
+
+    with pytest.raises(ValueError):
+        await database.transition_invoice_async("i1", [InvoiceStatus.CREATED], InvoiceStatus.SUCCESS, balance=0)
+    assert database._pool.connection.queries == []
+
+
+@pytest.fixture
+def manager_factory():
+    def factory(database) -> InvoiceManager:
+        return InvoiceManager(database, mock.Mock())
+    return factory
+
+
+async def test_payment_of_closed_invoice_raises_with_current_state(manager_factory):
+    manager = manager_factory(make_database(_handler(0, make_invoice(status=InvoiceStatus.SUCCESS))))
+
+    with pytest.raises(InvalidInvoiceStatusError) as ex:
+        await manager.set_invoice_payed_async("i1")
+
+    assert ex.value.invoice.status == InvoiceStatus.SUCCESS
+
+
+async def test_transition_of_unknown_invoice(manager_factory):
+    manager = manager_factory(make_database(_handler(0)))
+
+    with pytest.raises(InvalidInvoiceError):
+        await manager.set_invoice_status_async("i1", InvoiceStatus.ERROR)
+
+
+async def test_status_change_is_not_repeated(manager_factory):
+    database = make_database(_handler(1, make_invoice(status=InvoiceStatus.TIMEOUT)))
+    manager = manager_factory(database)
+
+    await manager.set_invoice_status_async("i1", InvoiceStatus.TIMEOUT)
+
+    # повторный перевод в тот же статус не допускается: TIMEOUT исключен из исходных статусов
+    _, params = database._pool.connection.queries[0]
+    assert "timeout" not in params[2:]
@@ -0,0 +1,99 @@
+"""
+Очередь вебхуков платежных систем: порядок вебхуков счета, отложенные повторы и список необработанных.
+"""
+import json
+from unittest import mock
+
+import pytest
+from fakeredis import FakeAsyncRedis
+from fastapi.responses import JSONResponse
+
+import streams
+import webhook_queue
+from db import InvoiceStatus
+from providers import RawWebhook, WebhookEvent
+from webhook_queue import WebhookIngestQueue
+
+
+pytestmark = pytest.mark.anyio
+
+
+class _Provider:
+    method_id = "enot"
+
+    @staticmethod
+    def parse_webhook(raw: RawWebhook) -> WebhookEvent:
+        data = json.loads(raw.body)
+        return WebhookEvent(data["invoice_id"], data["event"], data["event"], InvoiceStatus.SUCCESS)
+
+
+class _Applier:
+    """
+    Заменяет apply_event_async: запоминает порядок событий и отвечает заданными кодами.
+    """
+    def __init__(self, statuses: dict[str, list[int]] | None = None):
+        self.statuses = statuses or {}
+        self.applied = []
+
+    async def __call__(self, provider, context, event: WebhookEvent):
+        self.applied.append(event.event_id)
+        codes = self.statuses.get(event.event_id)
+        return JSONResponse({}, status_code=codes.pop(0) if codes else 200)
+
+
+async def _make_queue(applier: _Applier, monkeypatch, **kwargs) -> tuple[WebhookIngestQueue, FakeAsyncRedis]:
+    redis = FakeAsyncRedis()
+    queue = WebhookIngestQueue(redis, shards=1, retry_delay=0, **kwargs)
+    queue._context = mock.Mock(invoice_manager=mock.Mock(get_provider=mock.Mock(return_value=_Provider())))
+    await streams.ensure_group_async(redis, queue._get_stream(0), queue.GROUP)
+    monkeypatch.setattr(webhook_queue, "apply_event_async", applier)
+    return queue, redis
+
+
+async def _enqueue(queue: WebhookIngestQueue, invoice_id: str, event: str):
+    body = json.dumps({"invoice_id": invoice_id, "event": event}).encode("utf-8")
+    await queue.enqueue_async("enot", WebhookEvent(invoice_id, event, event, None), RawWebhook(body, "", {}))
+
+
+async def test_failed_invoice_does_not_block_shard_and_keeps_order(monkeypatch):
+    applier = _Applier({"a1": [500]})
+    queue, redis = await _make_queue(applier, monkeypatch)
+    for invoice_id, event in (("a", "a1"), ("b", "b1"), ("a", "a2"), ("b", "b2")):
+        await _enqueue(queue, invoice_id, event)
+
+    await queue._process_batch_async(0)
+    # вебхуки счета b применены, a2 отложен вместе с a1, хотя сам не выполнялся
+    assert applier.applied == ["a1", "b1", "b2"]
+    assert (await queue.get_queue_depth_async()) == {"queued": 0, "delayed": 1, "dead": 0}
+
+    await _enqueue(queue, "a", "a3")
+    await queue._process_batch_async(0)
+
+    assert applier.applied == ["a1", "b1", "b2", "a1", "a2", "a3"]
+    assert (await queue.get_queue_depth_async()) == {"queued": 0, "delayed": 0, "dead": 0}
+
+
+async def test_webhook_is_dead_lettered_after_max_attempts(monkeypatch):
+    applier = _Applier({"a1": [500] * 3})
+    queue, redis = await _make_queue(applier, monkeypatch, max_attempts=3)
+    await _enqueue(queue, "a", "a1")
+    await _enqueue(queue, "a", "a2")
+
+    for _ in range(3):
+        await queue._process_batch_async(0)
+
+    assert applier.applied == ["a1", "a1", "a1", "a2"]
+    dead = json.loads(await redis.lindex(WebhookIngestQueue.DEAD_LETTERS, 0))
+    assert dead["invoice_id"] == "a"
+    assert dead["error"] == "attempts exceeded"
+    assert json.loads(dead["body"])["event"] == "a1"
+
+
+async def test_unknown_invoice_is_dead_lettered(monkeypatch):
+    queue, redis = await _make_queue(_Applier({"a1": [404]}), monkeypatch)
+    await _enqueue(queue, "a", "a1")
+
+    await queue._process_batch_async(0)
+
+    assert json.loads(await redis.lindex(WebhookIngestQueue.DEAD_LETTERS, 0))["error"] == "invoice not found"
+    assert await redis.xlen(queue._get_stream(0)) == 0
@@ -0,0 +1,80 @@
+"""
+Проверка подписи вебхуков платежных систем: поддельные и мусорные вебхуки отклоняются с 401, а не ошибкой сервера.
+"""
+import hashlib
+import json
+import urllib.parse
+from unittest import mock
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import config
+from apis.sessions import ProviderSessions
+from providers import ProviderRegistry
+
+
+@pytest.fixture
+def client() -> TestClient:
+    app = FastAPI()
+    ProviderRegistry(ProviderSessions()).bind_webhooks(app.router, mock.Mock(queue=None))
+    return TestClient(app)
+
+
+def _aaio_form(sign: str) -> bytes:
+    return urllib.parse.urlencode({"amount": "100.00", "currency": "RUB", "order_id": "i1", "invoice_id": "p1",
+                                   "profit": "95.00", "sign": sign}).encode("utf-8")
+
+
+def _pally_form(signature: str) -> bytes:
+    return urllib.parse.urlencode({"InvId": "i1", "OutSum": "100.00", "TrsId": "p1", "Status": "SUCCESS", "CurrencyIn": "RUB",
+                                   "SignatureValue": signature}).encode("utf-8")
+
+
+def _nicepay_query(hash_value: str) -> str:
+    return urllib.parse.urlencode({"result": "success", "payment_id": "p1", "merchant_id": config.NICEPAY_MERCHANT_ID,
+                                   "order_id": "i1", "amount": "10000", "amount_currency": "RUB", "profit": "9500",
+                                   "profit_currency": "RUB", "method": "card", "hash": hash_value})
+
+
+def _post_form(client: TestClient, path: str, body: bytes):
+    return client.post(path, content=body, headers={"Content-Type": "application/x-www-form-urlencoded"})
+
+
+@pytest.mark.parametrize("signature", ["0" * 64, "é", "ф" * 64], ids=["ascii", "latin1", "cyrillic"])
+def test_aaio_rejects_invalid_signature(client: TestClient, signature: str):
+    assert _post_form(client, "/payment_service/aaio_webhook", _aaio_form(signature)).status_code == 401
+
+
+@pytest.mark.parametrize("signature", ["0" * 32, "é", "ф" * 32], ids=["ascii", "latin1", "cyrillic"])
+def test_pally_rejects_invalid_signature(client: TestClient, signature: str):
+    assert _post_form(client, "/payment_service/pally_webhook", _pally_form(signature)).status_code == 401
+
+
+@pytest.mark.parametrize("hash_value", ["0" * 64, "é", "ф" * 64], ids=["ascii", "latin1", "cyrillic"])
+def test_nicepay_rejects_invalid_hash(client: TestClient, hash_value: str):
+    assert client.get("/payment_service/nicepay_webhook?" + _nicepay_query(hash_value)).status_code == 401
+
+
+@pytest.mark.parametrize("signature", [b"0" * 64, "é".encode("latin-1")], ids=["ascii", "latin1"])
+def test_enot_rejects_invalid_signature(client: TestClient, signature: bytes):
+    body = json.dumps({"invoice_id": "p1", "status": "success"}).encode("utf-8")
+    response = client.post("/payment_service/enot_webhook", content=body,
+                           headers=[(b"content-type", b"application/json"), (b"x-api-sha256-signature", signature)])
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize("signature", [b"0" * 64, "é".encode("latin-1")], ids=["ascii", "latin1"])
+def test_lava_rejects_invalid_signature(client: TestClient, signature: bytes):
+    pytest.importorskip("lava_api")
+    response = client.post("/payment_service/lava_webhook", content=b"{}",
+                           headers=[(b"content-type", b"application/json"), (b"authorization", signature)])
+    assert response.status_code == 401
+
+
+def test_pally_valid_signature_passes_verification():
+    from providers.pally import PallyProvider
+    from providers.base import RawWebhook
+    signature = hashlib.md5(f"100.00:i1:{config.PALLY_SECRET_KEY}".encode("utf-8")).hexdigest().upper()
+    assert PallyProvider(ProviderSessions()).verify_webhook(RawWebhook(_pally_form(signature), "", {}))
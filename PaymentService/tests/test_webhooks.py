@@ -0,0 +1,89 @@
+"""
+Применение вебхуков платежных систем и постановка вебхуков клиентам в очередь.
+"""
+from unittest import mock
+
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from db import InvoiceStatus
+from invoice_manager import InvalidInvoiceStatusError
+from providers import WebhookContext, WebhookEvent
+from providers.webhooks import apply_event_async
+from webhook_dedup import WebhookDeduplicator
+from webhook_sender import WebhookSender
+from helpers import make_invoice
+
+
+pytestmark = pytest.mark.anyio
+
+
+class _Provider:
+    method_id = "enot"
+
+    @staticmethod
+    def webhook_ack():
+        from fastapi.responses import JSONResponse
+        return JSONResponse({"success": True})
+
+
+def _payed_event(invoice_id: str = "i1") -> WebhookEvent:
+    return WebhookEvent(invoice_id, "p1", "success", InvoiceStatus.SUCCESS)
+
+
+def _context(redis, invoice_manager, on_invoice_payed) -> WebhookContext:
+    return WebhookContext(invoice_manager, WebhookDeduplicator(redis), on_invoice_payed)
+
+
+async def test_enqueue_is_idempotent_per_invoice():
+    redis = FakeAsyncRedis()
+    sender = WebhookSender(redis)
+    assert await sender.enqueue_async(make_invoice("i1"))
+    assert not await sender.enqueue_async(make_invoice("i1"))
+    assert await sender.enqueue_async(make_invoice("i2"))
+    assert await redis.xlen(WebhookSender.STREAM) == 2
+
+
+async def test_enqueue_failure_is_not_acknowledged():
+    redis = FakeAsyncRedis()
+    payed = make_invoice(status=InvoiceStatus.SUCCESS)
+    invoice_manager = mock.Mock(set_invoice_payed_async=mock.AsyncMock(return_value=payed))
+    on_payed = mock.AsyncMock(side_effect=ConnectionError())
+    context = _context(redis, invoice_manager, on_payed)
+
+    response = await apply_event_async(_Provider(), context, _payed_event())
+
+    assert response.status_code == 500
+    # ответ не запомнен, поэтому повтор вебхука обрабатывается заново
+    assert await context.dedup.get_async(context.dedup.make_key("enot", "p1", "success")) is None
+
+
+async def test_retry_of_payed_invoice_enqueues_missing_client_webhook():
+    redis = FakeAsyncRedis()
+    sender = WebhookSender(redis)
+    payed = make_invoice(status=InvoiceStatus.SUCCESS)
+    invoice_manager = mock.Mock(set_invoice_payed_async=mock.AsyncMock(
+        side_effect=InvalidInvoiceStatusError("i1", InvoiceStatus.SUCCESS, invoice=payed)))
+    context = _context(redis, invoice_manager, sender.enqueue_async)
+
+    # счет оплачен предыдущей обработкой, которая прервалась до постановки вебхука клиенту в очередь
+    response = await apply_event_async(_Provider(), context, _payed_event())
+    assert response.status_code == 200
+    assert await redis.xlen(WebhookSender.STREAM) == 1
+
+    # следующий повтор отвечается из кэша и не ставит вебхук второй раз
+    await apply_event_async(_Provider(), context, _payed_event())
+    assert await redis.xlen(WebhookSender.STREAM) == 1
+
+
+async def test_closed_unpaid_invoice_is_acknowledged_without_client_webhook():
+    redis = FakeAsyncRedis()
+    on_payed = mock.AsyncMock()
+    closed = make_invoice(status=InvoiceStatus.ERROR)
+    invoice_manager = mock.Mock(set_invoice_payed_async=mock.AsyncMock(
+        side_effect=InvalidInvoiceStatusError("i1", InvoiceStatus.ERROR, invoice=closed)))
+
+    response = await apply_event_async(_Provider(), _context(redis, invoice_manager, on_payed), _payed_event())
+
+    assert response.status_code == 200
+    on_payed.assert_not_called()
@@ -0,0 +1,59 @@
+"""
+Защита от повторной обработки вебхуков платежных систем.
+
+Платежные системы повторяют вебхуки, пока не получат ответ, а иногда и после него.
+Ответ на успешно обработанный вебхук сохраняется в Redis, и повторы получают его без обращения к БД.
+"""
+import json
+import logging
+
+from fastapi import Response
+from redis.asyncio import Redis
+
+
+class WebhookDeduplicator:
+    REDIS_PREFIX = "payment_service:webhook_dedup:"
+
+    _redis: Redis
+    _ttl: int
+    _logger: logging.Logger
+
+    def __init__(self, redis: Redis, ttl: int = 86400):
+        """
+        :param ttl: сколько секунд хранится ответ на обработанный вебхук
+        """
+        self._redis = redis
+        self._ttl = ttl
+        self._logger = logging.getLogger("payment_api_logger")
+
+    def make_key(self, provider: str, provider_invoice_id: str, status: str) -> str:
+        return f"{self.REDIS_PREFIX}{provider}:{provider_invoice_id}:{status}"
+
+    async def get_async(self, key: str) -> Response | None:
+        """
+        Возвращает сохраненный ответ, если вебхук с таким ключом уже был обработан.
+        """
+        try:
+            cached = await self._redis.get(key)
+        except Exception as ex:
+            # без Redis вебхук просто обрабатывается повторно
+            self._logger.exception("Failed to get deduplicated webhook response: %s", key, exc_info=ex)
+            return None
+
+        if cached is None:
+            return None
+
+        cached = json.loads(cached)
+        self._logger.info("Duplicate webhook answered from cache: %s", key)
+        return Response(content=cached["body"], status_code=cached["status_code"], media_type=cached["media_type"])
+
+    async def remember_async(self, key: str, response: Response) -> Response:
+        """
+        Сохраняет ответ на успешно обработанный вебхук. Возвращает тот же ответ.
+        """
+        cached = {"status_code": response.status_code, "body": response.body.decode("utf-8"), "media_type": response.media_type}
+        try:
+            await self._redis.set(key, json.dumps(cached), ex=self._ttl)
+        except Exception as ex:
+            self._logger.exception("Failed to save deduplicated webhook response: %s", key, exc_info=ex)
+        return response
@@ -0,0 +1,319 @@
+"""
+Прием вебхуков платежных систем через очередь в Redis Streams.
+
+Вебхук с проверенной подписью записывается в поток, и платежной системе сразу отвечается успехом,
+поэтому время ответа не зависит от нагрузки на БД. Статусы счетов меняют фоновые обработчики.
+
+Вебхуки распределяются по шардам (отдельным потокам) по ID счета. Шард одновременно обрабатывает только один экземпляр
+сервиса, владеющий его блокировкой в Redis, поэтому вебхуки одного счета применяются в порядке поступления.
+Запись подтверждается только после обработки: при падении экземпляра ее обработает следующий владелец шарда.
+
+Вебхук, который не удалось применить, откладывается в список счета вместе со следующими вебхуками этого счета,
+поэтому ошибка одного счета не задерживает остальные счета шарда, а порядок вебхуков счета сохраняется.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import socket
+import time
+import zlib
+
+from redis.asyncio import Redis
+from redis.asyncio.lock import Lock
+from redis.exceptions import LockError
+
+import metrics
+import streams
+from providers import RawWebhook, WebhookContext, WebhookEvent
+from providers.webhooks import apply_event_async
+
+
+class WebhookIngestQueue:
+    REDIS_PREFIX = "payment_service:provider_webhooks:"
+    DEAD_LETTERS = REDIS_PREFIX + "dead"    # вебхуки, которые не удалось применить
+    GROUP = "processors"
+
+    _redis: Redis
+    _logger: logging.Logger
+    _shards: int
+    _batch_size: int
+    _max_attempts: int
+    _lease_seconds: float
+    _retry_delay: float
+    _max_retry_delay: float
+
+    _consumer: str
+    _context: WebhookContext | None
+    _tasks: list[asyncio.Task]
+
+    def __init__(self, redis: Redis, shards: int = 16, batch_size: int = 50, max_attempts: int = 10,
+                 lease_seconds: float = 30, retry_delay: float = 1, max_retry_delay: float = 300):
+        """
+        :param shards: количество потоков. Вебхуки одного счета всегда попадают в один поток
+        :param batch_size: количество записей, читаемых из потока за раз. Записи разных счетов обрабатываются параллельно
+        :param max_attempts: количество попыток, после которого вебхук попадает в список необработанных
+        :param lease_seconds: через сколько секунд шард упавшего экземпляра забирает другой экземпляр
+        :param retry_delay: задержка перед первым повтором вебхука, который не удалось применить; с каждой попыткой удваивается
+        :param max_retry_delay: максимальная задержка между попытками
+        """
+        self._redis = redis
+        self._logger = logging.getLogger("payment_api_logger")
+        self._shards = shards
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._lease_seconds = lease_seconds
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+
+        self._consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._context = None
+        self._tasks = []
+
+    async def start_async(self, context: WebhookContext):
+        self._context = context
+        for shard in range(self._shards):
+            await streams.ensure_group_async(self._redis, self._get_stream(shard), self.GROUP)
+        self._tasks = [asyncio.create_task(self._shard_loop_async(shard)) for shard in range(self._shards)]
+
+    async def stop_async(self):
+        """
+        Останавливает обработку. Неподтвержденные записи обработает следующий владелец шарда.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue_async(self, method_id: str, event: WebhookEvent, raw: RawWebhook):
+        """
+        Записывает вебхук с проверенной подписью в поток шарда его счета.
+        """
+        await self._redis.xadd(self._get_stream(self._get_shard(event.invoice_id)),
+                               {"provider": method_id, "invoice_id": event.invoice_id, "body": raw.body, "query": raw.query,
+                                "headers": json.dumps(raw.headers)})
+
+    async def get_queue_depth_async(self) -> dict[str, int]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for shard in range(self._shards):
+                pipe.xlen(self._get_stream(shard))
+            for shard in range(self._shards):
+                pipe.zcard(self._get_delayed(shard))
+            pipe.llen(self.DEAD_LETTERS)
+            *depths, dead = await pipe.execute()
+        # отложенные считаются по счетам: за каждым может стоять несколько вебхуков
+        return {"queued": sum(depths[:self._shards]), "delayed": sum(depths[self._shards:]), "dead": dead}
+
+    def _get_stream(self, shard: int) -> str:
+        return f"{self.REDIS_PREFIX}{shard}"
+
+    def _get_delayed(self, shard: int) -> str:
+        # счета шарда с отложенными вебхуками, score - время следующей попытки
+        return f"{self.REDIS_PREFIX}delayed:{shard}"
+
+    def _get_delayed_entries(self, shard: int, invoice_id: bytes) -> str:
+        # отложенные вебхуки счета в порядке поступления
+        return f"{self.REDIS_PREFIX}delayed:{shard}:{invoice_id.decode('utf-8')}"
+
+    def _get_shard(self, invoice_id: str) -> int:
+        return zlib.crc32(invoice_id.encode("utf-8")) % self._shards
+
+    def _get_retry_delay(self, attempt: int) -> float:
+        return min(self._max_retry_delay, self._retry_delay * 2 ** (attempt - 1))
+
+    async def _shard_loop_async(self, shard: int):
+        stream = self._get_stream(shard)
+        lock = self._redis.lock(f"{self.REDIS_PREFIX}lock:{shard}", timeout=self._lease_seconds, blocking=False)
+        owned = False
+        try:
+            while True:
+                try:
+                    if owned:
+                        await lock.reacquire()
+                    elif await lock.acquire():
+                        owned = True
+                        await self._claim_pending_async(stream)
+                    else:
+                        await asyncio.sleep(self._lease_seconds / 3)
+                        continue
+
+                    await self._process_batch_with_lease_async(shard, lock)
+                except LockError:
+                    # блокировка истекла, и шард мог забрать другой экземпляр
+                    self._logger.warning("[WEBHOOK QUEUE] Lost shard %s", shard)
+                    owned = False
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    self._logger.exception("[WEBHOOK QUEUE] An error occured in shard %s", shard, exc_info=ex)
+                    await asyncio.sleep(self._retry_delay)
+        finally:
+            if owned:
+                try:
+                    await lock.release()
+                except Exception:
+                    # блокировка освободится сама через lease_seconds
+                    pass
+
+    async def _process_batch_with_lease_async(self, shard: int, lock: Lock):
+        """
+        Обрабатывает порцию записей, продлевая блокировку шарда, пока обработка не закончится: при перегрузке БД порция
+        может обрабатываться дольше lease_seconds. Если блокировку продлить не удалось, обработка прерывается,
+        чтобы вебхуки шарда не применял одновременно новый владелец. Неподтвержденные записи он обработает сам.
+        """
+        batch = asyncio.create_task(self._process_batch_async(shard))
+        try:
+            while True:
+                done, _ = await asyncio.wait({batch}, timeout=self._lease_seconds / 3)
+                if done:
+                    return batch.result()
+                await lock.reacquire()
+        finally:
+            if not batch.done():
+                batch.cancel()
+                await asyncio.gather(batch, return_exceptions=True)
+
+    async def _claim_pending_async(self, stream: str):
+        """
+        Забирает записи, которые предыдущий владелец шарда прочитал, но не подтвердил.
+        Пока шард заблокирован этим экземпляром, другие их не обрабатывают, поэтому ждать простоя записей не нужно.
+        """
+        start = "0-0"
+        while True:
+            start, claimed, *_ = await self._redis.xautoclaim(stream, self.GROUP, self._consumer, 0, start, count=self._batch_size)
+            if claimed:
+                self._logger.info("[WEBHOOK QUEUE] Claimed %s pending webhooks from %s", len(claimed), stream)
+            if start in (b"0-0", "0-0"):
+                return
+
+    async def _process_batch_async(self, shard: int):
+        """
+        Повторяет отложенные вебхуки, время которых наступило, и обрабатывает одну порцию записей шарда.
+        """
+        stream = self._get_stream(shard)
+        due = await self._redis.zrangebyscore(self._get_delayed(shard), "-inf", time.time(), start=0, num=self._batch_size)
+        await asyncio.gather(*(self._process_delayed_async(shard, invoice_id) for invoice_id in due))
+
+        # сначала записи, прочитанные, но не подтвержденные (например, при отмене обработки): иначе более поздние вебхуки
+        # счета обогнали бы их. Вебхуки с ошибкой в потоке не остаются, поэтому они не занимают порцию
+        response = await self._redis.xreadgroup(self.GROUP, self._consumer, {stream: "0"}, count=self._batch_size)
+        entries = streams.read_entries(response)
+        if not entries:
+            response = await self._redis.xreadgroup(self.GROUP, self._consumer, {stream: ">"}, count=self._batch_size, block=1000)
+            entries = streams.read_entries(response)
+
+        by_invoice: dict[bytes, list[streams.StreamEntry]] = {}
+        for entry in entries:
+            by_invoice.setdefault(entry[1][b"invoice_id"], []).append(entry)
+        # у счета с отложенными вебхуками новые вебхуки встают за ними
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for invoice_id in by_invoice:
+                pipe.exists(self._get_delayed_entries(shard, invoice_id))
+            delayed = await pipe.execute()
+        await asyncio.gather(*(self._delay_entries_async(shard, invoice_entries) if is_delayed
+                               else self._process_invoice_entries_async(shard, invoice_entries)
+                               for invoice_entries, is_delayed in zip(by_invoice.values(), delayed)))
+
+    async def _process_invoice_entries_async(self, shard: int, entries: list[streams.StreamEntry]):
+        # вебхуки одного счета применяются по порядку: после ошибки вебхук откладывается вместе со следующими
+        for i, (entry_id, fields) in enumerate(entries):
+            webhook = self._decode_entry(entry_id, fields)
+            outcome = await self._apply_async(webhook)
+            if outcome is None and self._max_attempts > 1:
+                await self._delay_entries_async(shard, entries[i:], time.time() + self._get_retry_delay(1))
+                return
+            async with self._redis.pipeline(transaction=True) as pipe:
+                if outcome is None:
+                    outcome = "attempts exceeded"
+                if outcome:
+                    pipe.lpush(self.DEAD_LETTERS, self._make_dead_letter(webhook, outcome))
+                pipe.xack(self._get_stream(shard), self.GROUP, entry_id)
+                pipe.xdel(self._get_stream(shard), entry_id)
+                await pipe.execute()
+
+    async def _delay_entries_async(self, shard: int, entries: list[streams.StreamEntry], retry_at: float | None = None):
+        """
+        Переносит записи потока в конец отложенных вебхуков их счета.
+        :param retry_at: время следующей попытки. None - не менять время, уже назначенное счету
+        """
+        stream = self._get_stream(shard)
+        invoice_id = entries[0][1][b"invoice_id"]
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for i, (entry_id, fields) in enumerate(entries):
+                webhook = self._decode_entry(entry_id, fields)
+                # первая запись уже не удалась один раз, если счету назначается время повтора
+                webhook["attempt"] = 1 if i == 0 and retry_at is not None else 0
+                pipe.rpush(self._get_delayed_entries(shard, invoice_id), json.dumps(webhook))
+                pipe.xack(stream, self.GROUP, entry_id)
+                pipe.xdel(stream, entry_id)
+            if retry_at is None:
+                pipe.zadd(self._get_delayed(shard), {invoice_id: time.time()}, nx=True)
+            else:
+                pipe.zadd(self._get_delayed(shard), {invoice_id: retry_at})
+            await pipe.execute()
+
+    async def _process_delayed_async(self, shard: int, invoice_id: bytes):
+        """
+        Применяет отложенные вебхуки счета по порядку, пока они не закончатся или какой-то не завершится ошибкой.
+        """
+        key = self._get_delayed_entries(shard, invoice_id)
+        while (item := await self._redis.lindex(key, 0)) is not None:
+            webhook = json.loads(item)
+            outcome = await self._apply_async(webhook)
+            async with self._redis.pipeline(transaction=True) as pipe:
+                if outcome is None:
+                    webhook["attempt"] += 1
+                    if webhook["attempt"] < self._max_attempts:
+                        pipe.lset(key, 0, json.dumps(webhook))
+                        pipe.zadd(self._get_delayed(shard), {invoice_id: time.time() + self._get_retry_delay(webhook["attempt"])})
+                        await pipe.execute()
+                        return
+                    self._logger.error("[WEBHOOK QUEUE] Giving up after %s attempts: %s", webhook["attempt"], webhook["entry_id"],
+                                       extra={"provider": webhook["provider"], "invoice_id": webhook["invoice_id"]})
+                    outcome = "attempts exceeded"
+                if outcome:
+                    pipe.lpush(self.DEAD_LETTERS, self._make_dead_letter(webhook, outcome))
+                pipe.lpop(key)
+                await pipe.execute()
+        await self._redis.zrem(self._get_delayed(shard), invoice_id)
+
+    async def _apply_async(self, webhook: dict) -> str | None:
+        """
+        Применяет вебхук. Возвращает None, если его нужно повторить позже, "" - если он обработан,
+        иначе причину, по которой он попадает в список необработанных.
+        """
+        method_id = webhook["provider"]
+        provider = self._context.invoice_manager.get_provider(method_id)
+        raw = RawWebhook(base64.b64decode(webhook["body"]), webhook["query"], webhook["headers"])
+        if not webhook["attempt"]:
+            metrics.WEBHOOK_QUEUE_LAG_SECONDS.labels(method_id).observe(time.time() - int(webhook["entry_id"].split("-")[0]) / 1000)
+
+        try:
+            event = provider.parse_webhook(raw)
+        except (ValueError, KeyError) as ex:
+            # подпись и формат проверены при приеме, поэтому ошибка здесь означает несовместимое изменение формата
+            self._logger.error("[WEBHOOK QUEUE] Failed to parse queued webhook %s: %s", webhook["entry_id"], ex, extra={"provider": method_id})
+            return "parse error"
+
+        response = await apply_event_async(provider, self._context, event)
+        if response.status_code >= 500:
+            return None
+        if response.status_code == 404:
+            # платежной системе при приеме уже ответили успехом, и она вебхук не повторит: он сохраняется для разбора
+            return "invoice not found"
+        return ""
+
+    @staticmethod
+    def _decode_entry(entry_id: bytes, fields: dict[bytes, bytes]) -> dict:
+        return {"entry_id": entry_id.decode("utf-8"), "attempt": 0, "provider": fields[b"provider"].decode("utf-8"),
+                "invoice_id": fields[b"invoice_id"].decode("utf-8"),
+                # тело хранится в base64: подпись при повторной разборке проверяется по исходным байтам
+                "body": base64.b64encode(fields[b"body"]).decode("ascii"),
+                "query": fields[b"query"].decode("utf-8"), "headers": json.loads(fields[b"headers"])}
+
+    @staticmethod
+    def _make_dead_letter(webhook: dict, error: str) -> str:
+        return json.dumps({"provider": webhook["provider"], "invoice_id": webhook["invoice_id"],
+                           "body": base64.b64decode(webhook["body"]).decode("utf-8", "replace"),
+                           "query": webhook["query"], "headers": webhook["headers"], "error": error})
@@ -0,0 +1,241 @@
+"""
+Доставка вебхуков об оплате счетов на webhook_url клиента.
+
+Вебхуки хранятся в Redis Stream, поэтому не теряются при перезапуске сервиса.
+Неудачные попытки откладываются с экспоненциальной задержкой, после исчерпания попыток вебхук попадает в список недоставленных.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+from redis.asyncio import Redis
+
+import config
+import streams
+from db import InvoiceInfo
+
+
+class WebhookSender:
+    REDIS_PREFIX = "payment_service:webhooks:"
+    STREAM = REDIS_PREFIX + "queue"    # вебхуки, готовые к отправке
+    DELAYED = REDIS_PREFIX + "delayed"    # отложенные повторы, score - время следующей попытки
+    DEAD_LETTERS = REDIS_PREFIX + "dead"    # вебхуки, которые не удалось доставить
+    ENQUEUED_PREFIX = REDIS_PREFIX + "enqueued:"    # отметки о счетах, вебхук которых уже поставлен в очередь
+    GROUP = "senders"
+
+    # ставит вебхук в поток, только если для счета еще нет отметки. Отметка и запись в поток появляются вместе или не появляются вовсе
+    _ENQUEUE_ONCE_SCRIPT = """
+    if redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[2]) then
+        redis.call('XADD', KEYS[2], '*', 'payload', ARGV[1])
+        return 1
+    end
+    return 0
+    """
+
+    # атомарно переносит в поток вебхуки, время повтора которых уже наступило
+    _MOVE_DUE_SCRIPT = """
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, payload in ipairs(due) do
+        redis.call('ZREM', KEYS[1], payload)
+        redis.call('XADD', KEYS[2], '*', 'payload', payload)
+    end
+    return #due
+    """
+
+    _redis: Redis
+    _logger: logging.Logger
+    _workers_count: int
+    _per_host_limit: int
+    _max_attempts: int
+    _base_delay: float
+    _max_delay: float
+    _timeout: float
+    _visibility_timeout: float
+    _enqueued_ttl: int
+
+    _consumer: str
+    _session: aiohttp.ClientSession | None
+    _queue: asyncio.Queue
+    _host_semaphores: defaultdict[str, asyncio.Semaphore]
+    _reader_task: asyncio.Task | None
+    _worker_tasks: list[asyncio.Task]
+    _stopping: bool
+
+    def __init__(self, redis: Redis, workers: int = 8, per_host_limit: int = 4, max_attempts: int = 10,
+                 base_delay: float = 5, max_delay: float = 3600, timeout: float = 10, visibility_timeout: float = 300,
+                 enqueued_ttl: int = 7 * 86400):
+        """
+        :param workers: количество одновременно отправляемых вебхуков
+        :param per_host_limit: максимальное количество одновременных запросов к одному хосту
+        :param max_attempts: количество попыток, после которого вебхук попадает в список недоставленных
+        :param base_delay: задержка перед первым повтором; с каждой попыткой удваивается
+        :param max_delay: максимальная задержка между попытками
+        :param timeout: таймаут одного HTTP запроса
+        :param visibility_timeout: через сколько секунд вебхук, взятый в работу и не подтвержденный, забирается повторно
+        :param enqueued_ttl: сколько секунд хранится отметка о том, что вебхук счета поставлен в очередь.
+                             Должно быть больше времени, в течение которого платежные системы повторяют вебхуки
+        """
+        self._redis = redis
+        self._logger = logging.getLogger("payment_api_logger")
+        self._workers_count = workers
+        self._per_host_limit = per_host_limit
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._timeout = timeout
+        self._visibility_timeout = visibility_timeout
+        self._enqueued_ttl = enqueued_ttl
+
+        self._consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._session = None
+        self._queue = asyncio.Queue(maxsize=workers)
+        self._host_semaphores = defaultdict(lambda: asyncio.Semaphore(self._per_host_limit))
+        self._reader_task = None
+        self._worker_tasks = []
+        self._stopping = False
+        self._move_due = self._redis.register_script(self._MOVE_DUE_SCRIPT)
+        self._enqueue_once = self._redis.register_script(self._ENQUEUE_ONCE_SCRIPT)
+
+    async def start_async(self):
+        await streams.ensure_group_async(self._redis, self.STREAM, self.GROUP)
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self._timeout),
+                                              headers={"User-Id": config.AUTH_TOKEN})
+        self._worker_tasks = [asyncio.create_task(self._worker_async()) for _ in range(self._workers_count)]
+        self._reader_task = asyncio.create_task(self._reader_async())
+
+    async def stop_async(self, timeout: float = 10):
+        """
+        Прекращает получение новых вебхуков и дожидается отправки уже полученных.
+        Вебхуки, которые не успели отправиться за timeout, остаются в Redis и будут отправлены после перезапуска.
+        """
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self._logger.warning("[USER WEBHOOK] %s webhooks were not sent before shutdown", self._queue.qsize())
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def enqueue_async(self, invoice_info: InvoiceInfo) -> bool:
+        """
+        Ставит в очередь вебхук об оплате счета, если он еще не был поставлен. Поэтому вызывать метод можно повторно,
+        например при повторе вебхука платежной системы, обработка которого прервалась после оплаты счета.
+        :return: False, если вебхук счета уже был поставлен в очередь
+        """
+        payload = {
+            "id": str(uuid.uuid4()),    # делает одинаковые вебхуки различимыми в отложенных
+            "url": invoice_info.webhook_url,
+            "attempt": 0,
+            "data": {
+                "invoice_id": invoice_info.invoice_id,
+                "sum": invoice_info.amount,
+                "comment": invoice_info.comment,
+                "custom_field": invoice_info.custom_fields,
+            },
+        }
+        return bool(await self._enqueue_once(keys=[self.ENQUEUED_PREFIX + invoice_info.invoice_id, self.STREAM],
+                                             args=[json.dumps(payload), self._enqueued_ttl]))
+
+    async def get_queue_depth_async(self) -> dict[str, int]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.xlen(self.STREAM)
+            pipe.zcard(self.DELAYED)
+            pipe.llen(self.DEAD_LETTERS)
+            queued, delayed, dead = await pipe.execute()
+        return {"queued": queued, "delayed": delayed, "dead": dead}
+
+    async def _reader_async(self):
+        last_claim = 0
+        while not self._stopping:
+            try:
+                await self._move_due(keys=[self.DELAYED, self.STREAM], args=[time.time(), 100])
+
+                # забирает вебхуки, взятые в работу другим (например, упавшим) экземпляром сервиса и не подтвержденные
+                if time.monotonic() - last_claim > self._visibility_timeout / 2:
+                    last_claim = time.monotonic()
+                    _, claimed, *_ = await self._redis.xautoclaim(self.STREAM, self.GROUP, self._consumer,
+                                                                  int(self._visibility_timeout * 1000), count=100)
+                    for entry in claimed:
+                        await self._queue.put(entry)
+
+                response = await self._redis.xreadgroup(self.GROUP, self._consumer, {self.STREAM: ">"},
+                                                        count=self._workers_count, block=1000)
+                for entry in streams.read_entries(response):
+                    await self._queue.put(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._logger.exception("[USER WEBHOOK] An error occured while reading the queue", exc_info=ex)
+                await asyncio.sleep(1)
+
+    async def _worker_async(self):
+        while True:
+            entry_id, fields = await self._queue.get()
+            try:
+                await self._handle_entry_async(entry_id, fields)
+            except Exception as ex:
+                # вебхук остается неподтвержденным и будет забран повторно через visibility_timeout
+                self._logger.exception("[USER WEBHOOK] Failed to handle queue entry %s", entry_id, exc_info=ex)
+            finally:
+                self._queue.task_done()
+
+    async def _handle_entry_async(self, entry_id: bytes, fields: dict[bytes, bytes]):
+        payload = json.loads(fields[b"payload"])
+        error = await self._deliver_async(payload)
+
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if error is not None:
+                payload["attempt"] += 1
+                payload["error"] = error
+                if payload["attempt"] >= self._max_attempts:
+                    self._logger.error("[USER WEBHOOK] Giving up after %s attempts: id = %s", payload['attempt'], payload['data']['invoice_id'],
+                                       extra={"invoice_id": payload['data']['invoice_id']})
+                    pipe.lpush(self.DEAD_LETTERS, json.dumps(payload))
+                else:
+                    pipe.zadd(self.DELAYED, {json.dumps(payload): time.time() + self._get_retry_delay(payload["attempt"])})
+            pipe.xack(self.STREAM, self.GROUP, entry_id)
+            pipe.xdel(self.STREAM, entry_id)
+            await pipe.execute()
+
+    async def _deliver_async(self, payload: dict) -> str | None:
+        """
+        Отправляет вебхук. Возвращает описание ошибки или None, если вебхук доставлен.
+        """
+        invoice_id = payload["data"]["invoice_id"]
+        async with self._host_semaphores[urlsplit(payload["url"]).netloc]:
+            try:
+                async with self._session.post(payload["url"], json=payload["data"]) as resp:
+                    if resp.status != 200:
+                        self._logger.error("Failed to send webhook with status code %s: id = %s", resp.status, invoice_id, extra={"invoice_id": invoice_id})
+                        return f"HTTP {resp.status}"
+            except Exception as ex:
+                self._logger.exception("Internal error occured while sending webhook: id = %s", invoice_id, exc_info=ex, extra={"invoice_id": invoice_id})
+                return str(ex) or type(ex).__name__
+
+        self._logger.info("[USER WEBHOOK] Sended successfully: id = %s", invoice_id, extra={"invoice_id": invoice_id})
+        return None
+
+    def _get_retry_delay(self, attempt: int) -> float:
+        # экспоненциальная задержка со случайной составляющей, чтобы повторы к одному хосту не шли пачкой
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)